@@ -0,0 +1,24 @@
+#!/bin/bash -l
+
+# The directory that contains the COGS .tsv files.
+export TSV_DIR=$1
+# The directory to save the compiled shards and vocabularies to.
+export DATA_DIR=$2
+export OPENNMT_DIR=$3
+
+mkdir -p $DATA_DIR
+
+# As with the reformatted vocabulary files, both vocabularies cover every split.
+python $OPENNMT_DIR/compile_corpus.py \
+    -train $TSV_DIR/train.tsv \
+    -valid $TSV_DIR/dev.tsv \
+    -eval $TSV_DIR/test.tsv $TSV_DIR/gen.tsv \
+    -vocab_corpora $TSV_DIR/train.tsv $TSV_DIR/train_100.tsv $TSV_DIR/dev.tsv $TSV_DIR/test.tsv $TSV_DIR/gen.tsv \
+    -save_data $DATA_DIR/1_example
+
+python $OPENNMT_DIR/compile_corpus.py \
+    -train $TSV_DIR/train_100.tsv \
+    -valid $TSV_DIR/dev.tsv \
+    -eval $TSV_DIR/test.tsv $TSV_DIR/gen.tsv \
+    -vocab_corpora $TSV_DIR/train.tsv $TSV_DIR/train_100.tsv $TSV_DIR/dev.tsv $TSV_DIR/test.tsv $TSV_DIR/gen.tsv \
+    -save_data $DATA_DIR/100_example
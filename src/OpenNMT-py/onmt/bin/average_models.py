@@ -2,6 +2,8 @@
 import argparse
 import torch
 
+from onmt.models import load_checkpoint
+
 
 def average_models(model_files, fp32=False):
     vocab = None
@@ -10,7 +12,7 @@ def average_models(model_files, fp32=False):
     avg_generator = None
 
     for i, model_file in enumerate(model_files):
-        m = torch.load(model_file, map_location='cpu')
+        m = load_checkpoint(model_file)
         model_weights = m['model']
         generator_weights = m['generator']
 
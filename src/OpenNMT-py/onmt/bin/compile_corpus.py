@@ -0,0 +1,144 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+    Compile tab-separated corpora (source, target, category) straight into
+    numericalized shards and a vocabulary, in a single pass over the files.
+"""
+import codecs
+import os
+from collections import Counter, defaultdict
+
+import numpy as np
+import torch
+
+import onmt.inputters as inputters
+import onmt.opts as opts
+from onmt.inputters.dataset_base import length_array
+from onmt.inputters.inputter import _build_fields_vocab, _load_vocab, \
+    length_histogram, save_length_histogram
+from onmt.inputters.numeric_dataset import SHARD_SUFFIX, encode, save_shard
+from onmt.utils.logging import init_logger, logger
+from onmt.utils.parse import ArgumentParser
+
+
+def read_corpus(path, symbols, categories):
+    """Read and numericalize one tab-separated corpus.
+
+    Args:
+        path (str): corpus file, one ``source\\ttarget[\\tcategory]``
+            example per line.
+        symbols (dict[str, int]): symbol table, extended in place.
+        categories (dict[str, int]): category table, extended in place.
+
+    Returns:
+        dict[str, numpy.ndarray]: the arrays of a numericalized shard.
+    """
+
+    srcs, tgts, cats = [], [], []
+    with codecs.open(path, "r", "utf-8") as f:
+        for line in f:
+            cols = line.rstrip("\n").split("\t")
+            srcs.append(cols[0].split())
+            tgts.append(cols[1].split())
+            cat = cols[2] if len(cols) > 2 else ""
+            cats.append(categories.setdefault(cat, len(categories)))
+    src, src_offsets = encode(srcs, symbols)
+    tgt, tgt_offsets = encode(tgts, symbols)
+    return {"src": src, "src_offsets": src_offsets,
+            "tgt": tgt, "tgt_offsets": tgt_offsets,
+            "src_len": length_array(np.diff(src_offsets)),
+            "tgt_len": length_array(np.diff(tgt_offsets)),
+            "indices": np.arange(len(srcs), dtype=np.int64),
+            "category": np.array(cats, dtype=np.uint8)}
+
+
+def _count(ids, itos):
+    counts = np.bincount(ids, minlength=len(itos))
+    return Counter({itos[i]: int(counts[i]) for i in np.flatnonzero(counts)})
+
+
+def compile_corpus(opt):
+    init_logger(opt.log_file)
+
+    corpora = [("train", opt.train)]
+    if opt.valid:
+        corpora.append(("valid", opt.valid))
+    for path in opt.eval:
+        corpora.append((os.path.splitext(os.path.basename(path))[0], path))
+    names = [name for name, _ in corpora]
+    assert len(set(names)) == len(names), \
+        "Compiled corpora must have distinct names, got %s" % names
+
+    symbols, categories = {}, {}
+    shards = {}
+    for name, path in corpora:
+        logger.info("Reading %s corpus from %s" % (name, path))
+        shards[name] = read_corpus(path, symbols, categories)
+        logger.info(" * number of examples: %d"
+                    % (len(shards[name]["src_offsets"]) - 1))
+
+    vocab_paths = opt.vocab_corpora or [path for _, path in corpora]
+    by_path = {path: name for name, path in corpora}
+    counters = defaultdict(Counter)
+    src_vocab_size, tgt_vocab_size = opt.src_vocab_size, opt.tgt_vocab_size
+    if opt.src_vocab:
+        _, src_vocab_size = _load_vocab(
+            opt.src_vocab, "src", counters, opt.src_words_min_frequency)
+    if opt.tgt_vocab:
+        _, tgt_vocab_size = _load_vocab(
+            opt.tgt_vocab, "tgt", counters, opt.tgt_words_min_frequency)
+    for path in vocab_paths:
+        if path in by_path:
+            arrays = shards[by_path[path]]
+        else:
+            arrays = read_corpus(path, symbols, {})
+        itos = sorted(symbols, key=symbols.get)
+        if not opt.src_vocab:
+            counters["src"].update(_count(arrays["src"], itos))
+        if not opt.tgt_vocab:
+            counters["tgt"].update(_count(arrays["tgt"], itos))
+    counters["corpus_id"].update(
+        {"train": len(shards["train"]["src_offsets"]) - 1})
+
+    fields = inputters.get_fields("text", 0, 0)
+    fields = _build_fields_vocab(
+        fields, counters, "text",
+        opt.share_vocab, opt.vocab_size_multiple,
+        src_vocab_size, opt.src_words_min_frequency,
+        tgt_vocab_size, opt.tgt_words_min_frequency)
+    vocab_path = opt.save_data + ".vocab.pt"
+    logger.info("Saving vocabulary to %s" % vocab_path)
+    torch.save(fields, vocab_path)
+
+    assert len(categories) <= 256, "Too many categories for uint8 storage."
+    itos = sorted(symbols, key=symbols.get)
+    cat_itos = sorted(categories, key=categories.get)
+    meta = {"symbols": itos, "categories": cat_itos, "corpus_id": "train"}
+    for name, arrays in shards.items():
+        shard_path = "{:s}.{:s}.0{:s}".format(
+            opt.save_data, name, SHARD_SUFFIX)
+        logger.info(" * saving %s data shard to %s." % (name, shard_path))
+        save_shard(shard_path, arrays, meta)
+        save_length_histogram(
+            "{:s}.{:s}.lengths.json".format(opt.save_data, name),
+            [length_histogram({"src": arrays["src_len"],
+                               "tgt": arrays["tgt_len"]})])
+
+
+def _get_parser():
+    parser = ArgumentParser(description='compile_corpus.py')
+
+    opts.config_opts(parser)
+    opts.compile_opts(parser)
+    return parser
+
+
+def main():
+    parser = _get_parser()
+
+    opt = parser.parse_args()
+    compile_corpus(opt)
+
+
+if __name__ == "__main__":
+    main()
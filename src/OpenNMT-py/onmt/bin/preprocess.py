@@ -6,6 +6,11 @@
 import codecs
 import glob
 import gc
+import hashlib
+import json
+import math
+import os
+import numpy as np
 import torch
 from collections import Counter, defaultdict
 
@@ -17,12 +22,68 @@ from onmt.utils.parse import ArgumentParser
 from onmt.inputters.inputter import _build_fields_vocab,\
                                     _load_vocab, \
                                     old_style_vocab, \
-                                    load_old_vocab
+                                    load_old_vocab, \
+                                    length_histogram, \
+                                    save_length_histogram
+from onmt.inputters.numeric_dataset import NumericExample, \
+                                           encode, save_shard
+from onmt.inputters.dataset_base import build_dynamic_dict, length_array
 
 from functools import partial
 from multiprocessing import Pool
 
 
+# Options that change the content of a shard or of its counters.
+SHARD_OPTS = ['data_type', 'shard_format', 'shard_size', 'src_dir',
+              'src_seq_length', 'tgt_seq_length', 'src_seq_length_trunc',
+              'tgt_seq_length_trunc', 'filter_valid', 'dynamic_dict',
+              'sample_rate', 'window_size', 'window_stride', 'window',
+              'image_channel_size']
+# Options that change the vocabulary built from the counters.
+VOCAB_OPTS = ['data_type', 'share_vocab', 'vocab_size_multiple',
+              'src_vocab_size', 'tgt_vocab_size', 'src_words_min_frequency',
+              'tgt_words_min_frequency', 'dynamic_dict', 'subword_prefix',
+              'subword_prefix_is_joiner']
+
+
+def _digest(*parts):
+    h = hashlib.sha1()
+    for part in parts:
+        if isinstance(part, (list, tuple)):
+            for line in part:
+                h.update(line)
+        else:
+            h.update(json.dumps(part, sort_keys=True).encode("utf-8"))
+        h.update(b"\0")
+    return h.hexdigest()
+
+
+def _file_digest(path):
+    if not path:
+        return None
+    h = hashlib.sha1()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def load_manifest(opt):
+    """Read the manifest recording what every shard was built from."""
+    path = opt.save_data + '.manifest.json'
+    if opt.overwrite or not os.path.exists(path):
+        return {"shards": {}, "vocab": None}
+    with open(path) as f:
+        return json.load(f)
+
+
+def save_manifest(opt, manifest):
+    path = opt.save_data + '.manifest.json'
+    with open(path + '.tmp', 'w') as f:
+        json.dump(manifest, f)
+    os.replace(path + '.tmp', path)
+
+
 def check_existing_pt_files(opt, corpus_type, ids, existing_fields):
     """ Check if there are existing .pt files to avoid overwriting them """
     existing_shards = []
@@ -31,7 +92,8 @@ def check_existing_pt_files(opt, corpus_type, ids, existing_fields):
             shard_base = corpus_type + "_" + maybe_id
         else:
             shard_base = corpus_type
-        pattern = opt.save_data + '.{}.*.pt'.format(shard_base)
+        pattern = opt.save_data + '.{}.*.{}'.format(
+            shard_base, opt.shard_format)
         if glob.glob(pattern):
             if opt.overwrite:
                 maybe_overwrite = ("will be overwritten because "
@@ -45,14 +107,103 @@ def check_existing_pt_files(opt, corpus_type, ids, existing_fields):
     return existing_shards
 
 
-def process_one_shard(corpus_params, params):
-    corpus_type, fields, src_reader, tgt_reader, align_reader, opt,\
-         existing_fields, src_vocab, tgt_vocab = corpus_params
-    i, (src_shard, tgt_shard, align_shard, maybe_id, filter_pred) = params
+def _count_symbols(ids, symbols):
+    counts = np.bincount(ids, minlength=len(symbols))
+    return Counter({symbols[j]: int(counts[j])
+                    for j in np.flatnonzero(counts)})
+
+
+def build_numeric_shard(corpus_params, shard, offset=0):
+    """Tokenize a text shard into token ids and offsets.
+
+    Args:
+        corpus_params: see :func:`process_one_shard`.
+        shard: ``(src_shard, tgt_shard, align_shard, maybe_id,
+            filter_pred)``.
+        offset (int): index of the first line of ``shard``.
+
+    Returns:
+        (dict[str, numpy.ndarray], List[str], dict[str, Counter]): the
+        shard arrays, its symbol table and its counters.
+    """
+    corpus_type, fields, _, _, _, opt, \
+        existing_fields, src_vocab, tgt_vocab = corpus_params
+    src_shard, tgt_shard, _, maybe_id, filter_pred = shard
+    sub_sub_counter = defaultdict(Counter)
+    assert len(src_shard) == len(tgt_shard)
+
+    src_field = fields["src"].base_field
+    tgt_field = fields["tgt"].base_field
+    srcs, tgts, indices = [], [], []
+    for index, (src, tgt) in enumerate(zip(src_shard, tgt_shard), offset):
+        ex = NumericExample((src_field.preprocess(src.decode("utf-8")),),
+                            (tgt_field.preprocess(tgt.decode("utf-8")),),
+                            index)
+        if filter_pred is not None and not filter_pred(ex):
+            continue
+        srcs.append(ex.src[0])
+        tgts.append(ex.tgt[0])
+        indices.append(index)
+
+    symbols = {}
+    src_ids, src_offsets = encode(srcs, symbols)
+    tgt_ids, tgt_offsets = encode(tgts, symbols)
+    itos = sorted(symbols, key=symbols.get)
+    if corpus_type == "train" and existing_fields is None:
+        sub_sub_counter['corpus_id'].update(
+            {"train" if maybe_id is None else maybe_id: len(srcs)})
+        if src_vocab is None:
+            sub_sub_counter['src'].update(_count_symbols(src_ids, itos))
+        if tgt_vocab is None:
+            sub_sub_counter['tgt'].update(_count_symbols(tgt_ids, itos))
+    arrays = {"src": src_ids, "src_offsets": src_offsets,
+              "tgt": tgt_ids, "tgt_offsets": tgt_offsets,
+              "indices": np.array(indices, dtype=np.int64)}
+    return arrays, itos, sub_sub_counter
+
+
+def merge_numeric_shards(parts):
+    """Concatenate the outputs of :func:`build_numeric_shard`, in order."""
+    symbols = {}
+    pieces = defaultdict(list)
+    totals = {"src": 0, "tgt": 0}
+    sub_sub_counter = defaultdict(Counter)
+    for arrays, itos, counter in parts:
+        remap = np.array([symbols.setdefault(s, len(symbols)) for s in itos],
+                         dtype=np.int32)
+        for side in totals:
+            pieces[side].append(remap[arrays[side]])
+            pieces[side + "_offsets"].append(
+                arrays[side + "_offsets"][1:] + totals[side])
+            totals[side] += len(arrays[side])
+        pieces["indices"].append(arrays["indices"])
+        for key, value in counter.items():
+            sub_sub_counter[key].update(value)
+    arrays = {k: np.concatenate(v) for k, v in pieces.items()}
+    for side in totals:
+        arrays[side + "_offsets"] = np.concatenate(
+            [np.zeros(1, dtype=np.int64), arrays[side + "_offsets"]])
+    return arrays, sorted(symbols, key=symbols.get), sub_sub_counter
+
+
+def build_dataset_shard(corpus_params, shard, offset=0):
+    """Build the examples of a shard and count their tokens.
+
+    Args:
+        corpus_params: see :func:`process_one_shard`.
+        shard: ``(src_shard, tgt_shard, align_shard, maybe_id,
+            filter_pred)``.
+        offset (int): index of the first line of ``shard``.
+
+    Returns:
+        (inputters.Dataset, dict[str, Counter])
+    """
+    corpus_type, fields, src_reader, tgt_reader, align_reader, opt, \
+        existing_fields, src_vocab, tgt_vocab = corpus_params
+    src_shard, tgt_shard, align_shard, maybe_id, filter_pred = shard
     # create one counter per shard
     sub_sub_counter = defaultdict(Counter)
     assert len(src_shard) == len(tgt_shard)
-    logger.info("Building shard %d." % i)
 
     src_data = {"reader": src_reader, "data": src_shard, "dir": opt.src_dir}
     tgt_data = {"reader": tgt_reader, "data": tgt_shard, "dir": None}
@@ -66,6 +217,9 @@ def process_one_shard(corpus_params, params):
         filter_pred=filter_pred,
         corpus_id=maybe_id
     )
+    if offset:
+        for ex in dataset.examples:
+            ex.indices += offset
     if corpus_type == "train" and existing_fields is None:
         for ex in dataset.examples:
             sub_sub_counter['corpus_id'].update(
@@ -90,16 +244,72 @@ def process_one_shard(corpus_params, params):
                             and sub_f.sequential and not has_vocab):
                         val = fd
                         sub_sub_counter[sub_n].update(val)
+    return dataset, sub_sub_counter
+
+
+def merge_dataset_shards(parts):
+    """Concatenate the outputs of :func:`build_dataset_shard`, in order."""
+    dataset, sub_sub_counter = parts[0]
+    for part, counter in parts[1:]:
+        if dataset.symbols is not None:
+            for ex in part.examples:
+                ex.rebase(dataset.symbols)
+        dataset.examples.extend(part.examples)
+        for key, value in counter.items():
+            sub_sub_counter[key].update(value)
+    if dataset.lengths is not None:
+        dataset.build_length_index()
+    if dataset.dynamic_dict is not None:
+        dataset.build_dynamic_dict()
+    return dataset, sub_sub_counter
+
+
+def _build_shard(corpus_params, shard, offset=0):
+    opt = corpus_params[5]
+    if opt.shard_format == "bin":
+        return build_numeric_shard(corpus_params, shard, offset)
+    return build_dataset_shard(corpus_params, shard, offset)
+
+
+def _save_shard(corpus_params, i, maybe_id, built):
+    corpus_type, opt = corpus_params[0], corpus_params[5]
     if maybe_id:
         shard_base = corpus_type + "_" + maybe_id
     else:
         shard_base = corpus_type
-    data_path = "{:s}.{:s}.{:d}.pt".\
-        format(opt.save_data, shard_base, i)
+    data_path = "{:s}.{:s}.{:d}.{:s}".\
+        format(opt.save_data, shard_base, i, opt.shard_format)
 
     logger.info(" * saving %sth %s data shard to %s."
                 % (i, shard_base, data_path))
 
+    if opt.shard_format == "bin":
+        arrays, itos, sub_sub_counter = built
+        meta = {"symbols": itos,
+                "corpus_id": "train" if maybe_id is None else maybe_id}
+        if opt.dynamic_dict:
+            src_field = corpus_params[1]["src"].base_field
+            meta["copy_specials"] = [src_field.unk_token,
+                                     src_field.pad_token]
+            copy = build_dynamic_dict(
+                arrays["src"], arrays["src_offsets"],
+                arrays["tgt"], arrays["tgt_offsets"],
+                itos, meta["copy_specials"])
+            arrays = dict(arrays, src_map=copy["src_map"],
+                          alignment=copy["alignment"],
+                          copy_vocab=copy["vocab"],
+                          copy_vocab_offsets=copy["vocab_offsets"])
+        lengths = {side: length_array(np.diff(arrays[side + "_offsets"]))
+                   for side in ("src", "tgt")}
+        arrays = dict(arrays, src_len=lengths["src"],
+                      tgt_len=lengths["tgt"])
+        save_shard(data_path, arrays, meta)
+        return sub_sub_counter, length_histogram(lengths)
+
+    dataset, sub_sub_counter = built
+    histogram = None
+    if dataset.lengths is not None:
+        histogram = length_histogram(dataset.lengths)
     dataset.save(data_path)
 
     del dataset.examples
@@ -107,7 +317,58 @@ def process_one_shard(corpus_params, params):
     del dataset
     gc.collect()
 
-    return sub_sub_counter
+    return sub_sub_counter, histogram
+
+
+def process_one_shard(corpus_params, params):
+    """Build and save one shard.
+
+    Args:
+        corpus_params: ``(corpus_type, fields, src_reader, tgt_reader,
+            align_reader, opt, existing_fields, src_vocab, tgt_vocab)``.
+        params: ``(i, (src_shard, tgt_shard, align_shard, maybe_id,
+            filter_pred))``.
+
+    Returns:
+        (dict[str, Counter], dict): the counters of the shard and its
+        length histogram (see :func:`inputters.length_histogram`).
+    """
+    i, shard = params
+    logger.info("Building shard %d." % i)
+    return _save_shard(
+        corpus_params, i, shard[3], _build_shard(corpus_params, shard))
+
+
+def _build_chunk(corpus_params, params):
+    offset, shard = params
+    return _build_shard(corpus_params, shard, offset)
+
+
+def process_one_shard_in_chunks(pool, corpus_params, params):
+    """Like :func:`process_one_shard`, splitting the shard across ``pool``.
+
+    The shard is cut into one chunk of consecutive lines per worker. The
+    chunks are merged back in order, so the saved shard is the same as the
+    one :func:`process_one_shard` would write.
+    """
+    i, (src_shard, tgt_shard, align_shard, maybe_id, filter_pred) = params
+    opt = corpus_params[5]
+    size = max(1, int(math.ceil(len(src_shard) / opt.num_threads)))
+    chunks = [(start, (src_shard[start:start + size],
+                       tgt_shard[start:start + size],
+                       align_shard[start:start + size]
+                       if align_shard is not None else None,
+                       maybe_id, filter_pred))
+              for start in range(0, len(src_shard), size)]
+    if len(chunks) <= 1:
+        return process_one_shard(corpus_params, params)
+    logger.info("Building shard %d in %d chunks." % (i, len(chunks)))
+    parts = pool.map(partial(_build_chunk, corpus_params), chunks)
+    if opt.shard_format == "bin":
+        built = merge_numeric_shards(parts)
+    else:
+        built = merge_dataset_shards(parts)
+    return _save_shard(corpus_params, i, maybe_id, built)
 
 
 def maybe_load_vocab(corpus_type, counters, opt):
@@ -151,18 +412,43 @@ def build_save_dataset(corpus_type, fields, src_reader, tgt_reader,
     src_vocab, tgt_vocab, existing_fields = maybe_load_vocab(
         corpus_type, counters, opt)
 
+    manifest = load_manifest(opt)
+
+    def shard_base(maybe_id):
+        return corpus_type + "_" + maybe_id if maybe_id else corpus_type
+
+    def tracked(maybe_id):
+        prefix = shard_base(maybe_id) + "."
+        return any(k.startswith(prefix) for k in manifest["shards"])
+
+    # shards recorded in the manifest are checked one by one below
     existing_shards = check_existing_pt_files(
-        opt, corpus_type, ids, existing_fields)
+        opt, corpus_type, [i for i in ids if not tracked(i)],
+        existing_fields)
 
     # every corpus has shards, no new one
     if existing_shards == ids and not opt.overwrite:
         return
 
-    def shard_iterator(srcs, tgts, ids, aligns, existing_shards,
-                       existing_fields, corpus_type, opt):
+    shard_opts = {k: getattr(opt, k, None) for k in SHARD_OPTS}
+    shard_opts.update(
+        corpus_type=corpus_type,
+        counted=corpus_type == "train" and existing_fields is None,
+        src_vocab=src_vocab is not None, tgt_vocab=tgt_vocab is not None)
+    # (name, key) of the shards sent to the pool, in order
+    pending = []
+
+    def shards_to_build(srcs, tgts, ids, aligns, existing_shards,
+                        existing_fields, corpus_type, opt):
         """
-        Builds a single iterator yielding every shard of every corpus.
+        Lists the shards of every corpus to build, in order.
+        Shards whose inputs match the manifest are not rebuilt, their
+        recorded counters are used instead.
+
+        This runs in the main thread, before the pool: the counters and
+        the manifest are only updated from there.
         """
+        shards = []
         for src, tgt, maybe_id, maybe_align in zip(srcs, tgts, ids, aligns):
             if maybe_id in existing_shards:
                 if opt.overwrite:
@@ -190,25 +476,87 @@ def build_save_dataset(corpus_type, fields, src_reader, tgt_reader,
             src_shards = split_corpus(src, opt.shard_size)
             tgt_shards = split_corpus(tgt, opt.shard_size)
             align_shards = split_corpus(maybe_align, opt.shard_size)
+            names = set()
             for i, (ss, ts, a_s) in enumerate(
                     zip(src_shards, tgt_shards, align_shards)):
-                yield (i, (ss, ts, a_s, maybe_id, filter_pred))
-
-    shard_iter = shard_iterator(srcs, tgts, ids, aligns, existing_shards,
-                                existing_fields, corpus_type, opt)
+                name = "{:s}.{:d}.{:s}".format(
+                    shard_base(maybe_id), i, opt.shard_format)
+                names.add(name)
+                key = _digest(shard_opts, maybe_id, ss, ts,
+                              a_s if a_s is not None else "no align")
+                record = manifest["shards"].get(name)
+                if record is not None and record["key"] == key and \
+                        "lengths" in record and \
+                        os.path.exists(opt.save_data + "." + name):
+                    logger.info("Shard %s is up to date." % name)
+                    if counters is not None:
+                        for k, value in record["counter"].items():
+                            counters[k].update(value)
+                    continue
+                pending.append((name, key))
+                shards.append((i, (ss, ts, a_s, maybe_id, filter_pred)))
+            # drop the shards left over from a larger version of the
+            # corpus, or saved in another format
+            prefix = shard_base(maybe_id) + "."
+            for name in list(manifest["shards"]):
+                if name.startswith(prefix) and name not in names:
+                    logger.info("Removing stale shard %s." % name)
+                    del manifest["shards"][name]
+                    if os.path.exists(opt.save_data + "." + name):
+                        os.remove(opt.save_data + "." + name)
+        return shards
+
+    shards = shards_to_build(srcs, tgts, ids, aligns, existing_shards,
+                             existing_fields, corpus_type, opt)
 
     with Pool(opt.num_threads) as p:
         dataset_params = (corpus_type, fields, src_reader, tgt_reader,
                           align_reader, opt, existing_fields,
                           src_vocab, tgt_vocab)
-        func = partial(process_one_shard, dataset_params)
-        for sub_counter in p.imap(func, shard_iter):
+        if opt.shard_size > 0 or opt.num_threads == 1:
+            func = partial(process_one_shard, dataset_params)
+            results = p.imap(func, shards)
+        else:
+            # a single shard per corpus: parallelize within the shards
+            results = (
+                process_one_shard_in_chunks(p, dataset_params, params)
+                for params in shards)
+        for i, (sub_counter, histogram) in enumerate(results):
+            name, key = pending[i]
+            manifest["shards"][name] = {
+                "key": key, "counter": sub_counter or {},
+                "lengths": histogram}
             if sub_counter is not None:
-                for key, value in sub_counter.items():
-                    counters[key].update(value)
+                for k, value in sub_counter.items():
+                    counters[k].update(value)
+    save_manifest(opt, manifest)
+
+    histograms = [record["lengths"]
+                  for name, record in sorted(manifest["shards"].items())
+                  if name.split(".")[0].split("_")[0] == corpus_type
+                  and record.get("lengths")]
+    if histograms:
+        path = "{:s}.{:s}.lengths.json".format(opt.save_data, corpus_type)
+        summary = save_length_histogram(path, histograms)
+        for side in ("src", "tgt"):
+            if side in summary:
+                logger.info(
+                    " * %s %s lengths: mean %.1f, p95 %d, max %d (%s)."
+                    % (corpus_type, side, summary[side]["mean"],
+                       summary[side]["percentiles"]["95"],
+                       summary[side]["max"], path))
 
     if corpus_type == "train":
         vocab_path = opt.save_data + '.vocab.pt'
+        vocab_opts = {k: getattr(opt, k) for k in VOCAB_OPTS}
+        vocab_key = _digest(
+            vocab_opts,
+            {k: sorted(v.items()) for k, v in counters.items()},
+            {"src_vocab": _file_digest(opt.src_vocab),
+             "tgt_vocab": _file_digest(opt.tgt_vocab)})
+        if manifest["vocab"] == vocab_key and os.path.exists(vocab_path):
+            logger.info("Counters are unchanged, keeping %s." % vocab_path)
+            return
         new_fields = _build_fields_vocab(
             fields, counters, opt.data_type,
             opt.share_vocab, opt.vocab_size_multiple,
@@ -231,6 +579,8 @@ def build_save_dataset(corpus_type, fields, src_reader, tgt_reader,
                 counters["corpus_id"])
 
         torch.save(fields, vocab_path)
+        manifest["vocab"] = vocab_key
+        save_manifest(opt, manifest)
 
 
 def build_save_vocab(train_dataset, fields, opt):
@@ -278,6 +628,8 @@ def preprocess(opt):
                 "the other target datasets" % tgt
     logger.info(" * number of source features: %d." % src_nfeats)
     logger.info(" * number of target features: %d." % tgt_nfeats)
+    assert opt.shard_format != "bin" or src_nfeats == tgt_nfeats == 0, \
+        "-shard_format bin does not support word features."
 
     logger.info("Building `Fields` object...")
     fields = inputters.get_fields(
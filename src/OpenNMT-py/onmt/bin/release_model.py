@@ -1,7 +1,12 @@
 #!/usr/bin/env python
 import argparse
+import os
+import tempfile
+
 import torch
 
+from onmt.models import load_checkpoint
+
 
 def get_ctranslate2_model_spec(opt):
     """Creates a CTranslate2 model specification from the model options."""
@@ -39,7 +44,7 @@ def main():
                         help="Quantization type for CT2 model.")
     opt = parser.parse_args()
 
-    model = torch.load(opt.model)
+    model = load_checkpoint(opt.model)
     if opt.format == "pytorch":
         model["optim"] = None
         torch.save(model, opt.output)
@@ -50,9 +55,13 @@ def main():
                              "to https://github.com/OpenNMT/CTranslate2 for "
                              "more information on supported models.")
         import ctranslate2
-        converter = ctranslate2.converters.OpenNMTPyConverter(opt.model)
-        converter.convert(opt.output, model_spec, force=True,
-                          quantization=opt.quantization)
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            # the converter needs the vocab in the checkpoint
+            model_path = os.path.join(tmp_dir, "model.pt")
+            torch.save(model, model_path)
+            converter = ctranslate2.converters.OpenNMTPyConverter(model_path)
+            converter.convert(opt.output, model_spec, force=True,
+                              quantization=opt.quantization)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,395 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+    Train a grid of settings over several seeds on a pool of processes,
+    then tabulate the exact match of every run on the evaluation corpora.
+
+    The corpora are staged once in shared memory as memory-mapped shards,
+    which the runs map instead of loading their own copy.
+"""
+import glob
+import itertools
+import os
+import re
+import shutil
+import sys
+import tempfile
+import time
+import traceback
+
+import numpy as np
+import torch
+
+import onmt.opts as opts
+from onmt.bin.train import train, _get_parser as _get_train_parser
+from onmt.inputters.dataset_base import length_array
+from onmt.inputters.inputter import build_dataset_iter, _load_dataset
+from onmt.inputters.numeric_dataset import SHARD_SUFFIX, encode, save_shard
+from onmt.inputters.text_dataset import text_sort_key
+from onmt.model_builder import build_base_model
+from onmt.models import load_checkpoint
+from onmt.translate.greedy_search import greedy_exact_match
+from onmt.utils.logging import init_logger, logger
+from onmt.utils.parse import ArgumentParser
+
+_SHARD = re.compile(r"\.\w+\.\d+\.(pt|bin)$")
+
+
+def numericalize(dataset):
+    """The arrays and metadata of a numericalized shard holding the
+    examples of a ``.pt`` dataset.
+
+    Returns:
+        (dict[str, numpy.ndarray], dict) or NoneType: ``None`` for
+        datasets numericalized shards do not support: other than text,
+        without targets, with word features or copy vocabularies.
+    """
+
+    examples = dataset.examples
+    if not examples or dataset.sort_key is not text_sort_key \
+            or getattr(dataset, "dynamic_dict", None) is not None:
+        return None
+    first = examples[0]
+    if not hasattr(first, "tgt") or hasattr(first, "src_map") \
+            or len(first.src) != 1 or len(first.tgt) != 1:
+        return None
+    symbols = {}
+    src, src_offsets = encode((ex.src[0] for ex in examples), symbols)
+    tgt, tgt_offsets = encode((ex.tgt[0] for ex in examples), symbols)
+    arrays = {"src": src, "src_offsets": src_offsets,
+              "tgt": tgt, "tgt_offsets": tgt_offsets,
+              "src_len": length_array(np.diff(src_offsets)),
+              "tgt_len": length_array(np.diff(tgt_offsets)),
+              "indices": np.array([ex.indices for ex in examples],
+                                  dtype=np.int64)}
+    meta = {"symbols": sorted(symbols, key=symbols.get),
+            "corpus_id": getattr(first, "corpus_id", "train")}
+    return arrays, meta
+
+
+def share_corpus(data, shm_dir):
+    """Stage the shards and vocab of the corpus ``data`` in ``shm_dir``.
+
+    ``.pt`` shards are numericalized, so that every run memory-maps the
+    same pages instead of unpickling its own copy of the examples. Shards
+    that cannot be, and every other file of the corpus, are copied.
+
+    Returns:
+        str: the ``-data`` prefix of the staged corpus.
+    """
+
+    os.makedirs(shm_dir)
+    prefix = os.path.join(shm_dir, os.path.basename(data))
+    for path in sorted(glob.glob(glob.escape(data) + ".*")):
+        target = prefix + path[len(data):]
+        if path.endswith(".pt") and _SHARD.search(path):
+            shard = numericalize(_load_dataset(path))
+            if shard is not None:
+                target = target[:-len(".pt")] + SHARD_SUFFIX
+                logger.info("Staging %s as %s" % (path, target))
+                save_shard(target, *shard)
+                continue
+            logger.warning("%s cannot be numericalized, each run will "
+                           "load its own copy." % path)
+        shutil.copyfile(path, target)
+    return prefix
+
+
+def parse_grid(grid, train_parser):
+    """Read the ``-grid`` items.
+
+    Returns:
+        List[(str, List[(str, List[str])])]: for each swept option, its
+        name and its values, each with the arguments setting it.
+    """
+
+    actions = {s: a for a in train_parser._actions for s in a.option_strings}
+    axes = []
+    for item in grid:
+        name, sep, values = item.partition("=")
+        name = name.lstrip("-")
+        action = actions.get("-" + name)
+        if not sep or action is None:
+            raise ValueError("Invalid -grid item %r: expected OPTION=V1,V2,"
+                             " with a training OPTION." % item)
+        choices = []
+        for value in values.split(","):
+            if action.nargs == 0:
+                if value not in ("true", "false"):
+                    raise ValueError("Flag %s takes true or false, not %r."
+                                     % (name, value))
+                choices.append((value, ["-" + name] * (value == "true")))
+            else:
+                choices.append((value, ["-" + name] + value.split()))
+        axes.append((name, choices))
+    return axes
+
+
+def _slug(value):
+    value = os.path.basename(value.rstrip("/")) or value
+    return re.sub(r"[^\w.+-]+", "-", value)
+
+
+def build_runs(opt, train_args, axes):
+    """Every combination of the values of ``axes`` with every seed.
+
+    Returns:
+        List[dict]: runs, with their ``name``, ``seed``, ``setting`` (the
+        value of each axis) and training ``argv``.
+    """
+
+    runs = []
+    for values in itertools.product(*[choices for _, choices in axes]):
+        setting = [value for value, _ in values]
+        for seed in opt.seeds:
+            name = "_".join(["%s-%s" % (axis, _slug(value)) for (axis, _),
+                             value in zip(axes, setting)] + ["s%d" % seed])
+            run_dir = os.path.join(opt.sweep_dir, name)
+            argv = list(train_args)
+            for _, args in values:
+                argv += args
+            argv += ["-seed", str(seed), "-world_size", "1",
+                     "-save_model", os.path.join(run_dir, "model"),
+                     "-log_file", os.path.join(run_dir, "train.log"),
+                     "-gpu_ranks"] + ["0"] * bool(opt.gpus)
+            runs.append({"name": name, "seed": seed, "setting": setting,
+                         "argv": argv})
+    return runs
+
+
+def final_checkpoint(save_model):
+    """The checkpoint to evaluate: the best one when early stopping kept
+    track of it, otherwise the last one.
+
+    Returns:
+        (str, str): its path and a label naming its step.
+    """
+
+    steps = {}
+    for path in glob.glob(glob.escape(save_model) + "_step_*.pt"):
+        match = re.search(r"_step_(\d+)\.pt$", path)
+        if match:
+            steps[int(match.group(1))] = path
+    best = save_model + "_best.pt"
+    if os.path.exists(best):
+        for step, path in steps.items():
+            if os.path.samefile(path, best):
+                return best, "best (step %d)" % step
+        return best, "best"
+    if not steps:
+        raise RuntimeError("No checkpoint found for %s" % save_model)
+    step = max(steps)
+    return steps[step], "step %d" % step
+
+
+def exact_match(model, data_iter, tgt_pad):
+    """Number of exact matches of greedy decoding and of examples."""
+    n_exact = n_sents = 0
+    with torch.no_grad():
+        for batch in data_iter:
+            src, src_lengths = batch.src if isinstance(batch.src, tuple) \
+                else (batch.src, None)
+            enc_state, memory_bank, lengths = model.encoder(src, src_lengths)
+            match = greedy_exact_match(model, src, enc_state, memory_bank,
+                                       lengths, batch.tgt, tgt_pad)
+            n_exact += match.sum().item()
+            n_sents += match.numel()
+    return n_exact, n_sents
+
+
+def evaluate(opt, eval_sets):
+    """Exact match of the final model of a run on ``eval_sets``."""
+    path, label = final_checkpoint(opt.save_model)
+    logger.info("Evaluating %s" % path)
+    checkpoint = load_checkpoint(path)
+    model_opt = ArgumentParser.ckpt_model_opts(checkpoint["opt"])
+    ArgumentParser.update_model_opts(model_opt)
+    ArgumentParser.validate_model_opts(model_opt)
+    fields = checkpoint["vocab"]
+    gpu = len(opt.gpu_ranks) > 0
+    model = build_base_model(model_opt, fields, gpu, checkpoint,
+                             0 if gpu else None)
+    model.eval()
+    tgt_field = fields["tgt"].base_field
+    tgt_pad = tgt_field.vocab.stoi[tgt_field.pad_token]
+    scores = {}
+    for name in eval_sets:
+        data_iter = build_dataset_iter(name, fields, opt, is_train=False)
+        if data_iter is None:
+            logger.warning("No %s corpus for %s" % (name, opt.data))
+            continue
+        scores[name] = exact_match(model, data_iter, tgt_pad)
+        logger.info("%s exact match: %.2f%% (%d/%d)"
+                    % ((name, 100 * scores[name][0] / scores[name][1])
+                       + scores[name]))
+    return label, scores
+
+
+def train_run(job):
+    """Train and evaluate a run, in a worker process of the sweep.
+
+    Its logs go to its ``-log_file`` only. Failures are logged there and
+    reported in the result rather than raised, to let the sweep go on.
+    """
+
+    run, eval_sets, threads, devices = job
+    device = devices.get() if devices is not None else None
+    sys.stdout = sys.stderr = open(os.devnull, "w")
+    result = {"name": run["name"], "checkpoint": None, "scores": {},
+              "minutes": None, "error": None}
+    try:
+        if device is not None:
+            os.environ["CUDA_VISIBLE_DEVICES"] = str(device)
+        torch.set_num_threads(threads)
+        opt = _get_train_parser().parse_args(run["argv"])
+        os.makedirs(os.path.dirname(opt.save_model), exist_ok=True)
+        init_logger(opt.log_file)
+        start = time.time()
+        train(opt)
+        result["minutes"] = (time.time() - start) / 60
+        result["checkpoint"], result["scores"] = evaluate(opt, eval_sets)
+    except Exception:
+        logger.error(traceback.format_exc())
+        result["error"] = traceback.format_exc().strip().split("\n")[-1]
+    finally:
+        if device is not None:
+            devices.put(device)
+    return result
+
+
+def _available_cores():
+    if hasattr(os, "sched_getaffinity"):
+        return len(os.sched_getaffinity(0))
+    return os.cpu_count() or 1
+
+
+def _format_table(rows):
+    widths = [max(len(row[i]) for row in rows) for i in range(len(rows[0]))]
+    return "\n".join("  ".join(cell.ljust(w) for cell, w in zip(row, widths))
+                     .rstrip() for row in rows)
+
+
+def _write_table(path, rows):
+    with open(path, "w") as f:
+        f.write("".join("\t".join(row) + "\n" for row in rows))
+
+
+def tabulate(opt, axes, runs, results):
+    """Write the results of every run, and their mean and standard
+    deviation over seeds for each setting, to ``runs.tsv`` and
+    ``summary.tsv`` in the sweep directory, and log them."""
+    names = [name for name, _ in axes]
+    header = ["run", "seed"] + names + ["checkpoint", "minutes"] \
+        + [name + " EM" for name in opt.eval_sets]
+    rows = [header]
+    settings = {}
+    for run in runs:
+        result = results[run["name"]]
+        row = [run["name"], str(run["seed"])] + run["setting"]
+        if result["error"] is not None:
+            rows.append(row + ["failed: " + result["error"], "-"]
+                        + ["-"] * len(opt.eval_sets))
+            continue
+        row += [result["checkpoint"], "%.1f" % result["minutes"]]
+        scores = settings.setdefault(tuple(run["setting"]), [])
+        em = {}
+        for name in opt.eval_sets:
+            if name in result["scores"]:
+                n_exact, n_sents = result["scores"][name]
+                em[name] = 100 * n_exact / n_sents
+                row.append("%.2f" % em[name])
+            else:
+                row.append("-")
+        scores.append(em)
+        rows.append(row)
+
+    summary = [names + ["runs"] + [name + " EM" for name in opt.eval_sets]]
+    for setting, scores in settings.items():
+        row = list(setting) + [str(len(scores))]
+        for name in opt.eval_sets:
+            values = [em[name] for em in scores if name in em]
+            if values:
+                std = np.std(values, ddof=1) if len(values) > 1 else 0.
+                row.append("%.2f ± %.2f" % (np.mean(values), std))
+            else:
+                row.append("-")
+        summary.append(row)
+
+    _write_table(os.path.join(opt.sweep_dir, "runs.tsv"), rows)
+    _write_table(os.path.join(opt.sweep_dir, "summary.tsv"), summary)
+    logger.info("Runs:\n" + _format_table(rows))
+    logger.info("Summary over seeds:\n" + _format_table(summary))
+
+
+def sweep(opt, train_args):
+    os.makedirs(opt.sweep_dir, exist_ok=True)
+    init_logger(os.path.join(opt.sweep_dir, "sweep.log"))
+    train_parser = _get_train_parser()
+    axes = parse_grid(opt.grid, train_parser)
+    runs = build_runs(opt, train_args, axes)
+    # fail early on invalid options
+    corpora = [train_parser.parse_args(run["argv"]).data for run in runs]
+
+    cores = _available_cores()
+    workers = opt.workers or len(opt.gpus) or cores
+    threads = max(1, cores // workers)
+    logger.info("Sweeping %d runs on %d workers with %d threads each."
+                % (len(runs), workers, threads))
+
+    shm_dir = opt.shm_dir if os.path.isdir(opt.shm_dir) else None
+    staging = tempfile.mkdtemp(prefix="onmt_sweep_", dir=shm_dir)
+    results = {}
+    try:
+        staged = {}
+        for data in corpora:
+            if data not in staged:
+                staged[data] = share_corpus(
+                    data, os.path.join(staging, str(len(staged))))
+        mp = torch.multiprocessing.get_context("spawn")
+        devices = None
+        if opt.gpus:
+            devices = mp.Manager().Queue()
+            for gpu in opt.gpus:
+                devices.put(gpu)
+        jobs = []
+        for run, data in zip(runs, corpora):
+            run["argv"] += ["-data", staged[data], "-shard_format", "auto"]
+            jobs.append((run, opt.eval_sets, threads, devices))
+        # a fresh process per run, as runs set up global state
+        with mp.Pool(workers, maxtasksperchild=1) as pool:
+            for result in pool.imap_unordered(train_run, jobs):
+                results[result["name"]] = result
+                if result["error"] is not None:
+                    logger.error("Run %s failed: %s"
+                                 % (result["name"], result["error"]))
+                else:
+                    logger.info("Run %s done in %.1f min: %s" % (
+                        result["name"], result["minutes"],
+                        ", ".join("%s %.2f%%" % (k, 100 * v[0] / v[1])
+                                  for k, v in result["scores"].items())))
+    finally:
+        shutil.rmtree(staging)
+    tabulate(opt, axes, runs, results)
+
+
+def _get_parser():
+    # training options are passed through: none may be abbreviated, nor
+    # read as -h, like -heads
+    parser = ArgumentParser(description='sweep.py', allow_abbrev=False,
+                            add_help=False)
+    parser.add('--help', action='help', help='show this help message')
+
+    opts.config_opts(parser)
+    opts.sweep_opts(parser)
+    return parser
+
+
+def main():
+    parser = _get_parser()
+
+    opt, train_args = parser.parse_known_args()
+    sweep(opt, train_args)
+
+
+if __name__ == "__main__":
+    main()
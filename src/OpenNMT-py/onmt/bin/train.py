@@ -8,13 +8,9 @@ import onmt.opts as opts
 import onmt.utils.distributed
 
 from onmt.utils.misc import set_random_seed
-from onmt.utils.logging import init_logger, logger
+from onmt.utils.logging import logger
 from onmt.train_single import main as single_main
 from onmt.utils.parse import ArgumentParser
-from onmt.inputters.inputter import build_dataset_iter, patch_fields, \
-    load_old_vocab, old_style_vocab, build_dataset_iter_multiple
-
-from itertools import cycle
 
 
 def train(opt):
@@ -24,68 +20,30 @@ def train(opt):
 
     set_random_seed(opt.seed, False)
 
-    # Load checkpoint if we resume from a previous training.
-    if opt.train_from:
-        logger.info('Loading checkpoint from %s' % opt.train_from)
-        checkpoint = torch.load(opt.train_from,
-                                map_location=lambda storage, loc: storage)
-        logger.info('Loading vocab from checkpoint at %s.' % opt.train_from)
-        vocab = checkpoint['vocab']
-    else:
-        vocab = torch.load(opt.data + '.vocab.pt')
-
-    # check for code where vocab is saved instead of fields
-    # (in the future this will be done in a smarter way)
-    if old_style_vocab(vocab):
-        fields = load_old_vocab(
-            vocab, opt.model_type, dynamic_dict=opt.copy_attn)
-    else:
-        fields = vocab
-
-    # patch for fields that may be missing in old data/model
-    patch_fields(opt, fields)
-
-    if len(opt.data_ids) > 1:
-        train_shards = []
-        for train_id in opt.data_ids:
-            shard_base = "train_" + train_id
-            train_shards.append(shard_base)
-        train_iter = build_dataset_iter_multiple(train_shards, fields, opt)
-    else:
-        if opt.data_ids[0] is not None:
-            shard_base = "train_" + opt.data_ids[0]
-        else:
-            shard_base = "train"
-        train_iter = build_dataset_iter(shard_base, fields, opt)
-
     nb_gpu = len(opt.gpu_ranks)
 
     if opt.world_size > 1:
-        queues = []
+        # each process reads its own share of the training batches
+        if nb_gpu > 0:
+            processes = list(enumerate(opt.gpu_ranks))
+        else:
+            # CPU processes, all on this node
+            processes = [(-1, rank) for rank in range(opt.world_size)]
         mp = torch.multiprocessing.get_context('spawn')
-        semaphore = mp.Semaphore(opt.world_size * opt.queue_size)
         # Create a thread to listen for errors in the child processes.
         error_queue = mp.SimpleQueue()
         error_handler = ErrorHandler(error_queue)
         # Train with multiprocessing.
         procs = []
-        for device_id in range(nb_gpu):
-            q = mp.Queue(opt.queue_size)
-            queues += [q]
+        for device_id, rank in processes:
+            # not daemonic, to collate batches in -num_workers processes
             procs.append(mp.Process(target=run, args=(
-                opt, device_id, error_queue, q, semaphore), daemon=True))
-            procs[device_id].start()
-            logger.info(" Starting process pid: %d  " % procs[device_id].pid)
-            error_handler.add_child(procs[device_id].pid)
-        producer = mp.Process(target=batch_producer,
-                              args=(train_iter, queues, semaphore, opt,),
-                              daemon=True)
-        producer.start()
-        error_handler.add_child(producer.pid)
-
+                opt, device_id, rank, error_queue), daemon=False))
+            procs[-1].start()
+            logger.info(" Starting process pid: %d  " % procs[-1].pid)
+            error_handler.add_child(procs[-1].pid)
         for p in procs:
             p.join()
-        producer.terminate()
 
     elif nb_gpu == 1:  # case 1 GPU only
         single_main(opt, 0)
@@ -93,68 +51,20 @@ def train(opt):
         single_main(opt, -1)
 
 
-def batch_producer(generator_to_serve, queues, semaphore, opt):
-    init_logger(opt.log_file)
-    set_random_seed(opt.seed, False)
-    # generator_to_serve = iter(generator_to_serve)
-
-    def pred(x):
-        """
-        Filters batches that belong only
-        to gpu_ranks of current node
-        """
-        for rank in opt.gpu_ranks:
-            if x[0] % opt.world_size == rank:
-                return True
-
-    generator_to_serve = filter(
-        pred, enumerate(generator_to_serve))
-
-    def next_batch(device_id):
-        new_batch = next(generator_to_serve)
-        semaphore.acquire()
-        return new_batch[1]
-
-    b = next_batch(0)
-
-    for device_id, q in cycle(enumerate(queues)):
-        b.dataset = None
-        if isinstance(b.src, tuple):
-            b.src = tuple([_.to(torch.device(device_id))
-                           for _ in b.src])
-        else:
-            b.src = b.src.to(torch.device(device_id))
-        b.tgt = b.tgt.to(torch.device(device_id))
-        b.indices = b.indices.to(torch.device(device_id))
-        b.alignment = b.alignment.to(torch.device(device_id)) \
-            if hasattr(b, 'alignment') else None
-        b.src_map = b.src_map.to(torch.device(device_id)) \
-            if hasattr(b, 'src_map') else None
-        b.align = b.align.to(torch.device(device_id)) \
-            if hasattr(b, 'align') else None
-        b.corpus_id = b.corpus_id.to(torch.device(device_id)) \
-            if hasattr(b, 'corpus_id') else None
-
-        # hack to dodge unpicklable `dict_keys`
-        b.fields = list(b.fields)
-        q.put(b)
-        b = next_batch(device_id)
-
-
-def run(opt, device_id, error_queue, batch_queue, semaphore):
+def run(opt, device_id, rank, error_queue):
     """ run process """
     try:
-        gpu_rank = onmt.utils.distributed.multi_init(opt, device_id)
-        if gpu_rank != opt.gpu_ranks[device_id]:
+        gpu_rank = onmt.utils.distributed.multi_init(opt, device_id, rank)
+        if gpu_rank != rank:
             raise AssertionError("An error occurred in \
                   Distributed initialization")
-        single_main(opt, device_id, batch_queue, semaphore)
+        single_main(opt, device_id)
     except KeyboardInterrupt:
         pass  # killed by parent, do nothing
     except Exception:
         # propagate exception to parent process, keeping original traceback
         import traceback
-        error_queue.put((opt.gpu_ranks[device_id], traceback.format_exc()))
+        error_queue.put((rank, traceback.format_exc()))
 
 
 class ErrorHandler(object):
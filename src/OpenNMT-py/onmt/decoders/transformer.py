@@ -8,7 +8,8 @@ import torch.nn as nn
 from onmt.decoders.decoder import DecoderBase
 from onmt.modules import MultiHeadedAttention, AverageAttention
 from onmt.modules.position_ffn import PositionwiseFeedForward
-from onmt.utils.misc import sequence_mask
+from onmt.utils.misc import sequence_mask, segment_mask, \
+    segment_positions
 
 
 class TransformerDecoderLayer(nn.Module):
@@ -287,13 +288,20 @@ class TransformerDecoder(DecoderBase):
         self.state["src"] = self.state["src"].detach()
 
     def forward(self, tgt, memory_bank, step=None, **kwargs):
-        """Decode, possibly stepwise."""
+        """Decode, possibly stepwise.
+
+        Packed rows (see :mod:`onmt.inputters.packing`) pass the example
+        ids of their tokens as ``src_segments`` and ``tgt_segments``.
+        """
         if step == 0:
             self._init_cache(memory_bank)
 
         tgt_words = tgt[:, :, 0].transpose(0, 1)
+        tgt_segments = kwargs.get("tgt_segments")
 
-        emb = self.embeddings(tgt, step=step)
+        emb = self.embeddings(tgt, step=step, positions=None
+                              if tgt_segments is None
+                              else segment_positions(tgt_segments))
         assert emb.dim() == 3  # len x batch x embedding_dim
 
         output = emb.transpose(0, 1).contiguous()
@@ -303,7 +311,11 @@ class TransformerDecoder(DecoderBase):
         src_lens = kwargs["memory_lengths"]
         src_max_len = self.state["src"].shape[0]
         src_pad_mask = ~sequence_mask(src_lens, src_max_len).unsqueeze(1)
-        tgt_pad_mask = tgt_words.data.eq(pad_idx).unsqueeze(1)  # [B, 1, T_tgt]
+        tgt_pad_mask = tgt_words.eq(pad_idx).unsqueeze(1)  # [B, 1, T_tgt]
+        if tgt_segments is not None:
+            # attend within the example only: [B, T_tgt, T_src/T_tgt]
+            src_pad_mask = segment_mask(tgt_segments, kwargs["src_segments"])
+            tgt_pad_mask = segment_mask(tgt_segments, tgt_segments)
 
         with_align = kwargs.pop('with_align', False)
         attn_aligns = []
@@ -7,7 +7,8 @@ import torch.nn as nn
 from onmt.encoders.encoder import EncoderBase
 from onmt.modules import MultiHeadedAttention
 from onmt.modules.position_ffn import PositionwiseFeedForward
-from onmt.utils.misc import sequence_mask
+from onmt.utils.misc import sequence_mask, segment_mask, \
+    segment_positions
 
 
 class TransformerEncoderLayer(nn.Module):
@@ -114,14 +115,21 @@ class TransformerEncoder(EncoderBase):
             embeddings,
             opt.max_relative_positions)
 
-    def forward(self, src, lengths=None):
-        """See :func:`EncoderBase.forward()`"""
+    def forward(self, src, lengths=None, segments=None):
+        """See :func:`EncoderBase.forward()`. ``segments`` are the
+        example ids of the tokens of packed rows, see
+        :mod:`onmt.inputters.packing`."""
         self._check_args(src, lengths)
 
-        emb = self.embeddings(src)
+        if segments is None:
+            emb = self.embeddings(src)
+            mask = ~sequence_mask(lengths, src.size(0)).unsqueeze(1)
+        else:
+            emb = self.embeddings(
+                src, positions=segment_positions(segments))
+            mask = segment_mask(segments, segments)
 
         out = emb.transpose(0, 1).contiguous()
-        mask = ~sequence_mask(lengths).unsqueeze(1)
         # Run the forward pass of every layer of the tranformer.
         for layer in self.transformer:
             out = layer(out, mask)
@@ -12,6 +12,7 @@ from onmt.inputters.image_dataset import img_sort_key, ImageDataReader
 from onmt.inputters.audio_dataset import audio_sort_key, AudioDataReader
 from onmt.inputters.vec_dataset import vec_sort_key, VecDataReader
 from onmt.inputters.datareader_base import DataReaderBase
+from onmt.inputters.numeric_dataset import NumericDataset
 
 str2reader = {
     "text": TextDataReader, "img": ImageDataReader, "audio": AudioDataReader,
@@ -26,4 +27,4 @@ __all__ = ['Dataset', 'load_old_vocab', 'get_fields', 'DataReaderBase',
            'build_vocab', 'OrderedIterator',
            'text_sort_key', 'img_sort_key', 'audio_sort_key', 'vec_sort_key',
            'TextDataReader', 'ImageDataReader', 'AudioDataReader',
-           'VecDataReader']
+           'VecDataReader', 'NumericDataset']
@@ -1,12 +1,16 @@
 # coding: utf-8
 
+import sys
+from array import array
 from itertools import chain, starmap
-from collections import Counter
 
+import numpy as np
 import torch
+from torchtext.data import Batch as TorchtextBatch
 from torchtext.data import Dataset as TorchtextDataset
 from torchtext.data import Example
-from torchtext.vocab import Vocab
+
+from onmt.inputters.text_dataset import TextMultiField
 
 
 def _join_dicts(*args):
@@ -21,43 +25,368 @@ def _join_dicts(*args):
     return dict(chain(*[d.items() for d in args]))
 
 
-def _dynamic_dict(example, src_field, tgt_field):
-    """Create copy-vocab and numericalize with it.
+def length_array(lengths):
+    """Store sequence lengths as int16, or int32 if some do not fit."""
+    lengths = np.asarray(lengths, dtype=np.int64)
+    fits = not len(lengths) or lengths.max() <= np.iinfo(np.int16).max
+    return lengths.astype(np.int16 if fits else np.int32)
+
+
+def _segments(offsets):
+    """Row id of every element of a flat array cut at ``offsets``."""
+    lengths = np.diff(offsets)
+    return np.repeat(np.arange(len(lengths)), lengths), lengths
+
+
+def _gather(flat, offsets, rows):
+    """Concatenate the segments ``rows`` of a flat array.
+
+    Returns:
+        (numpy.ndarray, numpy.ndarray, numpy.ndarray): the elements, the
+        position of each element in the batch and in its segment.
+    """
+    starts = offsets[rows]
+    lengths = offsets[rows + 1] - starts
+    ends = np.cumsum(lengths)
+    pos = np.arange(ends[-1] if len(ends) else 0) - \
+        np.repeat(ends - lengths, lengths)
+    return flat[np.repeat(starts, lengths) + pos], \
+        np.repeat(np.arange(len(rows)), lengths), pos
+
+
+def build_dynamic_dict(src, src_offsets, tgt, tgt_offsets, symbols,
+                       specials):
+    """Build the copy vocabularies of a whole shard at once.
 
-    In-place adds ``"src_map"`` to ``example``. That is the copy-vocab
-    numericalization of the tokenized ``example["src"]``. If ``example``
-    has a ``"tgt"`` key, adds ``"alignment"`` to example. That is the
-    copy-vocab numericalization of the tokenized ``example["tgt"]``. The
-    alignment has an initial and final UNK token to match the BOS and EOS
-    tokens.
+    The copy vocabulary of an example is what a torchtext ``Vocab`` built
+    on its source tokens would be: ``specials`` (unk, pad), then the
+    distinct source tokens, most frequent first and in alphabetical order
+    among equally frequent ones.
 
     Args:
-        example (dict): An example dictionary with a ``"src"`` key and
-            maybe a ``"tgt"`` key. (This argument changes in place!)
-        src_field (torchtext.data.Field): Field object.
-        tgt_field (torchtext.data.Field): Field object.
+        src (numpy.ndarray): flat source token ids, indexing ``symbols``.
+        src_offsets (numpy.ndarray): example ``i`` has source tokens
+            ``src[src_offsets[i]:src_offsets[i + 1]]``.
+        tgt (numpy.ndarray or NoneType): flat target token ids.
+        tgt_offsets (numpy.ndarray or NoneType): target offsets.
+        symbols (List[str]): the token strings.
+        specials (List[str]): the unk and pad tokens.
 
     Returns:
-        torchtext.data.Vocab and ``example``, changed as described.
+        dict[str, numpy.ndarray]: ``src_map``, the copy vocabulary index
+        of each source token; ``alignment``, the copy vocabulary index of
+        each target token or unk (only when ``tgt`` is given); and
+        ``vocab``/``vocab_offsets``, the symbol ids of the non-special
+        entries of each copy vocabulary.
+    """
+
+    n_sym = max(len(symbols), 1)
+    n_ex = len(src_offsets) - 1
+    rank = np.zeros(n_sym, dtype=np.int64)
+    rank[sorted(range(len(symbols)), key=symbols.__getitem__)] = \
+        np.arange(len(symbols))
+    special_ids = np.full(n_sym, -1, dtype=np.int64)
+    special_ids[:len(symbols)] = [
+        specials.index(sym) if sym in specials else -1 for sym in symbols]
+
+    seg, _ = _segments(src_offsets)
+    keys, inverse, counts = np.unique(
+        seg * n_sym + np.asarray(src, dtype=np.int64),
+        return_inverse=True, return_counts=True)
+    key_seg, key_sym = keys // n_sym, keys % n_sym
+    # torchtext drops specials from the counter, they keep their index
+    order = np.flatnonzero(special_ids[key_sym] < 0)
+    order = order[np.lexsort(
+        (rank[key_sym[order]], -counts[order], key_seg[order]))]
+    sizes = np.bincount(key_seg[order], minlength=n_ex)
+    vocab_offsets = np.concatenate([[0], np.cumsum(sizes)])
+    index = special_ids[key_sym]
+    index[order] = len(specials) + np.arange(len(order)) - \
+        vocab_offsets[key_seg[order]]
+
+    arrays = {"src_map": index[inverse].reshape(-1).astype(np.int32),
+              "vocab": key_sym[order].astype(np.int32),
+              "vocab_offsets": vocab_offsets.astype(np.int64)}
+    if tgt is not None:
+        tseg, _ = _segments(tgt_offsets)
+        tkeys = tseg * n_sym + np.asarray(tgt, dtype=np.int64)
+        # target tokens missing from the copy vocabulary are unk (0)
+        alignment = np.zeros(len(tkeys), dtype=np.int32)
+        if len(keys):
+            pos = np.searchsorted(keys, tkeys).clip(max=len(keys) - 1)
+            found = keys[pos] == tkeys
+            alignment[found] = index[pos[found]]
+        arrays["alignment"] = alignment
+    return arrays
+
+
+class DynamicDict(object):
+    """Copy vocabularies of the examples of a dataset, as flat arrays.
+
+    Args:
+        arrays (dict[str, numpy.ndarray]): ``indices`` (the example
+            indices, increasing), ``src_offsets`` and, optionally,
+            ``tgt_offsets`` together with the output of
+            :func:`build_dynamic_dict`.
+        symbols (List[str]): the strings of the symbol ids.
+        specials (List[str]): the unk and pad tokens.
+    """
+
+    def __init__(self, arrays, symbols, specials):
+        self.arrays = arrays
+        self.symbols = symbols
+        self.specials = specials
+        self._tgt_lookup = None
+
+    def __getstate__(self):
+        state = dict(self.__dict__)
+        state["_tgt_lookup"] = None
+        return state
+
+    def rows(self, indices):
+        """Positions of the examples with the given ``indices``."""
+        return np.searchsorted(self.arrays["indices"], indices)
+
+    def itos(self, row):
+        """The copy vocabulary of an example, as a list of tokens."""
+        vocab, offsets = self.arrays["vocab"], self.arrays["vocab_offsets"]
+        return self.specials + [
+            self.symbols[i] for i in vocab[offsets[row]:offsets[row + 1]]]
+
+    def tgt_map(self, rows, tgt_vocab):
+        """Target vocabulary id of every copy vocabulary entry.
+
+        The mapping is computed once for the whole dataset and cached.
+
+        Returns:
+            torch.LongTensor: ``(len(rows), max_copy_vocab_size)``, with
+            ``0`` for entries that are unknown to ``tgt_vocab``, for the
+            unk entry and for padding.
+        """
+
+        if self._tgt_lookup is None or self._tgt_lookup[0] is not tgt_vocab:
+            stoi = tgt_vocab.stoi
+            words = np.array([stoi.get(s, 0) for s in self.symbols],
+                             dtype=np.int64)
+            specials = np.array(
+                [0] + [stoi.get(s, 0) for s in self.specials[1:]],
+                dtype=np.int64)
+            flat = words[self.arrays["vocab"]]
+            self._tgt_lookup = (tgt_vocab, specials, flat)
+        _, specials, flat = self._tgt_lookup
+        rows = np.asarray(rows)
+        ids, col, pos = _gather(flat, self.arrays["vocab_offsets"], rows)
+        width = len(specials) + (int(pos.max()) + 1 if len(pos) else 0)
+        out = np.zeros((len(rows), width), dtype=np.int64)
+        out[:, :len(specials)] = specials
+        out[col, pos + len(specials)] = ids
+        return torch.from_numpy(out)
+
+    def fill(self, batch, indices, device=None):
+        """Set ``src_map``, ``alignment`` and ``src_ex_vocab`` on a batch.
+
+        Args:
+            batch (torchtext.data.Batch): the batch, changed in place.
+            indices (Sequence[int]): indices of its examples, in order.
+            device (torch.device or str or NoneType): output device.
+        """
+
+        rows = self.rows(indices)
+        ids, col, pos = _gather(
+            self.arrays["src_map"], self.arrays["src_offsets"], rows)
+        ids = torch.from_numpy(ids.astype(np.int64))
+        col, pos = torch.from_numpy(col), torch.from_numpy(pos)
+        src_map = torch.zeros(int(pos.max()) + 1, len(rows),
+                              int(ids.max()) + 1)
+        src_map[pos, col, ids] = 1
+        batch.src_map = src_map.to(device)
+        if "alignment" in self.arrays:
+            ids, col, pos = _gather(
+                self.arrays["alignment"], self.arrays["tgt_offsets"], rows)
+            # the first and last target steps are BOS and EOS: unk
+            lengths = np.diff(self.arrays["tgt_offsets"])[rows]
+            alignment = torch.zeros(int(lengths.max()) + 2, len(rows),
+                                    dtype=torch.long)
+            alignment[torch.from_numpy(pos + 1), torch.from_numpy(col)] = \
+                torch.from_numpy(ids.astype(np.int64))
+            batch.alignment = alignment.to(device)
+        batch.src_ex_vocab = CopyVocabs(self, rows)
+
+
+class CopyVocabs(object):
+    """The copy vocabularies of the examples of a batch.
+
+    Args:
+        dynamic_dict (DynamicDict): where the vocabularies are stored.
+        rows (numpy.ndarray): rows of the batch examples in
+            ``dynamic_dict``.
+    """
+
+    def __init__(self, dynamic_dict, rows):
+        self.dynamic_dict = dynamic_dict
+        self.rows = rows
+
+    @classmethod
+    def from_tokens(cls, words, specials):
+        """Build the copy vocabularies of a batch from their tokens.
+
+        Args:
+            words (List[List[str]]): the copy vocabulary of each example,
+                without ``specials``.
+            specials (List[str]): the unk and pad tokens.
+        """
+        symbols = {}
+        ids = np.array([symbols.setdefault(w, len(symbols))
+                        for w in chain.from_iterable(words)], dtype=np.int32)
+        offsets = np.cumsum([0] + [len(w) for w in words])
+        dynamic_dict = DynamicDict(
+            {"vocab": ids, "vocab_offsets": offsets},
+            sorted(symbols, key=symbols.get), specials)
+        return cls(dynamic_dict, np.arange(len(words)))
+
+    @classmethod
+    def from_vocabs(cls, vocabs):
+        """Wrap a list of per-example torchtext ``Vocab`` objects."""
+        return cls.from_tokens([v.itos[2:] for v in vocabs],
+                               vocabs[0].itos[:2] if vocabs else [])
+
+    def __reduce__(self):
+        # only send the vocabularies of the batch to other processes
+        n = len(self.dynamic_dict.specials)
+        return (CopyVocabs.from_tokens,
+                ([self.itos(b)[n:] for b in range(len(self))],
+                 self.dynamic_dict.specials))
+
+    def __len__(self):
+        return len(self.rows)
+
+    def itos(self, b):
+        """The copy vocabulary of the ``b``-th example, as tokens."""
+        return self.dynamic_dict.itos(self.rows[b])
+
+    def tgt_map(self, tgt_vocab):
+        """See :meth:`DynamicDict.tgt_map`."""
+        return self.dynamic_dict.tgt_map(self.rows, tgt_vocab)
+
+
+class SymbolTable(object):
+    """Map tokens to small integer ids, shared by the examples of a dataset.
+
+    Each distinct token string is stored once; examples only hold arrays
+    of ids into the table.
+    """
+
+    def __init__(self):
+        self.itos = []
+        self.stoi = {}
+
+    def encode(self, tokens):
+        stoi = self.stoi
+        ids = array("i")
+        for tok in tokens:
+            i = stoi.get(tok)
+            if i is None:
+                i = stoi[tok] = len(self.itos)
+                self.itos.append(tok)
+            ids.append(i)
+        return ids
+
+    def decode(self, ids):
+        itos = self.itos
+        return [itos[i] for i in ids]
+
+    def __len__(self):
+        return len(self.itos)
+
+    def __getstate__(self):
+        return self.itos
+
+    def __setstate__(self, itos):
+        self.itos = itos
+        self.stoi = {s: i for i, s in enumerate(itos)}
+
+
+class CompactExample(object):
+    """A slotted, array-backed replacement for text
+    :class:`torchtext.data.Example` objects.
+
+    Tokens of every feature of ``src`` and ``tgt`` are kept as
+    ``array("i")`` ids into a :class:`SymbolTable` shared by the whole
+    dataset, and copy-attention tensors as plain int arrays. The usual
+    attributes are rebuilt on access, so ``ex.src[0]`` is still the list
+    of source tokens and ``ex.src_map`` a ``LongTensor``. Sides the
+    example does not have raise :class:`AttributeError`, like a regular
+    example.
     """
 
-    src = src_field.tokenize(example["src"])
-    # make a small vocab containing just the tokens in the source sequence
-    unk = src_field.unk_token
-    pad = src_field.pad_token
-    src_ex_vocab = Vocab(Counter(src), specials=[unk, pad])
-    unk_idx = src_ex_vocab.stoi[unk]
-    # Map source tokens to indices in the dynamic dict.
-    src_map = torch.LongTensor([src_ex_vocab.stoi[w] for w in src])
-    example["src_map"] = src_map
-    example["src_ex_vocab"] = src_ex_vocab
-
-    if "tgt" in example:
-        tgt = tgt_field.tokenize(example["tgt"])
-        mask = torch.LongTensor(
-            [unk_idx] + [src_ex_vocab.stoi[w] for w in tgt] + [unk_idx])
-        example["alignment"] = mask
-    return src_ex_vocab, example
+    __slots__ = ("_symbols", "_src", "_tgt", "indices", "corpus_id",
+                 "align")
+
+    TEXT_KEYS = ("src", "tgt")
+    # copy attention data lives in the dataset's DynamicDict
+    COPY_KEYS = ("src_map", "src_ex_vocab", "alignment")
+    KEYS = TEXT_KEYS + COPY_KEYS + ("indices", "corpus_id", "align")
+
+    @classmethod
+    def fromdict(cls, data, fields, symbols):
+        """Build an example like :meth:`torchtext.data.Example.fromdict`.
+
+        Args:
+            data (dict): raw example, as yielded by the readers.
+            fields (dict[str, Field]): the fields of the dataset; only
+                keys in :attr:`KEYS` are supported.
+            symbols (SymbolTable): table the tokens are added to.
+        """
+
+        ex = cls()
+        ex._symbols = symbols
+        for key, field in fields.items():
+            if key not in data:
+                continue
+            val = field.preprocess(data[key])
+            if key in cls.TEXT_KEYS:
+                # a side without word features (the common case) is
+                # stored as a bare array rather than a 1-tuple of arrays
+                feats = [symbols.encode(feat) for feat in val]
+                setattr(ex, "_" + key,
+                        feats[0] if len(feats) == 1 else tuple(feats))
+            elif key == "corpus_id":
+                ex.corpus_id = sys.intern(val)
+            else:
+                setattr(ex, key, val)
+        return ex
+
+    def _decode(self, feats):
+        if isinstance(feats, array):
+            return [self._symbols.decode(feats)]
+        return [self._symbols.decode(feat) for feat in feats]
+
+    def rebase(self, symbols):
+        """Move the example to another symbol table."""
+        for side in self.TEXT_KEYS:
+            feats = getattr(self, "_" + side, None)
+            if feats is None:
+                continue
+            if isinstance(feats, array):
+                feats = symbols.encode(self._symbols.decode(feats))
+            else:
+                feats = tuple(symbols.encode(self._symbols.decode(f))
+                              for f in feats)
+            setattr(self, "_" + side, feats)
+        self._symbols = symbols
+
+    @property
+    def src(self):
+        return self._decode(self._src)
+
+    @property
+    def tgt(self):
+        return self._decode(self._tgt)
+
+    def ids(self, side):
+        """Symbol ids of the words (first feature) of ``side``."""
+        feats = getattr(self, "_" + side)
+        return feats if isinstance(feats, array) else feats[0]
 
 
 class Dataset(TorchtextDataset):
@@ -70,6 +399,8 @@ class Dataset(TorchtextDataset):
     the bit that numericalizes it or turns it into batch tensors) to the raw
     data, producing a list of :class:`torchtext.data.Example` objects.
     torchtext's iterators then know how to use these examples to make batches.
+    Text examples are stored as :class:`CompactExample` objects, which
+    share one :class:`SymbolTable` per dataset.
 
     Args:
         fields (dict[str, Field]): a dict with the structure
@@ -101,10 +432,15 @@ class Dataset(TorchtextDataset):
             indicating whether to include that example in the dataset.
 
     Attributes:
-        src_vocabs (List[torchtext.data.Vocab]): Used with dynamic dict/copy
+        dynamic_dict (DynamicDict or NoneType): Used with dynamic dict/copy
             attention. There is a very short vocab for each src example.
             It contains just the source words, e.g. so that the generator can
             predict to copy them.
+        symbols (SymbolTable or NoneType): Token table of the examples,
+            when they are :class:`CompactExample` objects.
+        lengths (dict[str, numpy.ndarray] or NoneType): Length index of
+            text datasets: the ``"src"`` and ``"tgt"`` (``None`` without
+            targets) lengths of the examples, in order.
     """
 
     def __init__(self, fields, readers, data, dirs, sort_key,
@@ -115,24 +451,28 @@ class Dataset(TorchtextDataset):
         read_iters = [r.read(dat[1], dat[0], dir_) for r, dat, dir_
                       in zip(readers, data, dirs)]
 
-        # self.src_vocabs is used in collapse_copy_scores and Translator.py
-        self.src_vocabs = []
+        self.symbols = SymbolTable() if self._compact(fields) else None
+        self.dynamic_dict = None
+        assert not can_copy or self.symbols is not None, \
+            "Copy attention needs text data."
+        self._specials = None
+        if can_copy:
+            src_field = fields['src'].base_field
+            self._specials = [src_field.unk_token, src_field.pad_token]
         examples = []
         for ex_dict in starmap(_join_dicts, zip(*read_iters)):
             if corpus_id is not None:
                 ex_dict["corpus_id"] = corpus_id
             else:
                 ex_dict["corpus_id"] = "train"
-            if can_copy:
-                src_field = fields['src']
-                tgt_field = fields['tgt']
-                # this assumes src_field and tgt_field are both text
-                src_ex_vocab, ex_dict = _dynamic_dict(
-                    ex_dict, src_field.base_field, tgt_field.base_field)
-                self.src_vocabs.append(src_ex_vocab)
             ex_fields = {k: [(k, v)] for k, v in fields.items() if
                          k in ex_dict}
-            ex = Example.fromdict(ex_dict, ex_fields)
+            if self.symbols is not None:
+                ex = CompactExample.fromdict(
+                    ex_dict, {k: fields[k] for k in ex_fields},
+                    self.symbols)
+            else:
+                ex = Example.fromdict(ex_dict, ex_fields)
             examples.append(ex)
 
         # fields needs to have only keys that examples have as attrs
@@ -142,6 +482,47 @@ class Dataset(TorchtextDataset):
             fields.append(nf_list[0])
 
         super(Dataset, self).__init__(examples, fields, filter_pred)
+        self.lengths = None
+        if self.symbols is not None:
+            self.build_length_index()
+        if can_copy:
+            self.build_dynamic_dict()
+
+    def build_length_index(self):
+        """(Re)build :attr:`lengths` from the current examples."""
+        has_tgt = bool(self.examples) and hasattr(self.examples[0], "tgt")
+        self.lengths = {
+            side: length_array([len(ex.ids(side)) for ex in self.examples])
+            if side == "src" or has_tgt else None
+            for side in ("src", "tgt")}
+
+    def build_dynamic_dict(self):
+        """(Re)build :attr:`dynamic_dict` from the current examples."""
+        def flat(side):
+            seqs = [np.frombuffer(ex.ids(side), dtype=np.int32)
+                    for ex in self.examples]
+            offsets = np.cumsum([0] + [len(s) for s in seqs])
+            return np.concatenate(seqs or [np.zeros(0, np.int32)]), offsets
+
+        src, src_offsets = flat("src")
+        has_tgt = bool(self.examples) and hasattr(self.examples[0], "tgt")
+        tgt, tgt_offsets = flat("tgt") if has_tgt else (None, None)
+        arrays = build_dynamic_dict(
+            src, src_offsets, tgt, tgt_offsets,
+            self.symbols.itos, self._specials)
+        arrays["indices"] = np.array(
+            [ex.indices for ex in self.examples], dtype=np.int64)
+        arrays["src_offsets"] = src_offsets
+        if has_tgt:
+            arrays["tgt_offsets"] = tgt_offsets
+        self.dynamic_dict = DynamicDict(
+            arrays, self.symbols.itos, self._specials)
+
+    @staticmethod
+    def _compact(fields):
+        return all(k in CompactExample.KEYS for k in fields) and \
+            isinstance(fields.get("src"), TextMultiField) and \
+            isinstance(fields.get("tgt", fields["src"]), TextMultiField)
 
     def __getattr__(self, attr):
         # avoid infinite recursion when fields isn't defined
@@ -166,3 +547,27 @@ class Dataset(TorchtextDataset):
                 data.append((name, field["data"]))
                 dirs.append(field["dir"])
         return readers, data, dirs
+
+
+class DynamicDictBatch(TorchtextBatch):
+    """A batch of a dataset that has a :class:`DynamicDict`.
+
+    Fields are processed as in :class:`torchtext.data.Batch`, except the
+    copy attention ones, which come from the dataset's dynamic dict.
+    """
+
+    def __init__(self, data, dataset, device=None):
+        super(DynamicDictBatch, self).__init__()
+        self.batch_size = len(data)
+        self.dataset = dataset
+        fields = dataset.fields
+        self.fields = fields.keys()
+        self.input_fields = [k for k, v in fields.items() if
+                             v is not None and not v.is_target]
+        self.target_fields = [k for k, v in fields.items() if
+                              v is not None and v.is_target]
+        for name, field in fields.items():
+            if field is not None and name not in CompactExample.COPY_KEYS:
+                batch = [getattr(x, name) for x in data]
+                setattr(self, name, field.process(batch, device=device))
+        dataset.dynamic_dict.fill(self, [ex.indices for ex in data], device)
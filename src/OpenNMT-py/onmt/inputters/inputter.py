@@ -1,22 +1,34 @@
 # -*- coding: utf-8 -*-
 import glob
+import json
 import os
 import codecs
 import math
+import random
 
-from collections import Counter, defaultdict
-from itertools import chain, cycle
+from collections import Counter, defaultdict, namedtuple
+from itertools import chain, cycle, islice
 
+import numpy as np
 import torch
 import torchtext.data
 from torchtext.data import Field, RawField, LabelField
 from torchtext.vocab import Vocab
 from torchtext.data.utils import RandomShuffler
 
-from onmt.inputters.text_dataset import text_fields, TextMultiField
+from onmt.inputters.text_dataset import text_fields, TextMultiField, \
+    text_sort_key
 from onmt.inputters.image_dataset import image_fields
 from onmt.inputters.audio_dataset import audio_fields
 from onmt.inputters.vec_dataset import vec_fields
+from onmt.inputters.dataset_base import CopyVocabs, DynamicDictBatch
+from onmt.inputters.numeric_dataset import NumericDataset, NumericBatch, \
+    SHARD_SUFFIX
+from onmt.inputters.prefetch import prefetch_batches
+from onmt.inputters.packing import PackedIterator
+from onmt.inputters.tensor_dataset import TensorDataset, TensorIterator
+from onmt.inputters.sampler import BucketBatchSampler, PaddingStats, \
+    bucket_batches, max_tok_len, padded_lengths, shard_batches
 from onmt.utils.logging import logger
 # backwards compatibility
 from onmt.inputters.text_dataset import _feature_tokenize  # noqa: F401
@@ -360,6 +372,61 @@ def _load_vocab(vocab_path, name, counters, min_freq):
     return vocab, vocab_size
 
 
+def length_histogram(lengths):
+    """Count the examples of each length.
+
+    Args:
+        lengths (dict[str, numpy.ndarray or NoneType]): a length index.
+
+    Returns:
+        dict[str, List[int] or NoneType]: ``counts[n]`` is the number of
+        examples of length ``n``, per side.
+    """
+    return {side: None if lens is None else
+            np.bincount(np.asarray(lens, dtype=np.int64)).tolist()
+            for side, lens in lengths.items()}
+
+
+def save_length_histogram(path, histograms):
+    """Sum per-shard length histograms and save them with a summary.
+
+    Args:
+        path (str): output JSON file.
+        histograms (Iterable[dict]): outputs of :func:`length_histogram`.
+
+    Returns:
+        dict: what was saved: for each side, the ``counts`` per length
+        and their ``mean``, ``max`` and ``percentiles``, plus the number
+        of ``examples``.
+    """
+
+    totals = {}
+    for histogram in histograms:
+        for side, counts in histogram.items():
+            if counts is None:
+                continue
+            total = totals.setdefault(side, np.zeros(0, dtype=np.int64))
+            if len(counts) > len(total):
+                total = np.pad(total, (0, len(counts) - len(total)))
+            total[:len(counts)] += counts
+            totals[side] = total
+    summary = {}
+    for side, counts in totals.items():
+        n = int(counts.sum())
+        summary["examples"] = n
+        cumulative = np.cumsum(counts)
+        summary[side] = {
+            "mean": float(np.dot(np.arange(len(counts)), counts) / max(n, 1)),
+            "max": int(np.flatnonzero(counts).max()) if n else 0,
+            "percentiles": {
+                str(q): int(np.searchsorted(cumulative, n * q / 100.))
+                for q in (50, 90, 95, 99)},
+            "counts": counts.tolist()}
+    with open(path, "w") as f:
+        json.dump(summary, f)
+    return summary
+
+
 def _build_fv_from_multifield(multifield, counters, build_fv_args,
                               size_multiple=1):
     for name, field in multifield:
@@ -578,6 +645,25 @@ def _read_vocab_file(vocab_path, tag):
             return [line.strip().split()[0] for line in f if line.strip()]
 
 
+def _load_dataset(path):
+    """Load a ``.pt`` dataset or memory-map a numericalized shard."""
+    if path.endswith(SHARD_SUFFIX):
+        return NumericDataset.load(path)
+    return torch.load(path)
+
+
+def _make_batch(data, dataset, device):
+    if isinstance(dataset, NumericDataset):
+        return NumericBatch(data, dataset, device)
+    if getattr(dataset, "dynamic_dict", None) is not None:
+        return DynamicDictBatch(data, dataset, device)
+    batch = torchtext.data.Batch(data, dataset, device)
+    if isinstance(getattr(batch, "src_ex_vocab", None), list):
+        # shards preprocessed with one torchtext Vocab per example
+        batch.src_ex_vocab = CopyVocabs.from_vocabs(batch.src_ex_vocab)
+    return batch
+
+
 def batch_iter(data, batch_size, batch_size_fn=None, batch_size_multiple=1):
     """Yield elements from data in chunks of batch_size, where each chunk size
     is a multiple of batch_size_multiple.
@@ -618,6 +704,7 @@ def batch_iter(data, batch_size, batch_size_fn=None, batch_size_multiple=1):
 
 def _pool(data, batch_size, batch_size_fn, batch_size_multiple,
           sort_key, random_shuffler, pool_factor):
+    """Sort pools of examples and chunk them, for data without lengths."""
     for p in torchtext.data.batch(
             data, batch_size * pool_factor,
             batch_size_fn=batch_size_fn):
@@ -630,7 +717,62 @@ def _pool(data, batch_size, batch_size_fn, batch_size_multiple,
             yield b
 
 
+class ExampleLengths(namedtuple("ExampleLengths", ["src", "tgt", "ex"])):
+    """Source and target lengths of an example, as seen by batching.
+
+    ``ex`` is the position of the example in its dataset, or the example
+    itself once it left its dataset. ``tgt`` is 0 without targets.
+    """
+
+    __slots__ = ()
+
+    @staticmethod
+    def sort_key(item):
+        return item.src, item.tgt
+
+
+def length_index(dataset):
+    """The length index of a text dataset, or ``None`` for other data.
+
+    Shards have one since they are preprocessed; it is computed from the
+    examples for older ones.
+    """
+    lengths = getattr(dataset, "lengths", None)
+    if lengths is None and dataset.sort_key is text_sort_key:
+        examples = dataset.examples
+        has_tgt = bool(examples) and hasattr(examples[0], "tgt")
+        lengths = {
+            "src": np.array([len(ex.src[0]) for ex in examples]),
+            "tgt": np.array([len(ex.tgt[0]) for ex in examples])
+            if has_tgt else None}
+        dataset.lengths = lengths
+    return lengths
+
+
 class OrderedIterator(torchtext.data.Iterator):
+    """Iterator over a dataset that batches examples of similar lengths.
+
+    For text datasets, batching works on the :class:`ExampleLengths` of
+    the examples, read from the dataset's length index, and
+    ``batch_size_fn`` receives those rather than examples. Training
+    batches are then drawn from a
+    :class:`onmt.inputters.sampler.BucketBatchSampler`, which logs the
+    padding efficiency of each epoch.
+
+    Args:
+        batch_type (str or NoneType): ``"sents"`` or ``"tokens"``,
+            guessed from ``batch_size_fn`` by default. Training batches
+            of other types are made by sorting pools of ``pool_factor``
+            batches.
+        seed (int or NoneType): seed of the sampler, drawn from
+            :mod:`random` by default.
+        num_workers (int): collate batches in this many background
+            processes, see :func:`onmt.inputters.prefetch.prefetch_batches`.
+        prefetch (int): batches each worker keeps ready.
+        rank (int), world_size (int): in training, only yield the share
+            of process ``rank`` of ``world_size`` of the batches, see
+            :func:`onmt.inputters.sampler.shard_batches`.
+    """
 
     def __init__(self,
                  dataset,
@@ -638,14 +780,58 @@ class OrderedIterator(torchtext.data.Iterator):
                  pool_factor=1,
                  batch_size_multiple=1,
                  yield_raw_example=False,
+                 batch_type=None,
+                 seed=None,
+                 num_workers=0,
+                 prefetch=2,
+                 rank=0,
+                 world_size=1,
                  **kwargs):
         super(OrderedIterator, self).__init__(dataset, batch_size, **kwargs)
         self.batch_size_multiple = batch_size_multiple
         self.yield_raw_example = yield_raw_example
         self.dataset = dataset
         self.pool_factor = pool_factor
+        self.num_workers = num_workers
+        self.prefetch = prefetch
+        self.rank = rank
+        self.world_size = world_size
+        self.lengths = length_index(dataset)
+        self.batch_sort_key = self.sort_key if self.lengths is None \
+            else ExampleLengths.sort_key
+        if batch_type is None:
+            batch_type = {None: "sents", max_tok_len: "tokens"}.get(
+                self.batch_size_fn)
+        self.sampler = None
+        self._sampler_epoch = 0
+        self._fast_forwarded = False
+        if self.lengths is not None and self.train and batch_type \
+                and not yield_raw_example:
+            self.sampler = BucketBatchSampler(
+                self.lengths, batch_size, batch_type, batch_size_multiple,
+                shuffle=self.shuffle,
+                seed=random.randrange(2 ** 31) if seed is None else seed)
+
+    def data(self):
+        """The examples of an epoch, in order, or their lengths."""
+        if self.lengths is None:
+            return super(OrderedIterator, self).data()
+        n = len(self.dataset)
+        if self.sort:
+            order = sorted(range(n), key=lambda i: (
+                self.lengths["src"][i], 0 if self.lengths["tgt"] is None
+                else self.lengths["tgt"][i]))
+        elif self.shuffle:
+            order = self.random_shuffler(range(n))
+        else:
+            order = range(n)
+        src = self.lengths["src"].tolist()
+        tgt = self.lengths["tgt"].tolist() \
+            if self.lengths["tgt"] is not None else [0] * n
+        return [ExampleLengths(src[i], tgt[i], i) for i in order]
 
     def create_batches(self):
+        self._fast_forwarded = False
         if self.train:
             if self.yield_raw_example:
                 self.batches = batch_iter(
@@ -653,15 +839,24 @@ class OrderedIterator(torchtext.data.Iterator):
                     1,
                     batch_size_fn=None,
                     batch_size_multiple=1)
+            elif self.sampler is not None:
+                self._sampler_epoch = self.sampler.epoch
+                batches = self._shard(iter(self.sampler))
+                if self._restored_from_state:
+                    # resume without building the skipped minibatches
+                    batches = islice(
+                        batches, self._iterations_this_epoch, None)
+                    self._fast_forwarded = True
+                self.batches = map(self._records, batches)
             else:
-                self.batches = _pool(
+                self.batches = self._shard(_pool(
                     self.data(),
                     self.batch_size,
                     self.batch_size_fn,
                     self.batch_size_multiple,
-                    self.sort_key,
+                    self.batch_sort_key,
                     self.random_shuffler,
-                    self.pool_factor)
+                    self.pool_factor))
         else:
             self.batches = []
             for b in batch_iter(
@@ -669,37 +864,92 @@ class OrderedIterator(torchtext.data.Iterator):
                     self.batch_size,
                     batch_size_fn=self.batch_size_fn,
                     batch_size_multiple=self.batch_size_multiple):
-                self.batches.append(sorted(b, key=self.sort_key))
+                self.batches.append(sorted(b, key=self.batch_sort_key))
+
+    def _shard(self, batches):
+        if self.world_size == 1:
+            return batches
+        return shard_batches(batches, self.rank, self.world_size)
+
+    def _records(self, positions):
+        src = self.lengths["src"][positions].tolist()
+        tgt = self.lengths["tgt"][positions].tolist() \
+            if self.lengths["tgt"] is not None else [0] * len(positions)
+        return [ExampleLengths(*r)
+                for r in zip(src, tgt, positions.tolist())]
+
+    def _examples(self, minibatch):
+        if self.lengths is None:
+            return minibatch
+        return [self.dataset[item.ex] for item in minibatch]
+
+    def state_dict(self):
+        """Where the iterator is, with the seed and epoch of its sampler."""
+        state = super(OrderedIterator, self).state_dict()
+        if self.sampler is not None:
+            state["sampler"] = {"seed": self.sampler.seed,
+                                "epoch": self._sampler_epoch}
+        return state
+
+    def load_state_dict(self, state_dict):
+        """Resume from :meth:`state_dict` on the next iteration."""
+        super(OrderedIterator, self).load_state_dict(state_dict)
+        if self.sampler is not None and "sampler" in state_dict:
+            self.sampler.seed = state_dict["sampler"]["seed"]
+            self.sampler.set_epoch(state_dict["sampler"]["epoch"])
+
+    def _sort_within_batch(self, minibatch):
+        if self.sort_within_batch:
+            # NOTE: `rnn.pack_padded_sequence` requires that a
+            # minibatch be sorted by decreasing order, which
+            #  requires reversing relative to typical sort keys
+            if self.sort:
+                minibatch.reverse()
+            else:
+                minibatch.sort(key=self.batch_sort_key, reverse=True)
+        return minibatch
+
+    def _raw_example(self, minibatch):
+        if self.lengths is None:
+            return minibatch[0]
+        return minibatch[0]._replace(ex=self.dataset[minibatch[0].ex])
+
+    def _collate(self, minibatch):
+        return _make_batch(self._examples(minibatch), self.dataset, "cpu")
 
     def __iter__(self):
         """
         Extended version of the definition in torchtext.data.Iterator.
         Added yield_raw_example behaviour to yield a torchtext.data.Example
-        instead of a torchtext.data.Batch object.
+        instead of a torchtext.data.Batch object, and collation of the
+        batches in ``num_workers`` background processes.
         """
         while True:
             self.init_epoch()
-            for idx, minibatch in enumerate(self.batches):
-                # fast-forward if loaded from state
-                if self._iterations_this_epoch > idx:
-                    continue
+            # fast-forward if loaded from state
+            start = 0 if self._fast_forwarded else self._iterations_this_epoch
+            minibatches = map(self._sort_within_batch, islice(
+                self.batches, start, None))
+            if self.yield_raw_example:
+                batches = map(self._raw_example, minibatches)
+            elif self.num_workers > 0:
+                batches = prefetch_batches(
+                    minibatches, self._collate, self.dataset, self.device,
+                    self.num_workers, self.prefetch)
+            else:
+                batches = (
+                    _make_batch(self._examples(minibatch),
+                                self.dataset,
+                                self.device)
+                    for minibatch in minibatches)
+            for batch in batches:
                 self.iterations += 1
                 self._iterations_this_epoch += 1
-                if self.sort_within_batch:
-                    # NOTE: `rnn.pack_padded_sequence` requires that a
-                    # minibatch be sorted by decreasing order, which
-                    #  requires reversing relative to typical sort keys
-                    if self.sort:
-                        minibatch.reverse()
-                    else:
-                        minibatch.sort(key=self.sort_key, reverse=True)
-                if self.yield_raw_example:
-                    yield minibatch[0]
-                else:
-                    yield torchtext.data.Batch(
-                        minibatch,
-                        self.dataset,
-                        self.device)
+                yield batch
+            if self.sampler is not None and self.sampler.stats is not None:
+                logger.info("Batched %d examples: %s."
+                            % (self.sampler.stats.examples,
+                               self.sampler.stats))
             if not self.repeat:
                 return
 
@@ -713,7 +963,9 @@ class MultipleDatasetIterator(object):
                  train_shards,
                  fields,
                  device,
-                 opt):
+                 opt,
+                 rank=0,
+                 world_size=1):
         self.index = -1
         self.iterables = []
         self.weights = []
@@ -727,13 +979,21 @@ class MultipleDatasetIterator(object):
         self.batch_size = opt.batch_size
         self.batch_size_fn = max_tok_len \
             if opt.batch_type == "tokens" else None
+        self.batch_type = opt.batch_type
         self.batch_size_multiple = 8 if opt.model_dtype == "fp16" else 1
         self.device = device
         # Temporarily load one shard to retrieve sort_key for data_type
-        temp_dataset = torch.load(self.iterables[0]._paths[0])
+        temp_dataset = _load_dataset(self.iterables[0]._paths[0])
         self.sort_key = temp_dataset.sort_key
+        # text shards yield the ExampleLengths of their examples
+        self.yields_lengths = self.sort_key is text_sort_key
+        if self.yields_lengths:
+            self.sort_key = ExampleLengths.sort_key
         self.random_shuffler = RandomShuffler()
+        self.rng = np.random.RandomState(random.randrange(2 ** 31))
         self.pool_factor = opt.pool_factor
+        self.rank = rank
+        self.world_size = world_size
         del temp_dataset
 
     def _iter_datasets(self):
@@ -749,20 +1009,47 @@ class MultipleDatasetIterator(object):
         for iterator in cycle(self._iter_datasets()):
             yield next(iterator)
 
+    def _bucket_pools(self):
+        """Pack pools of ``pool_factor`` batches with the bucket packer."""
+        for pool in torchtext.data.batch(
+                self._iter_examples(), self.batch_size * self.pool_factor,
+                batch_size_fn=self.batch_size_fn):
+            lengths = padded_lengths({
+                "src": np.array([item.src for item in pool]),
+                "tgt": np.array([item.tgt for item in pool])})
+            batches = bucket_batches(
+                lengths, self.batch_size, self.batch_type,
+                self.batch_size_multiple, self.rng)
+            stats = PaddingStats()
+            stats.update(batches, lengths)
+            logger.info("Batched a pool of %d examples: %s."
+                        % (len(pool), stats))
+            for positions in batches:
+                yield [pool[i] for i in positions]
+
     def __iter__(self):
         while True:
-            for minibatch in _pool(
+            if self.yields_lengths:
+                minibatches = self._bucket_pools()
+            else:
+                minibatches = _pool(
                     self._iter_examples(),
                     self.batch_size,
                     self.batch_size_fn,
                     self.batch_size_multiple,
                     self.sort_key,
                     self.random_shuffler,
-                    self.pool_factor):
+                    self.pool_factor)
+            if self.world_size > 1:
+                minibatches = shard_batches(
+                    minibatches, self.rank, self.world_size)
+            for minibatch in minibatches:
                 minibatch = sorted(minibatch, key=self.sort_key, reverse=True)
-                yield torchtext.data.Batch(minibatch,
-                                           self.iterables[0].dataset,
-                                           self.device)
+                if self.yields_lengths:
+                    minibatch = [item.ex for item in minibatch]
+                yield _make_batch(minibatch,
+                                  self.iterables[0].dataset,
+                                  self.device)
 
 
 class DatasetLazyIter(object):
@@ -776,11 +1063,15 @@ class DatasetLazyIter(object):
         batch_size_fn: custom batch process function.
         device: See :class:`OrderedIterator` ``device``.
         is_train (bool): train or valid?
+        num_workers (int): See :class:`OrderedIterator` ``num_workers``.
+        prefetch (int): See :class:`OrderedIterator` ``prefetch``.
+        rank (int), world_size (int): See :class:`OrderedIterator`.
     """
 
     def __init__(self, dataset_paths, fields, batch_size, batch_size_fn,
                  batch_size_multiple, device, is_train, pool_factor,
-                 repeat=True, num_batches_multiple=1, yield_raw_example=False):
+                 repeat=True, num_batches_multiple=1, yield_raw_example=False,
+                 num_workers=0, prefetch=2, rank=0, world_size=1):
         self._paths = dataset_paths
         self.fields = fields
         self.batch_size = batch_size
@@ -792,10 +1083,20 @@ class DatasetLazyIter(object):
         self.num_batches_multiple = num_batches_multiple
         self.yield_raw_example = yield_raw_example
         self.pool_factor = pool_factor
-
-    def _iter_dataset(self, path):
+        self.num_workers = num_workers
+        self.prefetch = prefetch
+        self.rank = rank
+        self.world_size = world_size
+        # shard pass `k` is batched with seed `seed + k`
+        self.seed = random.randrange(2 ** 31)
+        self._pass = -1
+        self._num_batches = 0
+        self._cur_iter = None
+        self._resume = None
+
+    def _iter_dataset(self, path, state=None):
         logger.info('Loading dataset from %s' % path)
-        cur_dataset = torch.load(path)
+        cur_dataset = _load_dataset(path)
         logger.info('number of examples: %d' % len(cur_dataset))
         cur_dataset.fields = self.fields
         cur_iter = OrderedIterator(
@@ -809,8 +1110,16 @@ class DatasetLazyIter(object):
             sort=False,
             sort_within_batch=True,
             repeat=False,
-            yield_raw_example=self.yield_raw_example
+            yield_raw_example=self.yield_raw_example,
+            num_workers=self.num_workers,
+            prefetch=self.prefetch,
+            seed=self.seed + self._pass,
+            rank=self.rank,
+            world_size=self.world_size
         )
+        if state is not None:
+            cur_iter.load_state_dict(state)
+        self._cur_iter = cur_iter
         for batch in cur_iter:
             self.dataset = cur_iter.dataset
             yield batch
@@ -822,61 +1131,112 @@ class DatasetLazyIter(object):
         # del cur_dataset
         # gc.collect()
 
+    def state_dict(self):
+        """The shard pass and batch the iterator is at.
+
+        Together with the seed the sampler of each pass derives from, it
+        lets :meth:`load_state_dict` resume exactly there, without going
+        through the shards and batches before it.
+        """
+        return {
+            "paths": list(self._paths),
+            "seed": self.seed,
+            "pass": self._pass,
+            "num_batches": self._num_batches,
+            "iterator": self._cur_iter.state_dict()
+            if self._cur_iter is not None else None}
+
+    def load_state_dict(self, state_dict):
+        """Resume from :meth:`state_dict` on the next iteration."""
+        if state_dict["paths"] != list(self._paths):
+            logger.warning("Data changed since the checkpoint, "
+                           "starting from its first shard.")
+            return
+        self.seed = state_dict["seed"]
+        self._resume = state_dict
+
     def __iter__(self):
-        num_batches = 0
+        resume, self._resume = self._resume, None
+        self._pass, self._num_batches = -1, 0
+        state = None
+        if resume is not None:
+            self._pass = resume["pass"] - 1
+            self._num_batches = resume["num_batches"]
+            state = resume["iterator"]
         paths = self._paths
+        # passes from this one on stop at a multiple of num_batches_multiple
+        first_round = float("inf")
         if self.is_train and self.repeat:
             # Cycle through the shards indefinitely.
             paths = cycle(paths)
-        for path in paths:
-            for batch in self._iter_dataset(path):
-                yield batch
-                num_batches += 1
-        if self.is_train and not self.repeat and \
-           num_batches % self.num_batches_multiple != 0:
+        elif self.is_train:
             # When the dataset is not repeated, we might need to ensure that
             # the number of returned batches is the multiple of a given value.
             # This is important for multi GPU training to ensure that all
             # workers have the same number of batches to process.
-            for path in paths:
-                for batch in self._iter_dataset(path):
-                    yield batch
-                    num_batches += 1
-                    if num_batches % self.num_batches_multiple == 0:
-                        return
-
-
-def max_tok_len(new, count, sofar):
-    """
-    In token batching scheme, the number of sequences is limited
-    such that the total number of src/tgt tokens (including padding)
-    in a batch <= batch_size
-    """
-    # Maintains the longest src and tgt length in the current batch
-    global max_src_in_batch, max_tgt_in_batch  # this is a hack
-    # Reset current longest length at a new batch (count=1)
-    if count == 1:
-        max_src_in_batch = 0
-        max_tgt_in_batch = 0
-    # Src: [<bos> w1 ... wN <eos>]
-    max_src_in_batch = max(max_src_in_batch, len(new.src[0]) + 2)
-    # Tgt: [w1 ... wM <eos>]
-    max_tgt_in_batch = max(max_tgt_in_batch, len(new.tgt[0]) + 1)
-    src_elements = count * max_src_in_batch
-    tgt_elements = count * max_tgt_in_batch
-    return max(src_elements, tgt_elements)
-
-
-def build_dataset_iter(corpus_type, fields, opt, is_train=True, multi=False):
+            paths = chain(paths, paths)
+            first_round = len(self._paths)
+        for path in islice(paths, self._pass + 1, None):
+            self._pass += 1
+            if self._pass >= first_round and \
+                    self._num_batches % self.num_batches_multiple == 0:
+                return
+            for batch in self._iter_dataset(path, state):
+                self._num_batches += 1
+                yield batch
+                if self._pass >= first_round and \
+                        self._num_batches % self.num_batches_multiple == 0:
+                    return
+            state = None
+
+
+def _build_tensor_iter(dataset_paths, fields, batch_size, batch_type,
+                       batch_size_multiple, device, is_train, repeat,
+                       rank=0, world_size=1):
+    """Load shards into a :class:`TensorDataset` and iterate over it."""
+    batches, lengths = [], []
+    for path in dataset_paths:
+        logger.info('Loading dataset from %s' % path)
+        dataset = _load_dataset(path)
+        dataset.fields = fields
+        index = length_index(dataset)
+        assert index is not None, "Only text data can be tensorized."
+        lengths.append(index)
+        batches.append(_make_batch(
+            [dataset[i] for i in range(len(dataset))], dataset, "cpu"))
+        del dataset
+    data = TensorDataset(batches, lengths, fields, device)
+    logger.info('Loaded %d examples as tensors on %s.'
+                % (len(data), data.device))
+    return TensorIterator(
+        data, batch_size, batch_type, batch_size_multiple,
+        train=is_train, repeat=is_train and repeat,
+        seed=random.randrange(2 ** 31), rank=rank, world_size=world_size)
+
+
+def build_dataset_iter(corpus_type, fields, opt, is_train=True, multi=False,
+                       rank=0, world_size=1):
     """
     This returns user-defined train/validate data iterator for the trainer
     to iterate over. We implement simple ordered iterator strategy here,
     but more sophisticated strategy like curriculum learning is ok too.
+
+    In distributed training, each process passes its ``rank`` and the
+    ``world_size`` to iterate over its own share of the batches.
     """
-    dataset_glob = opt.data + '.' + corpus_type + '.[0-9]*.pt'
-    dataset_paths = list(sorted(
-        glob.glob(dataset_glob),
-        key=lambda p: int(p.split(".")[-2])))
+    dataset_glob = opt.data + '.' + corpus_type + '.[0-9]*'
+    if opt.shard_format == 'auto':
+        # pickled shards take precedence, as they used to be the only ones
+        extensions = ['.pt', SHARD_SUFFIX]
+    else:
+        extensions = ['.' + opt.shard_format]
+    dataset_paths = []
+    for ext in extensions:
+        dataset_paths = list(sorted(
+            glob.glob(dataset_glob + ext),
+            key=lambda p: int(p.split(".")[-2])))
+        if dataset_paths:
+            break
 
     if not dataset_paths:
         if is_train:
@@ -895,20 +1255,39 @@ def build_dataset_iter(corpus_type, fields, opt, is_train=True, multi=False):
 
     device = "cuda" if opt.gpu_ranks else "cpu"
 
-    return DatasetLazyIter(
-        dataset_paths,
-        fields,
-        batch_size,
-        batch_fn,
-        batch_size_multiple,
-        device,
-        is_train,
-        opt.pool_factor,
-        repeat=not opt.single_pass,
-        num_batches_multiple=max(opt.accum_count) * opt.world_size,
-        yield_raw_example=multi)
-
-
-def build_dataset_iter_multiple(train_shards, fields, opt):
-    return MultipleDatasetIterator(
-        train_shards, fields, "cuda" if opt.gpu_ranks else "cpu", opt)
+    if opt.preload_tensors and not multi:
+        data_iter = _build_tensor_iter(
+            dataset_paths, fields, batch_size,
+            "tokens" if batch_fn is not None else "sents",
+            batch_size_multiple, device, is_train,
+            repeat=not opt.single_pass, rank=rank, world_size=world_size)
+    else:
+        data_iter = DatasetLazyIter(
+            dataset_paths,
+            fields,
+            batch_size,
+            batch_fn,
+            batch_size_multiple,
+            device,
+            is_train,
+            opt.pool_factor,
+            repeat=not opt.single_pass,
+            num_batches_multiple=max(opt.accum_count),
+            yield_raw_example=multi,
+            num_workers=opt.num_workers,
+            prefetch=opt.prefetch,
+            rank=rank,
+            world_size=world_size)
+    if is_train and not multi and opt.pack_length > 0:
+        data_iter = PackedIterator(data_iter, opt.pack_length, fields)
+    return data_iter
+
+
+def build_dataset_iter_multiple(train_shards, fields, opt,
+                                rank=0, world_size=1):
+    data_iter = MultipleDatasetIterator(
+        train_shards, fields, "cuda" if opt.gpu_ranks else "cpu", opt,
+        rank=rank, world_size=world_size)
+    if opt.pack_length > 0:
+        data_iter = PackedIterator(data_iter, opt.pack_length, fields)
+    return data_iter
@@ -0,0 +1,303 @@
+# -*- coding: utf-8 -*-
+"""Numericalized shards: token ids stored as flat arrays plus offsets.
+
+A shard is a single file made of a small JSON header followed by raw,
+aligned numpy arrays. Opening a shard only parses the header; the arrays
+themselves are memory-mapped, so loading is cheap and every process
+reading the same shard shares its pages.
+
+Token ids index the shard's own ``symbols`` table rather than a field
+vocabulary, which keeps shards independent of the vocab they are
+trained with. The mapping to vocabulary ids is computed when the
+dataset's fields are set, and applied per batch.
+"""
+import json
+import struct
+from array import array
+
+import numpy as np
+import torch
+from torchtext.data import Batch
+
+from onmt.inputters.dataset_base import DynamicDict, length_array
+from onmt.inputters.text_dataset import text_sort_key
+
+SHARD_SUFFIX = ".bin"
+
+_MAGIC = b"ONMTNUM1"
+_ALIGN = 64
+
+
+def _aligned(n):
+    return -(-n // _ALIGN) * _ALIGN
+
+
+def save_shard(path, arrays, meta):
+    """Write a numericalized shard to ``path``.
+
+    Args:
+        path (str): Output file.
+        arrays (dict[str, numpy.ndarray]): Arrays to store, by name.
+        meta (dict): JSON-serializable metadata.
+    """
+
+    arrays = {k: np.ascontiguousarray(v) for k, v in arrays.items()}
+    header = {"meta": meta, "arrays": {}}
+    offset = 0
+    for name, arr in arrays.items():
+        header["arrays"][name] = {
+            "dtype": arr.dtype.str, "shape": list(arr.shape),
+            "offset": offset}
+        offset += _aligned(arr.nbytes)
+    blob = json.dumps(header).encode("utf-8")
+    start = _aligned(len(_MAGIC) + 8 + len(blob))
+    with open(path, "wb") as f:
+        f.write(_MAGIC)
+        f.write(struct.pack("<Q", len(blob)))
+        f.write(blob)
+        for name, arr in arrays.items():
+            f.write(b"\0" * (start + header["arrays"][name]["offset"]
+                             - f.tell()))
+            f.write(arr.tobytes())
+
+
+def load_shard(path):
+    """Memory-map a shard written by :func:`save_shard`.
+
+    Returns:
+        (dict[str, numpy.ndarray], dict): read-only arrays and metadata.
+    """
+
+    with open(path, "rb") as f:
+        magic = f.read(len(_MAGIC))
+        if magic != _MAGIC:
+            raise ValueError("%s is not a numericalized shard" % path)
+        blob_len, = struct.unpack("<Q", f.read(8))
+        header = json.loads(f.read(blob_len).decode("utf-8"))
+    start = _aligned(len(_MAGIC) + 8 + blob_len)
+    buf = np.memmap(path, dtype=np.uint8, mode="r").view(np.ndarray)
+    arrays = {}
+    for name, spec in header["arrays"].items():
+        dtype = np.dtype(spec["dtype"])
+        count = int(np.prod(spec["shape"], dtype=np.int64))
+        begin = start + spec["offset"]
+        arrays[name] = buf[begin:begin + count * dtype.itemsize] \
+            .view(dtype).reshape(spec["shape"])
+    return arrays, header["meta"]
+
+
+def encode(sequences, symbols):
+    """Map tokenized sequences to flat ids and offsets.
+
+    Args:
+        sequences (Iterable[List[str]]): tokenized sequences.
+        symbols (dict[str, int]): symbol table, extended in place with
+            unseen tokens.
+
+    Returns:
+        (numpy.ndarray, numpy.ndarray): int32 ids and int64 offsets, such
+        that sequence ``i`` is ``ids[offsets[i]:offsets[i + 1]]``.
+    """
+
+    ids = array("i")
+    offsets = array("q", [0])
+    for tokens in sequences:
+        ids.extend([symbols.setdefault(t, len(symbols)) for t in tokens])
+        offsets.append(len(ids))
+    return (np.frombuffer(ids, dtype=np.int32),
+            np.frombuffer(offsets, dtype=np.int64))
+
+
+class NumericExample(object):
+    """An example whose sides are id arrays viewing into a shard.
+
+    ``src`` and ``tgt`` hold a single-element tuple, mirroring the
+    per-feature lists of :class:`onmt.inputters.TextMultiField`, so that
+    ``len(ex.src[0])`` keeps working for sort keys and length filters.
+    """
+
+    __slots__ = ("src", "tgt", "indices")
+
+    def __init__(self, src, tgt, indices):
+        self.src = src
+        self.tgt = tgt
+        self.indices = indices
+
+
+class NumericDataset(object):
+    """A dataset backed by a memory-mapped numericalized shard.
+
+    It exposes the subset of the :class:`onmt.inputters.Dataset` API used by
+    the iterators: ``len``, indexing, iteration, ``examples``, ``sort_key``
+    and ``fields``.
+
+    Args:
+        arrays (dict[str, numpy.ndarray]): ``src``/``src_offsets``, and
+            optionally ``tgt``/``tgt_offsets``, ``indices``,
+            ``category`` and the ``src_len``/``tgt_len`` length index
+            (otherwise computed from the offsets).
+        meta (dict): shard metadata, with at least ``symbols``.
+            Shards with copy vocabularies (``src_map``, ``alignment``,
+            ``copy_vocab`` and ``copy_vocab_offsets`` arrays, see
+            :func:`onmt.inputters.dataset_base.build_dynamic_dict`) also
+            have their ``copy_specials``.
+        fields (dict[str, Field] or NoneType): fields used to map symbols
+            to vocabulary ids. May be set later.
+    """
+
+    sort_key = staticmethod(text_sort_key)
+
+    def __init__(self, arrays, meta, fields=None):
+        self.arrays = arrays
+        self.meta = meta
+        self.symbols = meta["symbols"]
+        self.categories = meta.get("categories", [])
+        self._src = arrays["src"]
+        self._src_offsets = arrays["src_offsets"]
+        self._tgt = arrays.get("tgt")
+        self._tgt_offsets = arrays.get("tgt_offsets")
+        self._indices = arrays.get("indices")
+        self.category = arrays.get("category")
+        self.lengths = {
+            side: arrays[side + "_len"] if side + "_len" in arrays
+            else None if offsets is None else length_array(np.diff(offsets))
+            for side, offsets in [("src", self._src_offsets),
+                                  ("tgt", self._tgt_offsets)]}
+        self.dynamic_dict = None
+        if "copy_vocab" in arrays:
+            copy = {"src_map": arrays["src_map"],
+                    "vocab": arrays["copy_vocab"],
+                    "vocab_offsets": arrays["copy_vocab_offsets"],
+                    "src_offsets": self._src_offsets,
+                    "indices": self._indices if self._indices is not None
+                    else np.arange(len(self))}
+            if "alignment" in arrays:
+                copy["alignment"] = arrays["alignment"]
+                copy["tgt_offsets"] = self._tgt_offsets
+            self.dynamic_dict = DynamicDict(
+                copy, self.symbols, meta["copy_specials"])
+        self._fields = None
+        self._lookup = {}
+        if fields is not None:
+            self.fields = fields
+
+    @classmethod
+    def load(cls, path, fields=None):
+        arrays, meta = load_shard(path)
+        return cls(arrays, meta, fields)
+
+    @property
+    def fields(self):
+        return self._fields
+
+    @fields.setter
+    def fields(self, fields):
+        self._fields = fields
+        self._lookup = {}
+        if not fields:
+            return
+        for side in ("src", "tgt"):
+            if side not in fields:
+                continue
+            assert len(fields[side].fields) == 1, \
+                "Numericalized shards do not support word features."
+            vocab = fields[side].base_field.vocab
+            unk = vocab.stoi[fields[side].base_field.unk_token]
+            self._lookup[side] = np.array(
+                [vocab.stoi.get(s, unk) for s in self.symbols],
+                dtype=np.int64)
+
+    @property
+    def has_tgt(self):
+        return self._tgt is not None
+
+    @property
+    def examples(self):
+        return self
+
+    def __len__(self):
+        return len(self._src_offsets) - 1
+
+    def __getitem__(self, i):
+        s, e = self._src_offsets[i], self._src_offsets[i + 1]
+        tgt = None
+        if self._tgt is not None:
+            ts, te = self._tgt_offsets[i], self._tgt_offsets[i + 1]
+            tgt = (self._tgt[ts:te],)
+        index = int(self._indices[i]) if self._indices is not None else i
+        return NumericExample((self._src[s:e],), tgt, index)
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+    def pad(self, data, side):
+        """Numericalize and pad one side of a minibatch.
+
+        Args:
+            data (List[NumericExample]): the minibatch.
+            side (str): ``"src"`` or ``"tgt"``.
+
+        Returns:
+            (torch.LongTensor, torch.LongTensor): ids of shape
+            ``(seq_len, batch_size, 1)`` and lengths of shape
+            ``(batch_size,)``, both including BOS/EOS when the field
+            adds them.
+        """
+
+        field = self._fields[side].base_field
+        stoi = field.vocab.stoi
+        seqs = [getattr(ex, side)[0] for ex in data]
+        lengths = np.fromiter(
+            (len(s) for s in seqs), dtype=np.int64, count=len(seqs))
+        bos = int(field.init_token is not None)
+        eos = int(field.eos_token is not None)
+        width = int(lengths.max()) + bos + eos
+        out = np.full((len(seqs), width), stoi[field.pad_token],
+                      dtype=np.int64)
+        body = np.arange(width)[None, :] - bos < lengths[:, None]
+        body[:, :bos] = False
+        out[body] = self._lookup[side][np.concatenate(seqs)]
+        if bos:
+            out[:, 0] = stoi[field.init_token]
+        if eos:
+            out[np.arange(len(seqs)), lengths + bos] = stoi[field.eos_token]
+        data = torch.from_numpy(out).t().contiguous().unsqueeze(2)
+        return data, torch.from_numpy(lengths + bos + eos)
+
+
+class NumericBatch(Batch):
+    """A :class:`torchtext.data.Batch` built from a :class:`NumericDataset`.
+
+    Attributes match the ones a regular batch has for text data: ``src``
+    is a ``(data, lengths)`` tuple, ``tgt`` the padded target, ``indices``
+    the example indices and ``corpus_id`` when the fields define it.
+    Shards with copy vocabularies also give ``src_map``, ``alignment``
+    and ``src_ex_vocab``.
+    """
+
+    def __init__(self, data, dataset, device=None):
+        super(NumericBatch, self).__init__()
+        self.batch_size = len(data)
+        self.dataset = dataset
+        fields = dataset.fields
+        self.fields = fields.keys()
+        self.input_fields = [k for k, v in fields.items() if
+                             v is not None and not v.is_target]
+        self.target_fields = [k for k, v in fields.items() if
+                              v is not None and v.is_target]
+        src, lengths = dataset.pad(data, "src")
+        self.src = (src.to(device), lengths.to(device))
+        if dataset.has_tgt and "tgt" in fields:
+            self.tgt = dataset.pad(data, "tgt")[0].to(device)
+        self.indices = torch.tensor(
+            [ex.indices for ex in data], dtype=torch.long, device=device)
+        cid_field = fields.get("corpus_id")
+        if cid_field is not None and hasattr(cid_field, "vocab"):
+            cid = cid_field.vocab.stoi[dataset.meta.get("corpus_id",
+                                                        "train")]
+            self.corpus_id = torch.full(
+                (len(data),), cid, dtype=torch.long, device=device)
+        if dataset.dynamic_dict is not None:
+            dataset.dynamic_dict.fill(
+                self, [ex.indices for ex in data], device)
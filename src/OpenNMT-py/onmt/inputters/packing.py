@@ -0,0 +1,156 @@
+# -*- coding: utf-8 -*-
+"""Packing of several short examples into each row of a training batch.
+
+COGS sources and targets are short and vary a lot in length, so a batch
+padded to its longest example is mostly padding. A packed batch instead
+concatenates examples, source with source and target with target, into
+rows of about ``pack_length`` tokens. Each token carries the id of its
+example within the row (its segment, ``0`` for padding): the transformer
+resets positions at segment boundaries and masks attention across them,
+see :func:`onmt.utils.misc.segment_mask`, and the loss skips the
+prediction of an example's BOS from the end of the previous one.
+"""
+import torch
+
+
+def pack_rows(src_lengths, tgt_lengths, pack_length):
+    """Assign examples to rows, first-fit by decreasing length.
+
+    A row holds at most ``pack_length`` tokens on each side, or the length
+    of the longest example of that side if it is longer.
+
+    Args:
+        src_lengths (List[int]), tgt_lengths (List[int]): lengths of the
+            examples, as in the batch tensors.
+        pack_length (int): maximum number of tokens of a row.
+
+    Returns:
+        List[List[int]]: the examples of each row, in order.
+    """
+
+    cap_src = max([pack_length] + src_lengths)
+    cap_tgt = max([pack_length] + tgt_lengths)
+    order = sorted(range(len(src_lengths)),
+                   key=lambda i: (tgt_lengths[i], src_lengths[i]),
+                   reverse=True)
+    rows, room = [], []
+    for i in order:
+        for k, (src_room, tgt_room) in enumerate(room):
+            if src_lengths[i] <= src_room and tgt_lengths[i] <= tgt_room:
+                break
+        else:
+            k = len(rows)
+            rows.append([])
+            room.append((cap_src, cap_tgt))
+        rows[k].append(i)
+        room[k] = (room[k][0] - src_lengths[i], room[k][1] - tgt_lengths[i])
+    return rows
+
+
+def _pack_side(data, lengths, example, row, offset, segment, pad):
+    """Scatter the ``(len, batch)`` ``data`` into packed rows.
+
+    ``example``, ``row``, ``offset`` and ``segment`` give, for each
+    example in packing order, its column in ``data``, its row, its first
+    position in the row and its segment id.
+    """
+
+    lengths = lengths[example]
+    n_tokens = int(lengths.sum())
+    starts = torch.cumsum(lengths, 0) - lengths
+    token = torch.arange(n_tokens, device=data.device) \
+        - starts.repeat_interleave(lengths)
+    column = example.repeat_interleave(lengths)
+    dest_row = row.repeat_interleave(lengths)
+    dest_pos = offset.repeat_interleave(lengths) + token
+    n_rows = int(row.max()) + 1
+    row_lengths = torch.zeros(n_rows, dtype=torch.long, device=data.device) \
+        .index_add_(0, row, lengths)
+    width = int(row_lengths.max())
+    packed = data.new_full((width, n_rows), pad)
+    packed[dest_pos, dest_row] = data[token, column]
+    segments = torch.zeros(
+        (width, n_rows), dtype=torch.long, device=data.device)
+    segments[dest_pos, dest_row] = segment.repeat_interleave(lengths)
+    return packed, segments, row_lengths
+
+
+def pack_batch(batch, pack_length, src_pad, tgt_pad):
+    """Pack the examples of a text batch, see :func:`pack_rows`.
+
+    The batch is modified in place: ``src`` and ``tgt`` become the packed
+    rows (``src`` lengths being those of the rows), and ``src_segments``
+    and ``tgt_segments`` are set, of shape ``(len, rows)``.
+    ``batch_size`` is still the number of examples.
+
+    Args:
+        batch (torchtext.data.Batch): batch with ``src`` and ``tgt``.
+        pack_length (int): see :func:`pack_rows`.
+        src_pad (int), tgt_pad (int): padding ids.
+
+    Returns:
+        the packed batch.
+    """
+
+    src, src_lengths = batch.src
+    tgt = batch.tgt
+    assert src.size(2) == 1 and tgt.size(2) == 1, \
+        "Packing does not support word features."
+    tgt_lengths = tgt[:, :, 0].ne(tgt_pad).sum(0)
+    lengths = {"src": src_lengths.tolist(), "tgt": tgt_lengths.tolist()}
+    rows = pack_rows(lengths["src"], lengths["tgt"], pack_length)
+
+    def as_tensor(values):
+        return torch.tensor(values, dtype=torch.long, device=src.device)
+
+    example = as_tensor([i for r in rows for i in r])
+    row = as_tensor([k for k, r in enumerate(rows) for _ in r])
+    segment = as_tensor([j + 1 for r in rows for j in range(len(r))])
+    packed = {}
+    for side, data, pad in [("src", src, src_pad), ("tgt", tgt, tgt_pad)]:
+        # first position of each example in its row
+        offset = []
+        for r in rows:
+            start = 0
+            for i in r:
+                offset.append(start)
+                start += lengths[side][i]
+        packed[side] = _pack_side(
+            data[:, :, 0], as_tensor(lengths[side]), example, row,
+            as_tensor(offset), segment, pad)
+
+    src, batch.src_segments, src_row_lengths = packed["src"]
+    tgt, batch.tgt_segments, _ = packed["tgt"]
+    batch.src = (src.unsqueeze(2), src_row_lengths)
+    batch.tgt = tgt.unsqueeze(2)
+    return batch
+
+
+class PackedIterator(object):
+    """Pack the batches of a training iterator, see :func:`pack_batch`.
+
+    Args:
+        iterator: iterator over text batches, e.g. a
+            :class:`onmt.inputters.inputter.DatasetLazyIter`.
+        pack_length (int): see :func:`pack_rows`.
+        fields (dict[str, Field]): the fields of the batches.
+
+    Other attributes are those of ``iterator``.
+    """
+
+    def __init__(self, iterator, pack_length, fields):
+        self.iterator = iterator
+        self.pack_length = pack_length
+        self.src_pad, self.tgt_pad = [
+            fields[side].base_field.vocab.stoi[
+                fields[side].base_field.pad_token]
+            for side in ["src", "tgt"]]
+
+    def __getattr__(self, name):
+        # state_dict/load_state_dict, when the iterator has them
+        return getattr(self.iterator, name)
+
+    def __iter__(self):
+        for batch in self.iterator:
+            yield pack_batch(batch, self.pack_length,
+                             self.src_pad, self.tgt_pad)
@@ -0,0 +1,102 @@
+# -*- coding: utf-8 -*-
+"""Collate batches in worker processes, ahead of the training loop.
+
+The iterators decide which examples go in each batch; padding and
+numericalizing them is handed to a :class:`torch.utils.data.DataLoader`
+whose workers keep a bounded number of batches ready, in order. Batches
+come back on CPU (in pinned memory when training on GPU) and are moved
+to the device without blocking.
+"""
+import multiprocessing
+
+import torch
+from torch.utils.data import DataLoader
+
+
+def batch_apply(batch, fn):
+    """Replace the tensors of ``batch`` by ``fn(tensor)``, in place.
+
+    Covers tensor attributes and tuples of tensors, like ``src``.
+    """
+    for name, value in list(vars(batch).items()):
+        if torch.is_tensor(value):
+            setattr(batch, name, fn(value))
+        elif isinstance(value, tuple) and value \
+                and all(torch.is_tensor(v) for v in value):
+            setattr(batch, name, tuple(fn(v) for v in value))
+    return batch
+
+
+class _Collated(object):
+    """A batch collated in a worker, on its way to the training loop.
+
+    It is sent without its ``dataset`` and ``fields``, which stay with
+    the iterator, and the DataLoader pins it with :meth:`pin_memory`.
+    """
+
+    def __init__(self, batch):
+        self.batch = batch
+
+    def __getstate__(self):
+        state = {k: v for k, v in vars(self.batch).items()
+                 if k not in ("dataset", "fields")}
+        return type(self.batch), state
+
+    def __setstate__(self, state):
+        cls, state = state
+        self.batch = cls.__new__(cls)
+        vars(self.batch).update(state)
+
+    def pin_memory(self):
+        batch_apply(self.batch, torch.Tensor.pin_memory)
+        return self
+
+
+class _Collator(torch.utils.data.Dataset):
+    """Map-style dataset whose "indices" are minibatches to collate."""
+
+    def __init__(self, collate):
+        self.collate = collate
+
+    def __getitem__(self, minibatch):
+        return _Collated(self.collate(minibatch))
+
+
+def _identity(batch):
+    return batch
+
+
+def prefetch_batches(minibatches, collate, dataset, device,
+                     num_workers, prefetch=2):
+    """Collate ``minibatches`` in worker processes.
+
+    Args:
+        minibatches (Iterable): what ``collate`` takes, in order.
+        collate (Callable): makes a CPU batch out of a minibatch.
+        dataset: set back as the ``dataset`` of the batches.
+        device (str or torch.device): where batches are yielded.
+        num_workers (int): number of worker processes.
+        prefetch (int): batches each worker keeps ready.
+
+    Yields:
+        the batches, in the order of ``minibatches``.
+    """
+
+    device = torch.device(device)
+    # forked workers share the dataset rather than unpickle a copy of it,
+    # also within the spawned processes of distributed training
+    context = "fork" if "fork" in multiprocessing.get_all_start_methods() \
+        else None
+    # workers draw their seeds from `generator`, which leaves the global
+    # RNG (dropout, noise) as it would be without workers
+    loader = DataLoader(
+        _Collator(collate), sampler=minibatches, batch_size=None,
+        collate_fn=_identity, num_workers=num_workers,
+        prefetch_factor=prefetch, pin_memory=device.type == "cuda",
+        generator=torch.Generator(), multiprocessing_context=context)
+    for collated in loader:
+        batch = collated.batch
+        batch.dataset = dataset
+        batch.fields = dataset.fields.keys()
+        yield batch_apply(
+            batch, lambda t: t.to(device, non_blocking=True))
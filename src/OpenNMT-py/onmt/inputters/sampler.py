@@ -0,0 +1,251 @@
+# -*- coding: utf-8 -*-
+"""Length-bucketed batching of text examples.
+
+Batches are built from the length index of a dataset (see
+:func:`onmt.inputters.inputter.length_index`) rather than from the
+examples: examples with the same lengths form a bucket, buckets are laid
+out by increasing length and packed greedily into batches, whose size is
+the exact padded size of the tensors they become.
+"""
+import numpy as np
+
+from onmt.utils.logging import logger
+
+# padded lengths: src is [<bos> w1 ... wN <eos>], tgt is [w1 ... wM <eos>]
+SRC_EXTRA = 2
+TGT_EXTRA = 1
+
+
+class PaddedSize(int):
+    """The size in tokens of a batch being built, as an ``int``.
+
+    It also remembers the longest padded ``src`` and ``tgt`` of the batch,
+    so that :func:`max_tok_len` keeps its state in the value it is handed
+    back rather than in globals, and several batches can be built at once.
+    """
+
+    def __new__(cls, count, src, tgt):
+        size = super(PaddedSize, cls).__new__(cls, count * max(src, tgt))
+        size.src = src
+        size.tgt = tgt
+        return size
+
+
+def max_tok_len(new, count, sofar):
+    """
+    In token batching scheme, the number of sequences is limited
+    such that the total number of src/tgt tokens (including padding)
+    in a batch <= batch_size. ``new`` is an
+    :class:`onmt.inputters.inputter.ExampleLengths`.
+    """
+    src, tgt = new.src + SRC_EXTRA, new.tgt + TGT_EXTRA
+    if count > 1:
+        src, tgt = max(src, sofar.src), max(tgt, sofar.tgt)
+    return PaddedSize(count, src, tgt)
+
+
+def max_src_tok_len(new, count, sofar):
+    """Like :func:`max_tok_len`, only counting source tokens."""
+    src = new.src + SRC_EXTRA
+    if count > 1:
+        src = max(src, sofar.src)
+    return PaddedSize(count, src, 0)
+
+
+class PaddingStats(object):
+    """Real and padded token counts of a set of batches.
+
+    Lengths include BOS/EOS, as in the batch tensors.
+    """
+
+    def __init__(self):
+        self.batches = 0
+        self.examples = 0
+        self.tokens = {"src": 0, "tgt": 0}
+        self.padded = {"src": 0, "tgt": 0}
+
+    def update(self, batches, lengths):
+        """Add ``batches`` (position arrays) with padded ``lengths``."""
+        if not batches:
+            return
+        order = np.concatenate(batches)
+        starts = np.cumsum([0] + [len(b) for b in batches[:-1]])
+        sizes = np.array([len(b) for b in batches])
+        self.batches += len(batches)
+        self.examples += len(order)
+        for side, lens in lengths.items():
+            if lens is None:
+                continue
+            lens = lens[order]
+            self.tokens[side] += int(lens.sum())
+            self.padded[side] += int(
+                (np.maximum.reduceat(lens, starts) * sizes).sum())
+
+    def efficiency(self, side=None):
+        """Fraction of the padded tensors holding real tokens."""
+        sides = [side] if side is not None else list(self.tokens)
+        padded = sum(self.padded[s] for s in sides)
+        return sum(self.tokens[s] for s in sides) / padded if padded else 1.
+
+    def __str__(self):
+        out = "%d batches, padding efficiency %.2f%%" % (
+            self.batches, 100 * self.efficiency())
+        sides = [s for s in self.padded if self.padded[s]]
+        if len(sides) > 1:
+            out += " (%s)" % ", ".join(
+                "%s %.2f%%" % (s, 100 * self.efficiency(s)) for s in sides)
+        return out
+
+
+def padded_lengths(lengths):
+    """The padded ``src`` and ``tgt`` lengths of a length index."""
+    src = np.asarray(lengths["src"], dtype=np.int64) + SRC_EXTRA
+    tgt = lengths.get("tgt")
+    tgt = None if tgt is None \
+        else np.asarray(tgt, dtype=np.int64) + TGT_EXTRA
+    return {"src": src, "tgt": tgt}
+
+
+def bucket_batches(lengths, batch_size, batch_type="sents",
+                   batch_size_multiple=1, rng=None):
+    """Pack examples of similar lengths into batches.
+
+    Examples are grouped into buckets of equal ``(src, tgt)`` lengths,
+    ordered by the side that weighs most in the batch sizes (usually the
+    target), and packed greedily. A batch is closed as soon as one more
+    example would take it over ``batch_size``, and trimmed to a multiple
+    of ``batch_size_multiple``, the remainder starting the next batch.
+
+    Args:
+        lengths (dict[str, numpy.ndarray or NoneType]): padded lengths, see
+            :func:`padded_lengths`.
+        batch_size (int): maximum number of examples or padded tokens.
+        batch_type (str): ``"sents"`` or ``"tokens"``.
+        batch_size_multiple (int): batch sizes are a multiple of it,
+            except for the last batch.
+        rng (numpy.random.RandomState or NoneType): shuffles examples
+            within buckets and the batches, which otherwise come in
+            increasing length order.
+
+    Returns:
+        List[numpy.ndarray]: positions of the examples of each batch.
+    """
+
+    src, tgt = lengths["src"], lengths["tgt"]
+    n = len(src)
+    if tgt is None:
+        tgt = np.zeros(n, dtype=np.int64)
+    order = rng.permutation(n) if rng is not None else np.arange(n)
+    # lexsort sorts by its last key first and is stable, which keeps the
+    # shuffled order within buckets
+    keys = (src[order], tgt[order])
+    if src.sum() > tgt.sum():
+        keys = keys[::-1]
+    order = order[np.lexsort(keys)]
+
+    tokens = batch_type == "tokens"
+    src_l, tgt_l = src[order].tolist(), tgt[order].tolist()
+    batches = []
+    start, max_src, max_tgt = 0, 0, 0
+    i = 0
+    while i < n:
+        s, t = max(max_src, src_l[i]), max(max_tgt, tgt_l[i])
+        count = i - start + 1
+        if (count * max(s, t) if tokens else count) <= batch_size:
+            max_src, max_tgt = s, t
+            i += 1
+            continue
+        if count == 1:
+            logger.warning("An example was ignored, more tokens"
+                           " than allowed by tokens batch_size")
+            start, i = i + 1, i + 1
+            continue
+        end = i
+        if batch_size_multiple > 1 and count - 1 > batch_size_multiple:
+            end -= (count - 1) % batch_size_multiple
+        batches.append(order[start:end])
+        start, i = end, end
+        max_src, max_tgt = 0, 0
+    if start < n:
+        batches.append(order[start:])
+    if rng is not None:
+        batches = [batches[j] for j in rng.permutation(len(batches))]
+    return batches
+
+
+class BucketBatchSampler(object):
+    """Yield the batches of each epoch of a text dataset, as positions.
+
+    The batches of an epoch only depend on ``seed`` and the epoch number,
+    and the sampler holds no state while iterating: several samplers, or
+    several epochs of one, can be iterated concurrently.
+
+    Args:
+        lengths (dict[str, numpy.ndarray or NoneType]): the ``src`` and
+            ``tgt`` length index of the dataset, without BOS/EOS.
+        batch_size (int): maximum number of examples or padded tokens.
+        batch_type (str): ``"sents"`` or ``"tokens"``.
+        batch_size_multiple (int): see :func:`bucket_batches`.
+        shuffle (bool): shuffle examples within buckets, and batches.
+        seed (int): seed of the shuffling; epoch ``e`` uses
+            ``(seed, e)``.
+
+    Attributes:
+        epoch (int): the epoch the next iteration yields.
+        stats (PaddingStats or NoneType): padding of the last epoch
+            iterated.
+    """
+
+    def __init__(self, lengths, batch_size, batch_type="sents",
+                 batch_size_multiple=1, shuffle=True, seed=0):
+        self.lengths = padded_lengths(lengths)
+        self.batch_size = batch_size
+        self.batch_type = batch_type
+        self.batch_size_multiple = batch_size_multiple
+        self.shuffle = shuffle
+        self.seed = seed
+        self.epoch = 0
+        self.stats = None
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+
+    def batches(self, epoch):
+        """The batches of ``epoch``, and their :class:`PaddingStats`."""
+        rng = np.random.RandomState([self.seed, epoch]) \
+            if self.shuffle else None
+        batches = bucket_batches(
+            self.lengths, self.batch_size, self.batch_type,
+            self.batch_size_multiple, rng)
+        stats = PaddingStats()
+        stats.update(batches, self.lengths)
+        return batches, stats
+
+    def __iter__(self):
+        batches, self.stats = self.batches(self.epoch)
+        self.epoch += 1
+        return iter(batches)
+
+
+def shard_batches(batches, rank, world_size):
+    """The share of process ``rank`` out of ``world_size`` of ``batches``.
+
+    Every process goes through the same batches and keeps batch ``rank``
+    of each group of ``world_size``; an incomplete last group is dropped,
+    so that all processes get as many batches.
+
+    Args:
+        batches (Iterable): the batches, in the same order on all ranks.
+        rank (int): rank of this process.
+        world_size (int): number of processes.
+
+    Yields:
+        the batches of ``rank``.
+    """
+
+    group = []
+    for batch in batches:
+        group.append(batch)
+        if len(group) == world_size:
+            yield group[rank]
+            group = []
@@ -0,0 +1,185 @@
+# -*- coding: utf-8 -*-
+"""Text corpora held as padded tensors on the training device.
+
+Small corpora fit on the device as a handful of padded tensors. They are
+numericalized once; each epoch then gathers them in the order of the
+:class:`onmt.inputters.sampler.BucketBatchSampler` batches, and every
+batch is a slice of the gathered tensors, trimmed to its longest example.
+"""
+import numpy as np
+import torch
+from torchtext.data import Batch
+
+from onmt.inputters.sampler import BucketBatchSampler, shard_batches
+from onmt.utils.logging import logger
+
+
+def _pad_to(data, width, pad):
+    """Pad ``(n, len)`` ids to ``(n, width)``."""
+    if data.size(1) == width:
+        return data
+    return torch.cat([data, data.new_full(
+        (data.size(0), width - data.size(1)), pad)], 1)
+
+
+class TensorDataset(object):
+    """The examples of text shards, as padded tensors.
+
+    Args:
+        batches (List[torchtext.data.Batch]): one batch of all the
+            examples of each shard, as :func:`_make_batch` makes them.
+        lengths (List[dict]): the length index of each shard.
+        fields (dict[str, Field]): the fields of the batches.
+        device (str or torch.device): where to keep the tensors.
+
+    Attributes:
+        src, tgt (torch.LongTensor): ids of shape ``(n, max_len)``,
+            including BOS/EOS when the fields add them; ``tgt`` may be
+            ``None``.
+        src_lengths, indices, corpus_id (torch.LongTensor): shape
+            ``(n,)``; ``corpus_id`` may be ``None``.
+        lengths (dict[str, numpy.ndarray or NoneType]): length index.
+    """
+
+    def __init__(self, batches, lengths, fields, device):
+        self.fields = fields
+        self.device = torch.device(device)
+        has_tgt = all(hasattr(b, "tgt") for b in batches)
+        sides = ["src", "tgt"] if has_tgt else ["src"]
+        # number of BOS/EOS tokens the fields add
+        self.extra = {}
+        for side in sides:
+            field = fields[side].base_field
+            self.extra[side] = int(field.init_token is not None) \
+                + int(field.eos_token is not None)
+        for side in sides:
+            data = [b.src[0] if side == "src" else b.tgt for b in batches]
+            assert all(d.size(2) == 1 for d in data), \
+                "Tensorized data does not support word features."
+            width = max(d.size(0) for d in data)
+            pad = fields[side].base_field.vocab.stoi[
+                fields[side].base_field.pad_token]
+            setattr(self, side, torch.cat(
+                [_pad_to(d[:, :, 0].t(), width, pad) for d in data]
+            ).to(self.device))
+        if not has_tgt:
+            self.tgt = None
+        self.src_lengths = torch.cat(
+            [b.src[1] for b in batches]).to(self.device)
+        self.indices = torch.cat([b.indices for b in batches]).to(self.device)
+        self.corpus_id = None
+        if all(hasattr(b, "corpus_id") for b in batches):
+            self.corpus_id = torch.cat(
+                [b.corpus_id for b in batches]).to(self.device)
+        self.lengths = {
+            side: np.concatenate([index[side] for index in lengths])
+            if side in sides else None for side in ["src", "tgt"]}
+
+    def __len__(self):
+        return self.src.size(0)
+
+
+class TensorBatch(Batch):
+    """A slice of a :class:`TensorDataset`, with the attributes of a text
+    :class:`torchtext.data.Batch`."""
+
+    def __init__(self, dataset, data, start, end, src_len, tgt_len):
+        super(TensorBatch, self).__init__()
+        self.batch_size = end - start
+        self.dataset = dataset
+        self.fields = dataset.fields.keys()
+        self.src = (data["src"][start:end, :src_len].t()
+                    .contiguous().unsqueeze(2),
+                    data["src_lengths"][start:end])
+        if data["tgt"] is not None:
+            self.tgt = data["tgt"][start:end, :tgt_len].t() \
+                .contiguous().unsqueeze(2)
+        self.indices = data["indices"][start:end]
+        if data["corpus_id"] is not None:
+            self.corpus_id = data["corpus_id"][start:end]
+
+
+class TensorIterator(object):
+    """Iterate over the batches of a :class:`TensorDataset`.
+
+    Args:
+        dataset (TensorDataset): the data.
+        batch_size (int), batch_type (str), batch_size_multiple (int):
+            See :class:`onmt.inputters.sampler.BucketBatchSampler`.
+        train (bool): shuffle the data, and log the padding of each
+            epoch.
+        repeat (bool): iterate over epochs indefinitely.
+        seed (int): seed of the sampler.
+        rank (int), world_size (int): in training, only yield the share
+            of process ``rank`` of ``world_size`` of the batches, see
+            :func:`onmt.inputters.sampler.shard_batches`.
+    """
+
+    def __init__(self, dataset, batch_size, batch_type="sents",
+                 batch_size_multiple=1, train=True, repeat=True, seed=0,
+                 rank=0, world_size=1):
+        self.dataset = dataset
+        self.train = train
+        self.repeat = repeat
+        self.rank = rank
+        self.world_size = world_size
+        self.sampler = BucketBatchSampler(
+            dataset.lengths, batch_size, batch_type, batch_size_multiple,
+            shuffle=train, seed=seed)
+        self._epoch_index = 0
+        self._batch_index = 0
+        self._resume = None
+
+    def state_dict(self):
+        """The seed, epoch and batch the iterator is at."""
+        return {"seed": self.sampler.seed, "epoch": self._epoch_index,
+                "batch": self._batch_index}
+
+    def load_state_dict(self, state_dict):
+        """Resume from :meth:`state_dict` on the next iteration."""
+        self.sampler.seed = state_dict["seed"]
+        self.sampler.set_epoch(state_dict["epoch"])
+        self._resume = state_dict["batch"]
+
+    def _epoch(self):
+        self._epoch_index = self.sampler.epoch
+        batches = list(self.sampler)
+        if self.train and self.world_size > 1:
+            batches = list(shard_batches(batches, self.rank, self.world_size))
+        self._batch_index, self._resume = self._resume or 0, None
+        src, tgt = self.dataset.lengths["src"], self.dataset.lengths["tgt"]
+        if tgt is None:
+            tgt = np.zeros_like(src)
+        # longest first within batches, as `rnn.pack_padded_sequence` needs
+        batches = [b[np.lexsort((-tgt[b], -src[b]))]
+                   for b in batches[self._batch_index:]]
+        if not batches:
+            return
+        order = torch.from_numpy(np.concatenate(batches)).to(
+            self.dataset.device)
+        data = {name: None if t is None else t.index_select(0, order)
+                for name, t in [("src", self.dataset.src),
+                                ("tgt", self.dataset.tgt),
+                                ("src_lengths", self.dataset.src_lengths),
+                                ("indices", self.dataset.indices),
+                                ("corpus_id", self.dataset.corpus_id)]}
+        extra = self.dataset.extra
+        start = 0
+        for b in batches:
+            end = start + len(b)
+            self._batch_index += 1
+            yield TensorBatch(
+                self.dataset, data, start, end,
+                int(src[b[0]]) + extra["src"],
+                int(tgt[b].max()) + extra.get("tgt", 0))
+            start = end
+        if self.train:
+            logger.info("Batched %d examples: %s."
+                        % (self.sampler.stats.examples, self.sampler.stats))
+
+    def __iter__(self):
+        while True:
+            for batch in self._epoch():
+                yield batch
+            if not self.repeat:
+                return
@@ -1,5 +1,6 @@
 """Module defining models."""
-from onmt.models.model_saver import build_model_saver, ModelSaver
+from onmt.models.model_saver import build_model_saver, ModelSaver, \
+    load_checkpoint
 from onmt.models.model import NMTModel
 
-__all__ = ["build_model_saver", "ModelSaver", "NMTModel"]
+__all__ = ["build_model_saver", "ModelSaver", "NMTModel", "load_checkpoint"]
@@ -17,7 +17,8 @@ class NMTModel(nn.Module):
         self.encoder = encoder
         self.decoder = decoder
 
-    def forward(self, src, tgt, lengths, bptt=False, with_align=False):
+    def forward(self, src, tgt, lengths, bptt=False, with_align=False,
+                src_segments=None, tgt_segments=None):
         """Forward propagate a `src` and `tgt` pair for training.
         Possible initialized with a beginning decoder state.
 
@@ -33,6 +34,10 @@ class NMTModel(nn.Module):
                 If reset then init_state
             with_align (Boolean): A flag indicating whether output alignment,
                 Only valid for transformer decoder.
+            src_segments (LongTensor): Example ids of the tokens of packed
+                rows ``(src_len, batch)``, see :mod:`onmt.inputters.packing`.
+                Only valid for transformers.
+            tgt_segments (LongTensor): Same for ``tgt``.
 
         Returns:
             (FloatTensor, dict[str, FloatTensor]):
@@ -42,13 +47,21 @@ class NMTModel(nn.Module):
         """
         dec_in = tgt[:-1]  # exclude last target from inputs
 
-        enc_state, memory_bank, lengths = self.encoder(src, lengths)
+        if src_segments is None:
+            enc_state, memory_bank, lengths = self.encoder(src, lengths)
+            segments = {}
+        else:
+            enc_state, memory_bank, lengths = self.encoder(
+                src, lengths, segments=src_segments)
+            segments = {"src_segments": src_segments,
+                        "tgt_segments": tgt_segments[:-1]}
 
         if bptt is False:
             self.decoder.init_state(src, memory_bank, enc_state)
         dec_out, attns = self.decoder(dec_in, memory_bank,
                                       memory_lengths=lengths,
-                                      with_align=with_align)
+                                      with_align=with_align,
+                                      **segments)
         return dec_out, attns
 
     def update_dropout(self, dropout):
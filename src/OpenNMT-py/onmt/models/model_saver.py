@@ -1,8 +1,15 @@
+import hashlib
+import io
 import os
+import shutil
+import time
 import torch
 
 from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from itertools import count
 from onmt.utils.logging import logger
+from onmt.utils.misc import get_rng_state
 
 from copy import deepcopy
 
@@ -13,16 +20,45 @@ def build_model_saver(model_opt, opt, model, fields, optim):
                              model_opt,
                              fields,
                              optim,
-                             opt.keep_checkpoint)
+                             opt.keep_checkpoint,
+                             background=not opt.sync_checkpoint,
+                             checkpoint_vocab=opt.checkpoint_vocab)
     return model_saver
 
 
+def load_checkpoint(path, map_location="cpu"):
+    """Load a checkpoint saved by :class:`ModelSaver`.
+
+    With ``-checkpoint_vocab shared``, the checkpoint only refers to the
+    vocab file of its run, next to it: it is loaded into ``'vocab'``, as
+    in a self-contained checkpoint.
+    """
+    checkpoint = torch.load(path, map_location=map_location)
+    vocab_ref = checkpoint.pop('vocab_ref', None)
+    if vocab_ref is not None:
+        checkpoint['vocab'] = torch.load(
+            os.path.join(os.path.dirname(path), vocab_ref['path']),
+            map_location=map_location)
+    return checkpoint
+
+
+def _storage_numel(tensor):
+    """The number of elements of the storage under ``tensor``."""
+    if hasattr(tensor, "untyped_storage"):
+        return tensor.untyped_storage().nbytes() // tensor.element_size()
+    # before torch 2.0
+    return tensor.storage().size()
+
+
 class ModelSaverBase(object):
     """Base class for model saving operations
 
     Inherited classes must implement private methods:
     * `_save`
     * `_rm_checkpoint
+    * `_mark_best`
+
+    and may write in the background, see :meth:`wait`.
     """
 
     def __init__(self, base_path, model, model_opt, fields, optim,
@@ -37,30 +73,31 @@ class ModelSaverBase(object):
         if keep_checkpoint > 0:
             self.checkpoint_queue = deque([], maxlen=keep_checkpoint)
 
-    def save(self, step, moving_average=None):
+    def save(self, step, moving_average=None, data_state=None, best=False):
         """Main entry point for model saver
 
         It wraps the `_save` method with checks and apply `keep_checkpoint`
         related logic
+
+        Args:
+            step (int): step number
+            moving_average (onmt.utils.ExponentialMovingAverage): average
+                whose weights to save instead of the model's
+            data_state (dict): state of the training data iterator, to
+                resume it from the checkpoint
+            best (bool): the model is the best so far, see `_mark_best`
         """
 
         if self.keep_checkpoint == 0 or step == self.last_saved_step:
             return
 
-        save_model = self.model
-        if moving_average:
-            model_params_data = []
-            for avg, param in zip(moving_average, save_model.parameters()):
-                model_params_data.append(param.data)
-                param.data = avg.data
-
-        chkpt, chkpt_name = self._save(step, save_model)
+        if moving_average is not None and moving_average.shadow is None:
+            moving_average = None
+        chkpt, chkpt_name = self._save(step, self.model, data_state,
+                                       moving_average)
         self.last_saved_step = step
-
-        if moving_average:
-            for param_data, param in zip(model_params_data,
-                                         save_model.parameters()):
-                param.data = param_data
+        if best:
+            self._mark_best(chkpt_name)
 
         if self.keep_checkpoint > 0:
             if len(self.checkpoint_queue) == self.checkpoint_queue.maxlen:
@@ -68,11 +105,18 @@ class ModelSaverBase(object):
                 self._rm_checkpoint(todel)
             self.checkpoint_queue.append(chkpt_name)
 
-    def _save(self, step):
+    def wait(self):
+        """Wait for the checkpoints being written to be on disk."""
+
+    def _save(self, step, model, data_state=None, moving_average=None):
         """Save a resumable checkpoint.
 
         Args:
             step (int): step number
+            model (nn.Module): model to save
+            data_state (dict): state of the training data iterator
+            moving_average (onmt.utils.ExponentialMovingAverage): average
+                of the model, whose weights are saved as the model's
 
         Returns:
             (object, str):
@@ -83,6 +127,16 @@ class ModelSaverBase(object):
 
         raise NotImplementedError()
 
+    def _mark_best(self, name):
+        """Mark a checkpoint as the best one, which outlives its removal
+        by `keep_checkpoint`
+
+        Args:
+            name(str): name that indentifies the checkpoint
+        """
+
+        raise NotImplementedError()
+
     def _rm_checkpoint(self, name):
         """Remove a checkpoint
 
@@ -95,14 +149,55 @@ class ModelSaverBase(object):
 
 
 class ModelSaver(ModelSaverBase):
-    """Simple model saver to filesystem"""
+    """Simple model saver to filesystem
 
-    def _save(self, step, model):
-        model_state_dict = model.state_dict()
-        model_state_dict = {k: v for k, v in model_state_dict.items()
-                            if 'generator' not in k}
-        generator_state_dict = model.generator.state_dict()
+    With ``background``, :meth:`save` only copies the checkpoint to CPU;
+    a thread then writes it, to a temporary file renamed once complete,
+    and removes the checkpoints beyond ``keep_checkpoint``.
+
+    With ``checkpoint_vocab="shared"``, the vocab is saved once, to
+    ``<base_path>_vocab_<hash>.pt``, and checkpoints only refer to it,
+    see :func:`load_checkpoint`.
+    """
+
+    def __init__(self, base_path, model, model_opt, fields, optim,
+                 keep_checkpoint=-1, background=False,
+                 checkpoint_vocab="inline"):
+        super(ModelSaver, self).__init__(
+            base_path, model, model_opt, fields, optim, keep_checkpoint)
+        self.checkpoint_vocab = checkpoint_vocab
+        self._vocab = None
+        self._vocab_ref = None
+        self._writer = ThreadPoolExecutor(max_workers=1) \
+            if background else None
+        self._pending = []
+        self._buffers = []
+
+    def _snapshot(self, obj, index):
+        """Copy the tensors of nested dicts and lists to CPU, so that
+        training can go on while they are written. The copies reuse the
+        buffers of the previous snapshot, which is on disk by then."""
+        if isinstance(obj, torch.Tensor):
+            i = next(index)
+            if i == len(self._buffers):
+                self._buffers.append(None)
+            buf = self._buffers[i]
+            if buf is None or buf.shape != obj.shape \
+                    or buf.dtype != obj.dtype:
+                buf = torch.empty(obj.shape, dtype=obj.dtype,
+                                  pin_memory=obj.is_cuda)
+                self._buffers[i] = buf
+            return buf.copy_(obj.detach())
+        if isinstance(obj, dict):
+            return obj.__class__(
+                (k, self._snapshot(v, index)) for k, v in obj.items())
+        if isinstance(obj, (list, tuple)):
+            return obj.__class__(self._snapshot(v, index) for v in obj)
+        return obj
 
+    def _trimmed_vocab(self):
+        if self._vocab is not None:
+            return self._vocab
         # NOTE: We need to trim the vocab to remove any unk tokens that
         # were not originally here.
 
@@ -117,19 +212,115 @@ class ModelSaver(ModelSaverBase):
                 for key in keys_to_pop:
                     vocab[side].fields[0][1].vocab.stoi.pop(key, None)
 
+        self._vocab = vocab
+        return vocab
+
+    def _shared_vocab(self):
+        """Save the vocab under its content hash, if not done yet."""
+        if self._vocab_ref is not None:
+            return self._vocab_ref
+        buf = io.BytesIO()
+        torch.save(self._trimmed_vocab(), buf)
+        key = hashlib.sha1(buf.getvalue()).hexdigest()
+        path = '%s_vocab_%s.pt' % (self.base_path, key[:16])
+        if not os.path.exists(path):
+            logger.info("Saving vocab %s" % path)
+            with open(path + '.tmp', 'wb') as f:
+                f.write(buf.getvalue())
+            os.replace(path + '.tmp', path)
+        self._vocab_ref = {'path': os.path.basename(path), 'sha1': key}
+        return self._vocab_ref
+
+    @staticmethod
+    def _weights(model):
+        model_state_dict = {k: v for k, v in model.state_dict().items()
+                            if 'generator' not in k}
+        generator_state_dict = model.generator.state_dict()
+        for state_dict in (model_state_dict, generator_state_dict):
+            for k, v in state_dict.items():
+                # torch.save writes whole storages: the weights of
+                # stacked replicas are views of the stack
+                if _storage_numel(v) > v.numel():
+                    state_dict[k] = v.clone()
+        return model_state_dict, generator_state_dict
+
+    def _save(self, step, model, data_state=None, moving_average=None):
+        start = time.perf_counter()
+        model_state_dict, generator_state_dict = self._weights(
+            model if moving_average is None else moving_average.module())
+
         checkpoint = {
             'model': model_state_dict,
             'generator': generator_state_dict,
-            'vocab': vocab,
             'opt': self.model_opt,
             'optim': self.optim.state_dict(),
+            'rng': get_rng_state(),
         }
+        if self.checkpoint_vocab == "shared":
+            checkpoint['vocab_ref'] = self._shared_vocab()
+        else:
+            checkpoint['vocab'] = self._trimmed_vocab()
+        if data_state is not None:
+            checkpoint['data_state'] = data_state
+        if moving_average is not None:
+            # translation uses the averaged weights, training resumes
+            # from the trained ones
+            train_model, train_generator = self._weights(model)
+            checkpoint['ema'] = moving_average.state_dict()
+            checkpoint['train_weights'] = {
+                'model': train_model, 'generator': train_generator}
 
-        logger.info("Saving checkpoint %s_step_%d.pt" % (self.base_path, step))
         checkpoint_path = '%s_step_%d.pt' % (self.base_path, step)
-        torch.save(checkpoint, checkpoint_path)
+        if self._writer is None:
+            logger.info("Saving checkpoint %s" % checkpoint_path)
+            self._write(checkpoint, checkpoint_path)
+            return checkpoint, checkpoint_path
+
+        # one checkpoint in memory at a time
+        self.wait()
+        checkpoint = self._snapshot(checkpoint, count())
+        self._pending.append(self._writer.submit(
+            self._write, checkpoint, checkpoint_path))
+        logger.info("Saving checkpoint %s in the background "
+                    "(training paused %.0f ms)"
+                    % (checkpoint_path, (time.perf_counter() - start) * 1e3))
         return checkpoint, checkpoint_path
 
+    @staticmethod
+    def _write(checkpoint, path):
+        tmp_path = path + '.tmp'
+        torch.save(checkpoint, tmp_path)
+        os.replace(tmp_path, path)
+
+    def wait(self):
+        pending, self._pending = self._pending, []
+        for job in pending:
+            # raises the error of the job, if any
+            job.result()
+
+    def _mark_best(self, name):
+        if self._writer is not None:
+            self._pending.append(self._writer.submit(self._link_best, name))
+        else:
+            self._link_best(name)
+
+    def _link_best(self, name):
+        best_path = '%s_best.pt' % self.base_path
+        tmp_path = best_path + '.tmp'
+        try:
+            # checkpoints are never rewritten in place: no need to copy
+            os.link(name, tmp_path)
+        except OSError:
+            shutil.copyfile(name, tmp_path)
+        os.replace(tmp_path, best_path)
+
     def _rm_checkpoint(self, name):
+        if self._writer is not None:
+            self._pending.append(self._writer.submit(self._remove, name))
+        else:
+            self._remove(name)
+
+    @staticmethod
+    def _remove(name):
         if os.path.exists(name):
             os.remove(name)
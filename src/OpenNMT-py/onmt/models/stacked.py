@@ -0,0 +1,111 @@
+"""Models of the same architecture run as one with ``torch.func.vmap``."""
+import torch
+import torch.nn as nn
+from torch.func import functional_call, vmap
+
+from onmt.decoders.transformer import TransformerDecoder
+from onmt.encoders.transformer import TransformerEncoder
+
+
+class StackedModel(object):
+    """Independent models of the same architecture, run as one.
+
+    The parameters of the models are stacked along a new leading
+    dimension, and become views of their slice of the stack, so that the
+    optimizer of each model updates the stack in place. The forward pass
+    maps the first model over the stack with ``torch.func.vmap``, which
+    draws different dropout masks for each model. After backward,
+    :meth:`scatter_grads` gives each model its slice of the gradients.
+    The generators are not part of the forward pass, and each model
+    keeps its own.
+
+    Only transformers can be stacked, see :meth:`supports`. This module
+    requires torch>=2.0, and is not imported by :mod:`onmt.models`.
+
+    Args:
+        models (List[onmt.models.NMTModel]): models with the same
+            architecture. Buffers and dropout are those of the first.
+    """
+
+    def __init__(self, models):
+        self.models = list(models)
+        self.stack = {}
+        # the vmapped embeddings give gradients to the padding of all
+        # models but the first
+        self.padding = [
+            (name + ".weight", module.padding_idx)
+            for name, module in self.models[0].named_modules()
+            if isinstance(module, nn.Embedding)
+            and module.padding_idx is not None]
+        self._stack()
+
+    @staticmethod
+    def supports(model):
+        """Whether ``model`` can be vmapped."""
+        return isinstance(model.encoder, TransformerEncoder) \
+            and isinstance(model.decoder, TransformerDecoder)
+
+    def _stack(self):
+        params = [{name: p for name, p in m.named_parameters()
+                   if not name.startswith("generator.")}
+                  for m in self.models]
+        self.stack = {}
+        for name in params[0]:
+            stack = torch.stack([p[name].detach() for p in params])
+            for i, p in enumerate(params):
+                p[name].data = stack[i]
+            self.stack[name] = stack.requires_grad_()
+
+    def select(self, indices):
+        """Keep the models at ``indices`` only, e.g. once the others
+        stopped training."""
+        self.models = [self.models[i] for i in indices]
+        if self.models:
+            self._stack()
+        else:
+            self.stack = {}
+
+    def zero_grad(self):
+        for stack in self.stack.values():
+            stack.grad = None
+
+    def scatter_grads(self):
+        """Set the gradients of the models to their slice of those of
+        the stack."""
+        for name, padding_idx in self.padding:
+            if self.stack[name].grad is not None:
+                self.stack[name].grad[:, padding_idx] = 0
+        for i, model in enumerate(self.models):
+            params = dict(model.named_parameters())
+            for name, stack in self.stack.items():
+                params[name].grad = None if stack.grad is None \
+                    else stack.grad[i]
+
+    def __call__(self, src, tgt, lengths, batched=False, **kwargs):
+        """Run the forward pass of every model.
+
+        Args:
+            src, tgt, lengths: the inputs of
+                :meth:`onmt.models.NMTModel.forward`, shared by the
+                models, or one per model stacked along a leading
+                dimension with ``batched``.
+            kwargs: other arguments of the forward pass, shared.
+
+        Returns:
+            FloatTensor: the decoder outputs of the models, stacked.
+        """
+
+        model = self.models[0]
+        buffers = dict(model.named_buffers())
+
+        def forward(params, src, tgt, lengths):
+            dec_out, _ = functional_call(
+                model, (params, buffers), (src, tgt, lengths), kwargs)
+            return dec_out
+
+        in_dims = 0 if batched else None
+        dec_out = vmap(forward, in_dims=(0, in_dims, in_dims, in_dims),
+                       randomness="different")(self.stack, src, tgt, lengths)
+        # do not leave vmapped tensors in the decoder state
+        model.decoder.init_state(src[0] if batched else src, None, None)
+        return dec_out
@@ -5,37 +5,38 @@ from onmt.utils.misc import aeq
 from onmt.utils.loss import NMTLossCompute
 
 
-def collapse_copy_scores(scores, batch, tgt_vocab, src_vocabs=None,
-                         batch_dim=1, batch_offset=None):
+def collapse_copy_scores(scores, batch, tgt_vocab, batch_dim=1,
+                         batch_offset=None):
     """
     Given scores from an expanded dictionary
     corresponeding to a batch, sums together copies,
     with a dictionary word when it is ambiguous.
+
+    The mapping from copy vocabulary entries to ``tgt_vocab`` ids comes
+    from ``batch.src_ex_vocab`` (see
+    :class:`onmt.inputters.dataset_base.CopyVocabs`) and is applied to the
+    whole batch at once.
     """
     offset = len(tgt_vocab)
-    for b in range(scores.size(batch_dim)):
-        blank = []
-        fill = []
-
-        if src_vocabs is None:
-            src_vocab = batch.src_ex_vocab[b]
-        else:
-            batch_id = batch_offset[b] if batch_offset is not None else b
-            index = batch.indices.data[batch_id]
-            src_vocab = src_vocabs[index]
-
-        for i in range(1, len(src_vocab)):
-            sw = src_vocab.itos[i]
-            ti = tgt_vocab.stoi[sw]
-            if ti != 0:
-                blank.append(offset + i)
-                fill.append(ti)
-        if blank:
-            blank = torch.Tensor(blank).type_as(batch.indices.data)
-            fill = torch.Tensor(fill).type_as(batch.indices.data)
-            score = scores[:, b] if batch_dim == 1 else scores[b]
-            score.index_add_(1, fill, score.index_select(1, blank))
-            score.index_fill_(1, blank, 1e-10)
+    fill = batch.src_ex_vocab.tgt_map(tgt_vocab).to(scores.device)
+    if batch_offset is not None:
+        fill = fill.index_select(
+            0, torch.as_tensor(batch_offset, device=fill.device))
+    if batch_dim != 0:
+        scores_ = scores.transpose(0, batch_dim)
+    else:
+        scores_ = scores
+    copy = scores_.narrow(-1, offset, scores_.size(-1) - offset)
+    cvocab = copy.size(-1)
+    if fill.size(1) < cvocab:
+        fill = torch.nn.functional.pad(fill, (0, cvocab - fill.size(1)))
+    fill = fill[:, :cvocab]
+    fill = fill.view(fill.size(0), *[1] * (copy.dim() - 2), cvocab) \
+        .expand_as(copy)
+    blank = fill.ne(0)
+    scores_.narrow(-1, 0, offset).scatter_add_(
+        -1, fill, copy.masked_fill(~blank, 0))
+    copy.masked_fill_(blank, 1e-10)
     return scores
 
 
@@ -230,7 +231,7 @@ class CopyGeneratorLossCompute(NMTLossCompute):
         # and is used only for stats
         scores_data = collapse_copy_scores(
             self._unbottle(scores.clone(), batch.batch_size),
-            batch, self.tgt_vocab, None)
+            batch, self.tgt_vocab)
         scores_data = self._bottle(scores_data)
 
         # this block does not depend on the loss value computed above
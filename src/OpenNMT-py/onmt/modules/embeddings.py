@@ -35,7 +35,7 @@ class PositionalEncoding(nn.Module):
         self.dropout = nn.Dropout(p=dropout)
         self.dim = dim
 
-    def forward(self, emb, step=None):
+    def forward(self, emb, step=None, positions=None):
         """Embed inputs.
 
         Args:
@@ -43,10 +43,14 @@ class PositionalEncoding(nn.Module):
                 ``(seq_len, batch_size, self.dim)``
             step (int or NoneType): If stepwise (``seq_len = 1``), use
                 the encoding for this position.
+            positions (LongTensor or NoneType): Position of each word
+                ``(seq_len, batch_size)``, for packed rows.
         """
 
         emb = emb * math.sqrt(self.dim)
-        if step is None:
+        if positions is not None:
+            emb = emb + self.pe[positions, 0]
+        elif step is None:
             emb = emb + self.pe[:emb.size(0)]
         else:
             emb = emb + self.pe[step]
@@ -257,11 +261,14 @@ class Embeddings(nn.Module):
             else:
                 self.word_lut.weight.data.copy_(pretrained)
 
-    def forward(self, source, step=None):
+    def forward(self, source, step=None, positions=None):
         """Computes the embeddings for words and features.
 
         Args:
             source (LongTensor): index tensor ``(len, batch, nfeat)``
+            step (int or NoneType): See :class:`PositionalEncoding`.
+            positions (LongTensor or NoneType): See
+                :class:`PositionalEncoding`.
 
         Returns:
             FloatTensor: Word embeddings ``(len, batch, embedding_size)``
@@ -270,7 +277,7 @@ class Embeddings(nn.Module):
         if self.position_encoding:
             for i, module in enumerate(self.make_embedding._modules.values()):
                 if i == len(self.make_embedding._modules.values()) - 1:
-                    source = module(source, step=step)
+                    source = module(source, step=step, positions=positions)
                 else:
                     source = module(source)
         else:
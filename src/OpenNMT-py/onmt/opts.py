@@ -67,8 +67,10 @@ def model_opts(parser):
                    "the system to incorporate non-text inputs. "
                    "Options are [text|img|audio|vec].")
     group.add('--model_dtype', '-model_dtype', default='fp32',
-              choices=['fp32', 'fp16'],
-              help='Data type of the model.')
+              choices=['fp32', 'fp16', 'bf16'],
+              help='Data type of the model. bf16 keeps fp32 weights and '
+                   'runs the matmuls under bfloat16 autocast, on CPU '
+                   'or GPU.')
 
     group.add('--encoder_type', '-encoder_type', type=str, default='rnn',
               choices=['rnn', 'brnn', 'ggnn', 'mean', 'transformer', 'cnn'],
@@ -270,6 +272,13 @@ def preprocess_opts(parser):
     group.add('--num_threads', '-num_threads', type=int, default=1,
               help="Number of shards to build in parallel.")
 
+    group.add('--shard_format', '-shard_format', default='pt',
+              choices=['pt', 'bin'],
+              help="Format of the saved shards: pickled `Dataset` objects "
+                   "(pt) or memory-mappable token ids and offsets (bin). "
+                   "bin shards only support text data without features "
+                   "or alignments.")
+
     group.add('--overwrite', '-overwrite', action="store_true",
               help="Overwrite existing shards if any.")
 
@@ -366,6 +375,82 @@ def preprocess_opts(parser):
               help="mask will need to be inverted if prefix is joiner")
 
 
+def compile_opts(parser):
+    """ Options to compile tab-separated corpora into numericalized shards """
+    group = parser.add_argument_group('Data')
+    group.add('--train', '-train', required=True,
+              help="Path to the training corpus, one example per line as "
+                   "tab-separated source, target and optional category.")
+    group.add('--valid', '-valid',
+              help="Path to the validation corpus, same format as -train.")
+    group.add('--eval', '-eval', nargs='+', default=[],
+              help="Extra corpora to compile, e.g. test sets. Each one is "
+                   "saved under the name of its file without extension.")
+    group.add('--save_data', '-save_data', required=True,
+              help="Output prefix for the shards and vocabulary")
+
+    group = parser.add_argument_group('Vocab')
+    group.add('--vocab_corpora', '-vocab_corpora', nargs='+', default=None,
+              help="Corpora whose tokens make up the vocabulary. Defaults "
+                   "to every compiled corpus, like the vocabulary files "
+                   "written by scripts/reformat_data_for_opennmt.py.")
+    group.add('--src_vocab', '-src_vocab', default="",
+              help="Path to an existing source vocabulary. Format: "
+                   "one word per line.")
+    group.add('--tgt_vocab', '-tgt_vocab', default="",
+              help="Path to an existing target vocabulary. Format: "
+                   "one word per line.")
+    group.add('--src_vocab_size', '-src_vocab_size', type=int, default=50000,
+              help="Size of the source vocabulary")
+    group.add('--tgt_vocab_size', '-tgt_vocab_size', type=int, default=50000,
+              help="Size of the target vocabulary")
+    group.add('--vocab_size_multiple', '-vocab_size_multiple',
+              type=int, default=1,
+              help="Make the vocabulary size a multiple of this value")
+    group.add('--src_words_min_frequency',
+              '-src_words_min_frequency', type=int, default=0)
+    group.add('--tgt_words_min_frequency',
+              '-tgt_words_min_frequency', type=int, default=0)
+    group.add('--share_vocab', '-share_vocab', action='store_true',
+              help="Share source and target vocabulary")
+
+    group = parser.add_argument_group('Logging')
+    group.add('--log_file', '-log_file', type=str, default="",
+              help="Output logs to a file under this path.")
+
+
+def sweep_opts(parser):
+    """ Options to sweep training runs over seeds and option values """
+    group = parser.add_argument_group('Sweep')
+    group.add('--sweep_dir', '-sweep_dir', required=True,
+              help="Output directory, with one subdirectory per run for "
+                   "its checkpoints and log, and the result tables.")
+    group.add('--seeds', '-seeds', type=int, nargs='+', default=[1],
+              help="Random seeds to train each setting with.")
+    group.add('--grid', '-grid', nargs='*', default=[],
+              help="Training options to sweep, as OPTION=V1,V2,... "
+                   "e.g. 'layers=2,4' 'data=d/1_example,d/100_example'. "
+                   "Runs cover every combination of values and seeds. "
+                   "Values of multi-valued options are separated by "
+                   "spaces, flags take true/false. Other training options "
+                   "given to the sweep are shared by all runs.")
+    group.add('--eval_sets', '-eval_sets', nargs='*',
+              default=['valid', 'test', 'gen'],
+              help="Corpora of -data to compute the greedy exact match "
+                   "of the final model on, e.g. compiled with "
+                   "compile_corpus.py -eval. Missing ones are skipped.")
+    group.add('--workers', '-workers', type=int, default=0,
+              help="Runs trained at once. Defaults to one per GPU of "
+                   "-gpus, or one per available CPU core.")
+    group.add('--gpus', '-gpus', type=int, nargs='*', default=[],
+              help="GPUs to train on, one run on each at a time. "
+                   "Runs train on CPU otherwise.")
+    group.add('--shm_dir', '-shm_dir', default='/dev/shm',
+              help="Directory backed by shared memory, where the corpora "
+                   "are staged once as memory-mapped shards for all the "
+                   "runs to map.")
+
+
 def train_opts(parser):
     """ Training and saving options """
 
@@ -376,11 +461,28 @@ def train_opts(parser):
 
     group.add('--data_ids', '-data_ids', nargs='+', default=[None],
               help="In case there are several corpora.")
+    group.add('--shard_format', '-shard_format', default='auto',
+              choices=['auto', 'pt', 'bin'],
+              help="Format of the shards to read, see preprocess.py. "
+                   "auto uses pickled .pt shards when there are some, "
+                   "memory-mapped .bin shards otherwise.")
     group.add('--data_weights', '-data_weights', type=int, nargs='+',
               default=[1], help="""Weights of different corpora,
               should follow the same order as in -data_ids.""")
     group.add('--data_to_noise', '-data_to_noise', nargs='+', default=[],
               help="IDs of datasets on which to apply noise.")
+    group.add('--num_workers', '-num_workers', type=int, default=0,
+              help="Number of background processes padding and "
+                   "numericalizing batches while the model trains. "
+                   "0 builds them in the training process. "
+                   "Requires torch>=1.7.")
+    group.add('--prefetch', '-prefetch', type=int, default=2,
+              help="Number of batches each -num_workers process keeps "
+                   "ready in advance.")
+    group.add('--preload_tensors', '-preload_tensors', action='store_true',
+              help="Load the whole train and valid corpora once, as "
+                   "padded tensors on the training device, and make "
+                   "batches by slicing them. For small text corpora.")
 
     group.add('--save_model', '-save_model', default='model',
               help="Model filename (the model will be saved as "
@@ -392,6 +494,14 @@ def train_opts(parser):
               help="""Save a checkpoint every X steps""")
     group.add('--keep_checkpoint', '-keep_checkpoint', type=int, default=-1,
               help="Keep X checkpoints (negative: keep all)")
+    group.add('--sync_checkpoint', '-sync_checkpoint', action='store_true',
+              help="Write checkpoints on the training thread. By default "
+                   "they are copied to CPU and written in the background.")
+    group.add('--checkpoint_vocab', '-checkpoint_vocab', default='inline',
+              choices=['inline', 'shared'],
+              help="Save the vocab in each checkpoint (inline), or once "
+                   "per run in <save_model>_vocab_<hash>.pt, which the "
+                   "checkpoints refer to and must be kept next to (shared).")
 
     # GPU
     group.add('--gpuid', '-gpuid', default=[], nargs='*', type=int,
@@ -399,7 +509,9 @@ def train_opts(parser):
     group.add('--gpu_ranks', '-gpu_ranks', default=[], nargs='*', type=int,
               help="list of ranks of each process.")
     group.add('--world_size', '-world_size', default=1, type=int,
-              help="total number of distributed processes.")
+              help="total number of distributed processes. Without "
+                   "-gpu_ranks, this many CPU processes are started "
+                   "(with the gloo backend).")
     group.add('--gpu_backend', '-gpu_backend',
               default="nccl", type=str,
               help="Type of torch distributed backend")
@@ -409,12 +521,29 @@ def train_opts(parser):
               help="IP of master for torch.distributed training.")
     group.add('--master_port', '-master_port', default=10000, type=int,
               help="Port of master for torch.distributed training.")
+    group.add('--reduce_after_backward', '-reduce_after_backward',
+              action='store_true',
+              help="In multi-process training, all-reduce gradients once "
+                   "backward is done, instead of in buckets during "
+                   "backward. Always the case before torch 2.1.")
     group.add('--queue_size', '-queue_size', default=40, type=int,
-              help="Size of queue for each process in producer/consumer")
+              help="Deprecated, each process reads its own batches.")
 
     group.add('--seed', '-seed', type=int, default=-1,
               help="Random seed used for the experiments "
                    "reproducibility.")
+    group.add('--replicas', '-replicas', type=int, default=1,
+              help="Train this many independently initialized replicas "
+                   "of the model at once, replica k with seed -seed + k. "
+                   "Each has its own optimizer, early stopping and "
+                   "checkpoints, saved as <save_model>_replica<k>. "
+                   "Transformers are stacked and vmapped, other models "
+                   "run one after the other.")
+    group.add('--replica_data_order', '-replica_data_order',
+              default='same', choices=['same', 'different'],
+              help="Train all the replicas on the batches of replica 0, "
+                   "or each on its own, in the order of a single run "
+                   "with its seed.")
 
     # Init options
     group = parser.add_argument_group('Initialization')
@@ -460,11 +589,19 @@ def train_opts(parser):
                    "is sents. Tokens will do dynamic batching")
     group.add('--pool_factor', '-pool_factor', type=int, default=8192,
               help="""Factor used in data loading and batch creations.
-              It will load the equivalent of `pool_factor` batches,
-              sort them by the according `sort_key` to produce
-              homogeneous batches and reduce padding, and yield
-              the produced batches in a shuffled way.
+              Text shards are batched as a whole, from their length
+              index. Other data, and the mix of corpora weighted by
+              -data_weights, load the equivalent of `pool_factor`
+              batches, sort them by length to produce homogeneous
+              batches and reduce padding, and yield the produced
+              batches in a shuffled way.
               Inspired by torchtext's pool mechanism.""")
+    group.add('--pack_length', '-pack_length', type=int, default=0,
+              help="Pack the examples of each training batch into rows "
+                   "of up to this many source and target tokens, with "
+                   "attention masked and positions reset between "
+                   "examples. For short sentences; transformers only. "
+                   "0 disables packing.")
     group.add('--normalization', '-normalization', default='sents',
               choices=["sents", "tokens"],
               help='Normalization method of the gradient.')
@@ -495,7 +632,14 @@ def train_opts(parser):
               help='Number of validation steps without improving.')
     group.add('--early_stopping_criteria', '-early_stopping_criteria',
               nargs="*", default=None,
-              help='Criteria to use for early stopping.')
+              choices=['ppl', 'accuracy', 'loss', 'exact_match'],
+              help='Criteria to use for early stopping. exact_match is '
+                   'the share of validation targets that greedy decoding '
+                   'reproduces, see -valid_exact_match.')
+    group.add('--valid_exact_match', '-valid_exact_match',
+              action='store_true',
+              help="Also report the exact match of greedy decoding in "
+                   "validation. Implied by the exact_match criterion.")
     group.add('--optim', '-optim', default='sgd',
               choices=['sgd', 'adagrad', 'adadelta', 'adam',
                        'sparseadam', 'adafactor', 'fusedadam'],
@@ -554,6 +698,9 @@ def train_opts(parser):
               help="Step for moving average. "
                    "Default is every update, "
                    "if -average_decay is set.")
+    group.add('--average_offload', '-average_offload', action='store_true',
+              help="Keep the moving average on CPU, updated from copies "
+                   "made on a side CUDA stream, to save GPU memory.")
     group.add("--src_noise", "-src_noise", type=str, nargs='+',
               default=[],
               choices=onmt.modules.source_noise.MultiNoise.NOISES.keys())
@@ -606,6 +753,14 @@ def train_opts(parser):
               type=str, default="runs/onmt",
               help="Log directory for Tensorboard. "
                    "This is also the name of the run.")
+    group.add('--phase_timing', '-phase_timing', action="store_true",
+              help="Time the phases of the training steps (data, "
+                   "forward, loss, backward, all_reduce, optim, "
+                   "checkpoint), synchronizing CUDA at their boundaries. "
+                   "Their mean, median and 95th percentile in ms per step "
+                   "are reported every -report_every steps, and written "
+                   "for the whole training to "
+                   "<save_model>_phase_timing.json.")
 
     group = parser.add_argument_group('Speech')
     # Options most relevant to speech
@@ -632,6 +787,10 @@ def translate_opts(parser):
     group.add('--fp32', '-fp32', action='store_true',
               help="Force the model to be in FP32 "
                    "because FP16 is very slow on GTX1080(ti).")
+    group.add('--bf16', '-bf16', action='store_true',
+              help="Translate under bfloat16 autocast: fp32 weights, "
+                   "bfloat16 matmuls. Pays off on CPUs with AVX512-BF16/AMX "
+                   "for wide models; small models can decode slower.")
     group.add('--avg_raw_probs', '-avg_raw_probs', action='store_true',
               help="If this is set, during ensembling scores from "
                    "different models will be combined by averaging their "
@@ -1,11 +1,16 @@
 import unittest
-from onmt.modules.copy_generator import CopyGenerator, CopyGeneratorLoss
+from onmt.modules.copy_generator import CopyGenerator, CopyGeneratorLoss, \
+    collapse_copy_scores
+from onmt.inputters.dataset_base import CopyVocabs
 
 import itertools
+from argparse import Namespace
+from collections import Counter
 from copy import deepcopy
 
 import torch
 from torch.nn.functional import softmax
+from torchtext.vocab import Vocab
 
 from onmt.tests.utils_for_tests import product_dict
 
@@ -134,3 +139,30 @@ class TestCopyGeneratorLoss(unittest.TestCase):
             dummy_in = self.dummy_inputs(params, init_case)
             res = loss(*dummy_in)
             self.assertTrue((res >= 0).all())
+
+
+class TestCollapseCopyScores(unittest.TestCase):
+    SPECIALS = ["<unk>", "<blank>"]
+
+    def test_copies_are_added_to_target_words(self):
+        tgt_vocab = Vocab(Counter(["a", "c"]), specials=self.SPECIALS)
+        src_vocabs = [Vocab(Counter(src), specials=self.SPECIALS)
+                      for src in [["b", "a", "c"], ["c"]]]
+        batch = Namespace(src_ex_vocab=CopyVocabs.from_vocabs(src_vocabs))
+        offset = len(tgt_vocab)
+        for batch_dim, batch_offset in [(1, None), (0, None), (0, [1])]:
+            size = [3, 3]
+            size[batch_dim] = 1 if batch_offset else 2
+            scores = torch.rand(*size, offset + 5)
+            expected = scores.clone()
+            for b, src_b in enumerate(batch_offset or range(2)):
+                score = expected[:, b] if batch_dim == 1 else expected[b]
+                for i, w in enumerate(src_vocabs[src_b].itos[1:], 1):
+                    ti = tgt_vocab.stoi[w]
+                    if ti != 0:
+                        score[:, ti] += score[:, offset + i]
+                        score[:, offset + i] = 1e-10
+            res = collapse_copy_scores(scores, batch, tgt_vocab,
+                                       batch_dim=batch_dim,
+                                       batch_offset=batch_offset)
+            self.assertTrue(res.allclose(expected))
@@ -0,0 +1,103 @@
+import os
+import tempfile
+import unittest
+
+import torch
+import torch.distributed
+import torch.multiprocessing as mp
+
+from onmt.utils.distributed import GradientReducer, all_gather_list
+from onmt.utils.statistics import Statistics
+
+
+def _check_reductions(rank, world_size, init_file):
+    torch.distributed.init_process_group(
+        "gloo", init_method="file://" + init_file,
+        world_size=world_size, rank=rank)
+    # larger than the old 64KB limit
+    gathered = all_gather_list(["x" * (70000 * (rank + 1))])
+    assert [len(x[0]) for x in gathered] == [70000, 140000]
+
+    stat = Statistics(loss=1.5 * (rank + 1), n_words=10, n_correct=rank)
+    stat.n_src_words = 7
+    stat.n_steps = 1
+    stat.data_wait = 0.25
+    stat.n_tokens, stat.n_padding = 40, rank
+    stat.n_sents, stat.n_exact = 3, rank + 1
+    total = Statistics.all_gather_stats(stat)
+    values = [getattr(total, name) for name in Statistics.REDUCED]
+    assert values == [4.5, 20, 1, 14, 2, 0.5, 80, 1, 6, 3], values
+    assert isinstance(total.n_words, int)
+    # the statistics of the process are left as they were
+    assert stat.loss == 1.5 * (rank + 1)
+
+
+def _backward(body, generator, x, sharded):
+    out = body(x)
+    if not sharded:
+        generator(out).pow(2).sum().backward()
+        return
+    # as the sharded loss computation does
+    leaf = out.detach().requires_grad_()
+    for shard in leaf.split(2):
+        generator(shard).pow(2).sum().backward()
+    out.backward(leaf.grad)
+
+
+def _check_grad_reducer(rank, world_size, init_file):
+    torch.distributed.init_process_group(
+        "gloo", init_method="file://" + init_file,
+        world_size=world_size, rank=rank)
+    torch.manual_seed(rank + 1)
+    inputs = [torch.randn(6, 3) for _ in range(2)]
+    for sharded, tied in [(False, False), (True, False), (True, True)]:
+        torch.manual_seed(0)
+        body = torch.nn.Sequential(
+            torch.nn.Linear(3, 5), torch.nn.Tanh(), torch.nn.Linear(5, 5))
+        generator = torch.nn.Linear(5, 4)
+        late, final = list(generator.parameters()) if sharded else [], []
+        if tied:
+            # as -share_decoder_embeddings
+            generator = torch.nn.Linear(5, 5)
+            generator.weight = body[2].weight
+            late, final = [generator.bias], [generator.weight]
+        params = list(body.parameters()) + [
+            p for p in generator.parameters()
+            if all(p is not q for q in body.parameters())]
+        # reference: accumulate, then reduce everything
+        for x in inputs:
+            _backward(body, generator, x, sharded)
+        expected = [p.grad.clone() for p in params]
+        for grad in expected:
+            torch.distributed.all_reduce(grad)
+        for p in params:
+            p.grad = None
+
+        # small buckets, to launch several during backward
+        reducer = GradientReducer(params, late, final, bucket_size=64)
+        for k, x in enumerate(inputs):
+            reducer.arm(k == len(inputs) - 1)
+            _backward(body, generator, x, sharded)
+        # all launched by the hooks, but the final ones
+        assert reducer._launched == len(reducer.buckets) - bool(final)
+        reducer.finish()
+        for p, grad in zip(params, expected):
+            assert torch.allclose(p.grad, grad), (sharded, tied, p.grad, grad)
+
+
+class TestDistributed(unittest.TestCase):
+    def test_gloo_reductions(self):
+        # failures in the processes are raised here
+        with tempfile.TemporaryDirectory() as tmp:
+            mp.start_processes(
+                _check_reductions, args=(2, os.path.join(tmp, "init")),
+                nprocs=2, start_method="spawn")
+
+    @unittest.skipUnless(
+        hasattr(torch.Tensor, "register_post_accumulate_grad_hook"),
+        "requires torch>=2.1")
+    def test_gradient_reducer(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            mp.start_processes(
+                _check_grad_reducer, args=(2, os.path.join(tmp, "init")),
+                nprocs=2, start_method="spawn")
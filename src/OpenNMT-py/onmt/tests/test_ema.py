@@ -0,0 +1,90 @@
+import unittest
+
+import torch
+
+from onmt.utils import ExponentialMovingAverage
+
+
+class TestExponentialMovingAverage(unittest.TestCase):
+    def model(self):
+        torch.manual_seed(0)
+        model = torch.nn.Sequential(
+            torch.nn.Linear(4, 8), torch.nn.LayerNorm(8))
+        model.generator = torch.nn.Linear(8, 3)
+        return model
+
+    def step(self, model):
+        with torch.no_grad():
+            for param in model.parameters():
+                param.add_(torch.randn_like(param))
+
+    def test_update(self):
+        model = self.model()
+        ema = ExponentialMovingAverage(model, 1e-1)
+        expected = None
+        for step in range(1, 30):
+            self.step(model)
+            ema.update(step)
+            params = [p.detach().clone() for p in model.parameters()]
+            if expected is None:
+                expected = params
+            else:
+                decay = max(1e-1, 1 - (step + 1) / (step + 10))
+                expected = [(1 - decay) * avg + param * decay
+                            for avg, param in zip(expected, params)]
+        for avg, exp in zip(ema.shadow, expected):
+            self.assertTrue(torch.allclose(avg, exp, atol=1e-6))
+
+    @unittest.skipUnless(torch.cuda.is_available(), "needs CUDA")
+    def test_offloaded_update(self):
+        model = self.model().cuda()
+        ema = ExponentialMovingAverage(model, 1e-1, device="cpu")
+        expected = None
+        for step in range(1, 30):
+            # in place on the current stream, as an optimizer step
+            ema.wait_for_copies()
+            self.step(model)
+            ema.update(step)
+            params = [p.detach().cpu() for p in model.parameters()]
+            if expected is None:
+                expected = params
+            else:
+                decay = max(1e-1, 1 - (step + 1) / (step + 10))
+                expected = [(1 - decay) * avg + param * decay
+                            for avg, param in zip(expected, params)]
+        ema.synchronize()
+        for avg, exp in zip(ema.shadow, expected):
+            self.assertEqual(avg.device.type, "cpu")
+            self.assertTrue(torch.allclose(avg, exp, atol=1e-6))
+
+    def test_module(self):
+        model = self.model()
+        ema = ExponentialMovingAverage(model, 1e-1)
+        ema.update(1)
+        module = ema.module()
+        for step in range(2, 5):
+            self.step(model)
+            ema.update(step)
+        self.assertIs(ema.module(), module)
+        for avg, param, shadow in zip(ema.shadow, model.parameters(),
+                                      module.parameters()):
+            self.assertEqual(shadow.data_ptr(), avg.data_ptr())
+            self.assertFalse(param.equal(avg))
+        self.assertIsNot(module.generator, model.generator)
+        x = torch.randn(2, 4)
+        self.assertFalse(module(x).equal(model(x)))
+
+    def test_resume(self):
+        model = self.model()
+        ema = ExponentialMovingAverage(model, 1e-1)
+        for step in range(1, 4):
+            self.step(model)
+            ema.update(step)
+        state = ema.state_dict()
+        resumed = self.model()
+        resumed.load_state_dict(ema.module().state_dict())
+        other = ExponentialMovingAverage(resumed, 1e-1)
+        other.load_state_dict(state)
+        self.assertEqual(other.updates, 3)
+        for avg, exp in zip(other.shadow, ema.shadow):
+            self.assertTrue(avg.equal(exp))
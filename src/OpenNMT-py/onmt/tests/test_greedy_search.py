@@ -1,7 +1,14 @@
 import unittest
-from onmt.translate.greedy_search import GreedySearch
+from collections import Counter
+from onmt.translate.greedy_search import GreedySearch, greedy_exact_match
 
 import torch
+from torchtext.vocab import Vocab
+
+import onmt
+import onmt.opts
+from onmt.model_builder import build_base_model
+from onmt.utils.parse import ArgumentParser
 
 
 class TestGreedySearch(unittest.TestCase):
@@ -214,3 +221,55 @@ class TestGreedySearch(unittest.TestCase):
                     if b != 0 and b != 8:
                         self.assertEqual(samp.scores[b], [0])
                 self.assertTrue(samp.done)
+
+
+class TestGreedyExactMatch(unittest.TestCase):
+    def build_model(self, encoder_type, decoder_type):
+        parser = ArgumentParser()
+        onmt.opts.model_opts(parser)
+        onmt.opts.train_opts(parser)
+        opt = parser.parse_known_args(['-data', 'dummy'])[0]
+        for param, setting in [('decoder_type', decoder_type),
+                               ('encoder_type', encoder_type),
+                               ('word_vec_size', 16),
+                               ('rnn_size', 16),
+                               ('layers', 2),
+                               ('position_encoding', True)]:
+            setattr(opt, param, setting)
+        ArgumentParser.update_model_opts(opt)
+        fields = onmt.inputters.get_fields("text", 0, 0)
+        for side in ["src", "tgt"]:
+            fields[side].base_field.vocab = Vocab(
+                Counter("abcdefgh"), specials=["<unk>", "<blank>"])
+        return build_base_model(opt, fields, False).eval()
+
+    def check(self, model):
+        torch.manual_seed(0)
+        batch_size, steps, pad = 6, 7, 99
+        lengths = torch.tensor([5, 5, 5, 4, 3, 2])
+        src = torch.randint(2, 10, (5, batch_size, 1))
+        # the greedy predictions, decoding the whole prefix at each step
+        tgt = torch.full((1, batch_size, 1), 2)
+        with torch.no_grad():
+            for _ in range(steps):
+                out, _ = model(src, torch.cat([tgt, tgt[-1:]]), lengths)
+                pred = model.generator(out[-1]).argmax(-1)
+                tgt = torch.cat([tgt, pred.view(1, -1, 1)])
+        # as targets, to their end or not
+        for i, end in enumerate([8, 3, 5, 8, 2, 6]):
+            tgt[end:, i] = pad
+        expected = torch.ones(batch_size, dtype=torch.bool)
+        tgt[2, 0] = 10 if tgt[2, 0] != 10 else 11
+        expected[0] = False
+        with torch.no_grad():
+            enc_state, memory_bank, memory_lengths = model.encoder(
+                src, lengths)
+            match = greedy_exact_match(model, src, enc_state, memory_bank,
+                                       memory_lengths, tgt, pad)
+        self.assertTrue(match.equal(expected))
+
+    def test_transformer(self):
+        self.check(self.build_model("transformer", "transformer"))
+
+    def test_rnn(self):
+        self.check(self.build_model("brnn", "rnn"))
@@ -0,0 +1,60 @@
+import unittest
+
+import torch
+
+from onmt.utils.loss import FusedLabelSmoothingLoss, LabelSmoothingLoss, \
+    shards
+
+
+class TestFusedLabelSmoothingLoss(unittest.TestCase):
+    def check(self, label_smoothing, vocab_size=50, pad=1, chunk_size=512):
+        torch.manual_seed(0)
+        logits = torch.randn(40, vocab_size, dtype=torch.float64) * 3
+        target = torch.randint(0, vocab_size, (40,))
+        target[::7] = pad
+        reference = LabelSmoothingLoss(
+            label_smoothing, vocab_size, ignore_index=pad).double()
+        fused = FusedLabelSmoothingLoss(
+            label_smoothing, vocab_size, ignore_index=pad,
+            chunk_size=chunk_size)
+
+        x = logits.clone().requires_grad_()
+        expected = reference(torch.log_softmax(x, 1), target)
+        expected.backward()
+        y = logits.clone().requires_grad_()
+        loss = fused(y, target)
+        loss.backward()
+        self.assertTrue(torch.allclose(loss, expected))
+        self.assertTrue(torch.allclose(y.grad, x.grad))
+
+    def test_matches_label_smoothing_loss(self):
+        self.check(0.1)
+
+    def test_full_smoothing(self):
+        self.check(1.0)
+
+    def test_chunks(self):
+        self.check(0.1, chunk_size=6)
+
+
+class TestShards(unittest.TestCase):
+    def test_grad_matches_unsharded(self):
+        torch.manual_seed(0)
+        weight = torch.randn(8, 5, requires_grad=True)
+        x = torch.randn(7, 3, 8)
+        target = torch.randint(0, 5, (7, 3))
+
+        (x @ weight).log_softmax(-1).sum().backward()
+        expected = weight.grad.clone()
+        weight.grad = None
+
+        output = x @ weight
+        state = {"output": output, "target": target}
+        start = output.data_ptr()
+        end = start + output.numel() * output.element_size()
+        for shard in shards(state, 2):
+            # a view of the output, not a copy
+            self.assertIsNotNone(shard["output"]._base)
+            self.assertTrue(start <= shard["output"].data_ptr() < end)
+            shard["output"].log_softmax(-1).sum().backward()
+        self.assertTrue(torch.allclose(weight.grad, expected))
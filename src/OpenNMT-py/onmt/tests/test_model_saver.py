@@ -0,0 +1,76 @@
+import os
+import shutil
+import tempfile
+import unittest
+from collections import Counter
+
+import torch
+from torchtext.vocab import Vocab
+
+import onmt
+from onmt.models.model_saver import ModelSaver, load_checkpoint
+
+
+class _Optim(object):
+    def __init__(self, model):
+        self.state = {"exp_avg": [torch.zeros_like(p)
+                                  for p in model.parameters()]}
+
+    def state_dict(self):
+        return self.state
+
+
+class TestBackgroundModelSaver(unittest.TestCase):
+    checkpoint_vocab = "inline"
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.model = torch.nn.Sequential(torch.nn.Linear(4, 4))
+        self.model.generator = torch.nn.Linear(4, 3)
+        fields = onmt.inputters.get_fields("text", 0, 0)
+        for side in ["src", "tgt"]:
+            fields[side].base_field.vocab = Vocab(Counter("abc"))
+        self.saver = ModelSaver(
+            os.path.join(self.dir, "m"), self.model, None, fields,
+            _Optim(self.model), keep_checkpoint=2, background=True,
+            checkpoint_vocab=self.checkpoint_vocab)
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def test_save(self):
+        for step in range(1, 4):
+            with torch.no_grad():
+                self.model.generator.bias.fill_(step)
+            self.saver.save(step)
+        # training goes on while the last checkpoint is written
+        with torch.no_grad():
+            self.model.generator.bias.fill_(10)
+        self.saver.wait()
+        self.assertEqual(sorted(os.listdir(self.dir)),
+                         ["m_step_2.pt", "m_step_3.pt"])
+        checkpoint = torch.load(os.path.join(self.dir, "m_step_3.pt"))
+        self.assertTrue(checkpoint["generator"]["bias"].eq(3).all())
+        self.assertEqual(len(checkpoint["optim"]["exp_avg"]), 4)
+
+
+class TestSharedVocabModelSaver(TestBackgroundModelSaver):
+    checkpoint_vocab = "shared"
+
+    def test_save(self):
+        for step in range(1, 4):
+            self.saver.save(step, best=step == 1)
+        self.saver.wait()
+        files = sorted(os.listdir(self.dir))
+        self.assertEqual(files[:3],
+                         ["m_best.pt", "m_step_2.pt", "m_step_3.pt"])
+        self.assertTrue(files[3].startswith("m_vocab_"))
+        self.assertEqual(len(files), 4)
+        for name in ["m_best.pt", "m_step_3.pt"]:
+            path = os.path.join(self.dir, name)
+            self.assertNotIn("vocab", torch.load(path))
+            checkpoint = load_checkpoint(path)
+            self.assertNotIn("vocab_ref", checkpoint)
+            self.assertEqual(
+                checkpoint["vocab"]["src"].base_field.vocab.itos,
+                self.saver.fields["src"].base_field.vocab.itos)
@@ -11,6 +11,8 @@ from onmt.model_builder import build_embeddings, \
     build_encoder, build_decoder
 from onmt.encoders.image_encoder import ImageEncoder
 from onmt.encoders.audio_encoder import AudioEncoder
+from onmt.modules.util_class import Cast
+from onmt.utils.misc import autocast
 from onmt.utils.parse import ArgumentParser
 
 parser = ArgumentParser(description='train.py')
@@ -213,6 +215,42 @@ class TestModel(unittest.TestCase):
         self.assertEqual(type(outputs), torch.Tensor)
 
 
+class TestBf16Autocast(unittest.TestCase):
+    def test_transformer_matches_fp32(self):
+        torch.manual_seed(0)
+        bf16_opt = copy.deepcopy(opt)
+        for param, setting in [('decoder_type', 'transformer'),
+                               ('encoder_type', 'transformer'),
+                               ('src_word_vec_size', 16),
+                               ('tgt_word_vec_size', 16),
+                               ('rnn_size', 16),
+                               ('position_encoding', True)]:
+            setattr(bf16_opt, param, setting)
+        ArgumentParser.update_model_opts(bf16_opt)
+        bf16_opt.enc_rnn_size = bf16_opt.dec_rnn_size = 16
+        src = onmt.inputters.get_fields("text", 0, 0)["src"]
+        src.base_field.build_vocab([])
+        model = onmt.models.model.NMTModel(
+            build_encoder(bf16_opt, build_embeddings(bf16_opt, src)),
+            build_decoder(bf16_opt, build_embeddings(
+                bf16_opt, src, for_encoder=False)))
+        generator = torch.nn.Sequential(
+            torch.nn.Linear(16, 4), Cast(torch.float32),
+            torch.nn.LogSoftmax(dim=-1))
+        model.eval()
+
+        test_src = torch.randint(0, 2, (5, 3, 1))
+        test_tgt = torch.randint(0, 2, (5, 3, 1))
+        lengths = torch.full((3,), 5, dtype=torch.long)
+        with torch.no_grad():
+            expected = generator(model(test_src, test_tgt, lengths)[0])
+            with autocast("bf16"):
+                log_probs = generator(model(test_src, test_tgt, lengths)[0])
+        self.assertEqual(next(model.parameters()).dtype, torch.float32)
+        self.assertEqual(log_probs.dtype, torch.float32)
+        self.assertTrue(torch.allclose(log_probs, expected, atol=5e-2))
+
+
 def _add_test(param_setting, methodname):
     """
     Adds a Test to TestModel according to settings
@@ -0,0 +1,134 @@
+import json
+import os
+import shutil
+import tempfile
+import unittest
+
+import numpy as np
+import torch
+from torchtext.data import Batch
+
+import onmt.inputters as inputters
+from onmt.bin import preprocess
+from onmt.bin.compile_corpus import _get_parser, compile_corpus
+from onmt.inputters.numeric_dataset import NumericBatch, NumericDataset, \
+    encode, load_shard, save_shard
+
+LINES = [
+    ("A cat ate the cake .", "cat ( x _ 1 ) AND eat . agent ( x _ 2 , x _ 1 )",
+     "in_distribution"),
+    ("Emma slept .", "sleep . agent ( x _ 1 , Emma )", "in_distribution"),
+    ("The dog gave Emma a cake .",
+     "* dog ( x _ 1 ) ; give . agent ( x _ 2 , x _ 1 )",
+     "prim_to_subj_proper"),
+]
+
+
+class TestNumericShard(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def test_save_load_roundtrip(self):
+        symbols = {}
+        ids, offsets = encode([["a", "b"], [], ["b", "c", "a"]], symbols)
+        path = os.path.join(self.tmp, "x.bin")
+        save_shard(path, {"src": ids, "src_offsets": offsets,
+                          "empty": np.zeros(0, dtype=np.int16)},
+                   {"symbols": sorted(symbols, key=symbols.get)})
+        arrays, meta = load_shard(path)
+        self.assertEqual(meta["symbols"], ["a", "b", "c"])
+        self.assertEqual(arrays["src"].tolist(), [0, 1, 1, 2, 0])
+        self.assertEqual(arrays["src_offsets"].tolist(), [0, 2, 2, 5])
+        self.assertEqual(arrays["empty"].shape, (0,))
+
+    def test_compiled_batch_matches_torchtext_batch(self):
+        tsv = os.path.join(self.tmp, "train.tsv")
+        with open(tsv, "w") as f:
+            f.write("".join("\t".join(cols) + "\n" for cols in LINES))
+        save_data = os.path.join(self.tmp, "corpus")
+        opt = _get_parser().parse_args(
+            ["-train", tsv, "-save_data", save_data])
+        compile_corpus(opt)
+
+        fields = torch.load(save_data + ".vocab.pt")
+        dataset = NumericDataset.load(save_data + ".train.0.bin", fields)
+        self.assertEqual(len(dataset), len(LINES))
+        self.assertEqual(
+            [dataset.categories[c] for c in dataset.category],
+            [cols[2] for cols in LINES])
+
+        reader = inputters.str2reader["text"]()
+        reference = inputters.Dataset(
+            fields,
+            readers=[reader, reader],
+            data=[("src", [cols[0] for cols in LINES]),
+                  ("tgt", [cols[1] for cols in LINES])],
+            dirs=[None, None],
+            sort_key=inputters.str2sortkey["text"])
+        order = [2, 0, 1]
+        expected = Batch([reference[i] for i in order], reference)
+        batch = NumericBatch([dataset[i] for i in order], dataset)
+        self.assertTrue(expected.src[0].equal(batch.src[0]))
+        self.assertTrue(expected.src[1].equal(batch.src[1]))
+        self.assertTrue(expected.tgt.equal(batch.tgt))
+        self.assertTrue(expected.indices.equal(batch.indices))
+        self.assertTrue(expected.corpus_id.equal(batch.corpus_id))
+        self.assertEqual(inputters.text_sort_key(dataset[0]),
+                         inputters.text_sort_key(reference[0]))
+
+    def test_compiled_length_index(self):
+        tsv = os.path.join(self.tmp, "train.tsv")
+        with open(tsv, "w") as f:
+            f.write("".join("\t".join(cols) + "\n" for cols in LINES))
+        save_data = os.path.join(self.tmp, "corpus")
+        compile_corpus(_get_parser().parse_args(
+            ["-train", tsv, "-save_data", save_data]))
+
+        dataset = NumericDataset.load(save_data + ".train.0.bin")
+        self.assertEqual(dataset.lengths["src"].dtype, np.int16)
+        self.assertEqual(dataset.lengths["src"].tolist(),
+                         [len(cols[0].split()) for cols in LINES])
+        self.assertEqual(dataset.lengths["tgt"].tolist(),
+                         [len(cols[1].split()) for cols in LINES])
+        with open(save_data + ".train.lengths.json") as f:
+            summary = json.load(f)
+        self.assertEqual(summary["examples"], len(LINES))
+        self.assertEqual(summary["src"]["max"], 7)
+        self.assertEqual(sum(summary["tgt"]["counts"]), len(LINES))
+
+    def test_preprocess_bin_shards_match_pt_shards(self):
+        paths = {}
+        for side, col in [("src", 0), ("tgt", 1)]:
+            paths[side] = os.path.join(self.tmp, side + ".txt")
+            with open(paths[side], "w") as f:
+                f.write("".join(cols[col] + "\n" for cols in LINES))
+        datasets = {}
+        for fmt in ["pt", "bin"]:
+            save_data = os.path.join(self.tmp, fmt)
+            opt = preprocess._get_parser().parse_args(
+                ["-train_src", paths["src"], "-train_tgt", paths["tgt"],
+                 "-save_data", save_data, "-shard_format", fmt,
+                 "-tgt_seq_length", "19"])
+            preprocess.preprocess(opt)
+            fields = torch.load(save_data + ".vocab.pt")
+            path = save_data + ".train.0." + fmt
+            if fmt == "bin":
+                datasets[fmt] = NumericDataset.load(path, fields)
+            else:
+                datasets[fmt] = torch.load(path)
+                datasets[fmt].fields = fields
+
+        pt, bin_ = datasets["pt"], datasets["bin"]
+        # the last example is filtered out by -tgt_seq_length
+        self.assertEqual(len(pt), 2)
+        self.assertEqual(len(bin_), 2)
+        self.assertEqual(pt.fields["tgt"].base_field.vocab.itos,
+                         bin_.fields["tgt"].base_field.vocab.itos)
+        expected = Batch(list(pt), pt)
+        batch = NumericBatch(list(bin_), bin_)
+        self.assertTrue(expected.src[0].equal(batch.src[0]))
+        self.assertTrue(expected.tgt.equal(batch.tgt))
+        self.assertTrue(expected.indices.equal(batch.indices))
@@ -0,0 +1,97 @@
+import copy
+import unittest
+from collections import Counter
+
+import torch
+from torchtext.data import Batch
+from torchtext.vocab import Vocab
+
+import onmt
+import onmt.inputters
+import onmt.opts
+from onmt.inputters.packing import pack_batch, pack_rows
+from onmt.model_builder import build_embeddings, build_encoder, \
+    build_decoder
+from onmt.utils.misc import segment_positions
+from onmt.utils.parse import ArgumentParser
+
+
+class TestPackRows(unittest.TestCase):
+    def test_rows_fit(self):
+        src = [3, 9, 4, 2, 7, 5, 12]
+        tgt = [10, 30, 12, 8, 25, 15, 40]
+        rows = pack_rows(src, tgt, 32)
+        self.assertEqual(sorted(i for r in rows for i in r),
+                         list(range(len(src))))
+        for row in rows:
+            # the longest target does not fit 32 tokens: it gets its own
+            self.assertLessEqual(sum(tgt[i] for i in row), 40)
+            self.assertLessEqual(sum(src[i] for i in row), 32)
+        self.assertLess(len(rows), len(src))
+
+    def test_segment_positions(self):
+        segments = torch.tensor([[1, 1, 2, 2, 2, 0], [1, 2, 3, 3, 0, 0]]).t()
+        expected = torch.tensor([[0, 1, 0, 1, 2, 0], [0, 0, 0, 1, 0, 1]]).t()
+        self.assertTrue(segment_positions(segments).equal(expected))
+
+
+class TestPackedTransformer(unittest.TestCase):
+    def build_model(self):
+        parser = ArgumentParser()
+        onmt.opts.model_opts(parser)
+        onmt.opts.train_opts(parser)
+        opt = parser.parse_known_args(['-data', 'dummy'])[0]
+        opt = copy.deepcopy(opt)
+        for param, setting in [('decoder_type', 'transformer'),
+                               ('encoder_type', 'transformer'),
+                               ('word_vec_size', 16),
+                               ('rnn_size', 16),
+                               ('layers', 2),
+                               ('position_encoding', True)]:
+            setattr(opt, param, setting)
+        ArgumentParser.update_model_opts(opt)
+        opt.enc_rnn_size = opt.dec_rnn_size = 16
+        field = onmt.inputters.get_fields("text", 0, 0)["src"]
+        field.base_field.vocab = Vocab(
+            Counter("abcdefgh"), specials=["<unk>", "<blank>"])
+        model = onmt.models.model.NMTModel(
+            build_encoder(opt, build_embeddings(opt, field)),
+            build_decoder(opt, build_embeddings(
+                opt, field, for_encoder=False)))
+        return model.eval()
+
+    def batch(self, src_lengths, tgt_lengths, pad=1):
+        batch = Batch()
+        batch.batch_size = len(src_lengths)
+        src = torch.full((max(src_lengths), len(src_lengths), 1), pad)
+        tgt = torch.full((max(tgt_lengths), len(tgt_lengths), 1), pad)
+        for i, (s, t) in enumerate(zip(src_lengths, tgt_lengths)):
+            src[:s, i, 0] = torch.randint(2, 10, (s,))
+            tgt[:t, i, 0] = torch.randint(2, 10, (t,))
+        batch.src = (src, torch.tensor(src_lengths))
+        batch.tgt = tgt
+        return batch
+
+    def test_matches_unpacked(self):
+        torch.manual_seed(0)
+        model = self.build_model()
+        src_lengths, tgt_lengths = [3, 6, 2, 5, 4], [7, 12, 4, 9, 6]
+        batch = self.batch(src_lengths, tgt_lengths)
+        src, lengths = batch.src
+        with torch.no_grad():
+            expected, _ = model(src, batch.tgt, lengths)
+            packed = pack_batch(copy.copy(batch), 16, 1, 1)
+            src, lengths = packed.src
+            out, _ = model(src, packed.tgt, lengths,
+                           src_segments=packed.src_segments,
+                           tgt_segments=packed.tgt_segments)
+
+        rows = pack_rows(src_lengths, tgt_lengths, 16)
+        self.assertEqual(out.size(1), len(rows))
+        for r, row in enumerate(rows):
+            start = 0
+            for i in row:
+                n = tgt_lengths[i] - 1
+                self.assertTrue(torch.allclose(
+                    out[start:start + n, r], expected[:n, i], atol=1e-5))
+                start += tgt_lengths[i]
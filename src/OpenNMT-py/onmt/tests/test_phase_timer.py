@@ -0,0 +1,67 @@
+import json
+import os
+import shutil
+import tempfile
+import unittest
+
+from onmt.utils import PhaseTimer
+
+
+class TestPhaseTimer(unittest.TestCase):
+    def setUp(self):
+        self.timer = PhaseTimer()
+        self.clock = 0.
+        # a clock in seconds advanced by the test
+        self.timer._now = lambda: self.clock
+
+    def tick(self, ms):
+        self.clock += ms / 1000
+
+    def step(self, forward, backward, loss):
+        with self.timer("forward"):
+            self.tick(forward)
+        with self.timer("loss"):
+            self.tick(loss / 2)
+            with self.timer("backward"):
+                self.tick(backward)
+            self.tick(loss / 2)
+        self.timer.add("data", 0.001)
+        self.timer.end_step()
+
+    def test_nested_phases(self):
+        self.step(10, 30, 4)
+        summary = self.timer.summary()
+        self.assertAlmostEqual(summary["forward"]["mean"], 10)
+        self.assertAlmostEqual(summary["backward"]["mean"], 30)
+        self.assertAlmostEqual(summary["loss"]["mean"], 4)
+        self.assertAlmostEqual(summary["data"]["mean"], 1)
+        self.assertEqual(summary["optim"]["mean"], 0.)
+
+    def test_percentiles(self):
+        for forward in range(1, 101):
+            self.step(forward, 0, 0)
+        summary = self.timer.interval_summary()["forward"]
+        self.assertAlmostEqual(summary["mean"], 50.5)
+        self.assertAlmostEqual(summary["p50"], 50)
+        self.assertAlmostEqual(summary["p95"], 95)
+        self.step(7, 0, 0)
+        summary = self.timer.interval_summary()["forward"]
+        self.assertAlmostEqual(summary["p95"], 7)
+
+    def test_dump(self):
+        tmp = tempfile.mkdtemp()
+        try:
+            self.step(10, 30, 4)
+            self.step(20, 30, 4)
+            with self.timer("checkpoint"):
+                self.tick(5)
+            path = os.path.join(tmp, "timing.json")
+            self.timer.dump(path)
+            with open(path) as f:
+                timing = json.load(f)
+        finally:
+            shutil.rmtree(tmp)
+        self.assertEqual(timing["steps"], 2)
+        self.assertAlmostEqual(timing["phases"]["forward"]["mean"], 15)
+        self.assertAlmostEqual(timing["phases"]["forward"]["total"], 30)
+        self.assertAlmostEqual(timing["phases"]["checkpoint"]["total"], 5)
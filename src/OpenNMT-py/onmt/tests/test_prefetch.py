@@ -0,0 +1,93 @@
+import unittest
+
+import torch
+
+from onmt.inputters.dataset_base import Dataset
+from onmt.inputters.inputter import OrderedIterator, get_fields
+from onmt.inputters.prefetch import _Collated
+from onmt.inputters.text_dataset import TextDataReader, text_sort_key
+
+SRC = ["A cat ate the cake .", "Emma slept .", "The dog gave Emma a cake .",
+       "A girl liked the cake .", "Liam ran ."]
+TGT = ["cat ( x _ 1 ) AND eat . agent ( x _ 2 , x _ 1 )",
+       "sleep . agent ( x _ 1 , Emma )",
+       "* dog ( x _ 1 ) ; give . agent ( x _ 2 , x _ 1 )",
+       "girl ( x _ 1 ) AND like . agent ( x _ 2 , x _ 1 )",
+       "run . agent ( x _ 1 , Liam )"]
+
+
+class TestPrefetch(unittest.TestCase):
+    def make_dataset(self):
+        fields = get_fields("text", 0, 0, dynamic_dict=True)
+        data = [("src", [s.encode("utf-8") for s in SRC]),
+                ("tgt", [s.encode("utf-8") for s in TGT])]
+        reader = TextDataReader()
+        dataset = Dataset(fields, readers=[reader, reader], data=data,
+                          dirs=[None, None], sort_key=text_sort_key)
+        for side, _ in data:
+            fields[side].base_field.build_vocab(
+                [ex[0] for ex in getattr(dataset, side)])
+        fields["corpus_id"].build_vocab(["train"])
+        return dataset
+
+    def iterator(self, num_workers, repeat=False, rank=0, world_size=1):
+        return OrderedIterator(
+            self.make_dataset(), 2, train=True, sort=False,
+            sort_within_batch=True, repeat=repeat, device="cpu", seed=1,
+            num_workers=num_workers, rank=rank, world_size=world_size)
+
+    def batches(self, num_workers):
+        return list(self.iterator(num_workers))
+
+    def test_workers_collate_the_same_batches(self):
+        expected = self.batches(0)
+        batches = self.batches(2)
+        self.assertEqual(len(batches), len(expected))
+        for batch, ref in zip(batches, expected):
+            self.assertIsNotNone(batch.dataset)
+            self.assertEqual(list(batch.fields), list(ref.fields))
+            for name in ["tgt", "indices", "src_map", "alignment"]:
+                self.assertTrue(getattr(batch, name).equal(
+                    getattr(ref, name)), name)
+            self.assertTrue(batch.src[0].equal(ref.src[0]))
+            self.assertTrue(batch.src[1].equal(ref.src[1]))
+            self.assertEqual(
+                [batch.src_ex_vocab.itos(b) for b in range(len(batch))],
+                [ref.src_ex_vocab.itos(b) for b in range(len(ref))])
+            tgt_vocab = ref.dataset.fields["tgt"].base_field.vocab
+            self.assertTrue(batch.src_ex_vocab.tgt_map(tgt_vocab).equal(
+                ref.src_ex_vocab.tgt_map(tgt_vocab)))
+
+    @unittest.skipUnless(torch.cuda.is_available(), "needs CUDA")
+    def test_pinned_batches(self):
+        collated = _Collated(self.batches(0)[0]).pin_memory()
+        self.assertTrue(collated.batch.tgt.is_pinned())
+        self.assertTrue(collated.batch.src[0].is_pinned())
+
+    def test_workers_leave_global_rng_alone(self):
+        torch.manual_seed(0)
+        self.batches(2)
+        after = torch.rand(1)
+        torch.manual_seed(0)
+        self.assertTrue(torch.rand(1).equal(after))
+
+    def test_resume_from_state_dict(self):
+        for num_workers in [0, 1]:
+            iterator = self.iterator(num_workers, repeat=True)
+            batches = iter(iterator)
+            for _ in range(4):
+                next(batches)
+            state = iterator.state_dict()
+            expected = [next(batches).indices for _ in range(4)]
+            resumed = self.iterator(num_workers, repeat=True)
+            resumed.load_state_dict(state)
+            batches = iter(resumed)
+            for indices in expected:
+                self.assertTrue(next(batches).indices.equal(indices))
+
+    def test_ranks_collate_their_share(self):
+        expected = [b.indices.tolist() for b in self.batches(0)]
+        shares = [[b.indices.tolist() for b in self.iterator(
+            rank, rank=rank, world_size=2)] for rank in range(2)]
+        # three batches: the last one is dropped
+        self.assertEqual(shares, [expected[:1], expected[1:2]])
@@ -4,15 +4,19 @@ from __future__ import print_function
 
 import configargparse
 import copy
+import torch
 import unittest
 import glob
 import os
 import codecs
+import shutil
+import tempfile
 
 import onmt
 import onmt.inputters
 import onmt.opts
 import onmt.bin.preprocess as preprocess
+from onmt.inputters.numeric_dataset import load_shard
 
 
 parser = configargparse.ArgumentParser(description='preprocess.py')
@@ -56,8 +60,8 @@ class TestData(unittest.TestCase):
         preprocess.build_save_dataset(
             'valid', fields, src_reader, tgt_reader, align_reader, opt)
 
-        # Remove the generated *pt files.
-        for pt in glob.glob(SAVE_DATA_PREFIX + '*.pt'):
+        # Remove the generated *pt files and the manifest.
+        for pt in glob.glob(SAVE_DATA_PREFIX + '.*'):
             os.remove(pt)
         if hasattr(opt, 'src_vocab') and os.path.exists(opt.src_vocab):
             os.remove(opt.src_vocab)
@@ -174,3 +178,94 @@ test_databuild_common = [('data_type', 'audio'),
                          ]
 for p in test_databuild:
     _add_test(p + test_databuild_common, 'dataset_build')
+
+
+class TestPreprocessShards(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.src = os.path.join(self.tmp, 'src.txt')
+        self.tgt = os.path.join(self.tmp, 'tgt.txt')
+        self.save_data = os.path.join(self.tmp, 'data')
+        self.write(['a b c', 'b c d', 'c d e', 'd e f'])
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def write(self, lines):
+        for path in [self.src, self.tgt]:
+            with codecs.open(path, 'w', 'utf-8') as f:
+                f.write(''.join(line + '\n' for line in lines))
+
+    def preprocess(self, *args, **kwargs):
+        parser = preprocess._get_parser()
+        opt = parser.parse_args(
+            ['-train_src', self.src, '-train_tgt', self.tgt,
+             '-save_data', kwargs.get('save_data', self.save_data),
+             '-shard_size', '2'] + list(args))
+        preprocess.preprocess(opt)
+
+    def mtimes(self):
+        return {os.path.basename(p): os.stat(p).st_mtime_ns
+                for p in glob.glob(self.save_data + '.*')
+                if not p.endswith('.json')}
+
+    def test_only_changed_shards_are_rebuilt(self):
+        self.preprocess()
+        first = self.mtimes()
+        self.assertEqual(
+            sorted(first), ['data.train.0.pt', 'data.train.1.pt',
+                            'data.vocab.pt'])
+
+        self.preprocess()
+        self.assertEqual(self.mtimes(), first)
+
+        # same counters: the vocab is kept too
+        self.write(['a b c', 'b c d', 'd e f', 'c d e'])
+        self.preprocess()
+        second = self.mtimes()
+        self.assertEqual(second['data.train.0.pt'], first['data.train.0.pt'])
+        self.assertNotEqual(second['data.train.1.pt'],
+                            first['data.train.1.pt'])
+        self.assertEqual(second['data.vocab.pt'], first['data.vocab.pt'])
+
+        self.write(['a b c', 'b c d', 'c d e'])
+        self.preprocess('-src_seq_length', '10')
+        third = self.mtimes()
+        self.assertEqual(
+            sorted(third), ['data.train.0.pt', 'data.train.1.pt',
+                            'data.vocab.pt'])
+        self.assertNotEqual(third['data.vocab.pt'], first['data.vocab.pt'])
+
+        self.preprocess('-shard_format', 'bin', '-src_seq_length', '10')
+        self.assertEqual(
+            sorted(self.mtimes()), ['data.train.0.bin', 'data.train.1.bin',
+                                    'data.vocab.pt'])
+
+    def test_chunked_shard_matches_serial_shard(self):
+        self.write(['a b c', 'b c d e f g', 'c', 'd e f', 'x y'])
+        serial = os.path.join(self.tmp, 'serial')
+        chunked = os.path.join(self.tmp, 'chunked')
+        common = ['-shard_size', '0', '-tgt_seq_length', '5']
+        self.preprocess(*common, save_data=serial)
+        self.preprocess('-num_threads', '2', *common, save_data=chunked)
+        expected = torch.load(serial + '.train.0.pt')
+        dataset = torch.load(chunked + '.train.0.pt')
+        self.assertEqual(len(dataset.examples), 4)
+        for ex, exp in zip(dataset.examples, expected.examples):
+            self.assertEqual(ex.src, exp.src)
+            self.assertEqual(ex.indices, exp.indices)
+        self.assertEqual(
+            torch.load(serial + '.vocab.pt')['src'].base_field.vocab.freqs,
+            torch.load(chunked + '.vocab.pt')['src'].base_field.vocab.freqs)
+
+        self.preprocess('-num_threads', '2', '-shard_format', 'bin',
+                        *common, save_data=chunked)
+        arrays, meta = load_shard(chunked + '.train.0.bin')
+        symbols = meta['symbols']
+        offsets = arrays['src_offsets']
+        self.assertEqual(
+            [[symbols[t] for t in arrays['src'][b:e]]
+             for b, e in zip(offsets[:-1], offsets[1:])],
+            [ex.src[0] for ex in expected.examples])
+        self.assertEqual(arrays['indices'].tolist(),
+                         [ex.indices for ex in expected.examples])
@@ -0,0 +1,123 @@
+import copy
+import unittest
+from collections import Counter
+
+import torch
+from torchtext.data import Batch
+from torchtext.vocab import Vocab
+
+import onmt
+import onmt.inputters
+import onmt.opts
+from onmt.model_builder import build_embeddings, build_encoder, \
+    build_decoder
+from onmt.trainer import _stack_batches
+from onmt.utils.parse import ArgumentParser
+
+if hasattr(torch, "func"):
+    from onmt.models.stacked import StackedModel
+
+
+@unittest.skipUnless(hasattr(torch, "func"), "requires torch>=2.0")
+class TestStackedModel(unittest.TestCase):
+    def build_model(self, seed):
+        parser = ArgumentParser()
+        onmt.opts.model_opts(parser)
+        onmt.opts.train_opts(parser)
+        opt = parser.parse_known_args(['-data', 'dummy'])[0]
+        opt = copy.deepcopy(opt)
+        for param, setting in [('decoder_type', 'transformer'),
+                               ('encoder_type', 'transformer'),
+                               ('word_vec_size', 16),
+                               ('rnn_size', 16),
+                               ('layers', 2),
+                               ('position_encoding', True),
+                               ('dropout', [0.0]),
+                               ('attention_dropout', [0.0])]:
+            setattr(opt, param, setting)
+        ArgumentParser.update_model_opts(opt)
+        opt.enc_rnn_size = opt.dec_rnn_size = 16
+        field = onmt.inputters.get_fields("text", 0, 0)["src"]
+        field.base_field.vocab = Vocab(
+            Counter("abcdefgh"), specials=["<unk>", "<blank>"])
+        torch.manual_seed(seed)
+        model = onmt.models.model.NMTModel(
+            build_encoder(opt, build_embeddings(opt, field)),
+            build_decoder(opt, build_embeddings(
+                opt, field, for_encoder=False)))
+        return model
+
+    def batch(self, src_lengths, tgt_lengths, pad=1):
+        batch = Batch()
+        batch.batch_size = len(src_lengths)
+        src = torch.full((max(src_lengths), len(src_lengths), 1), pad)
+        tgt = torch.full((max(tgt_lengths), len(tgt_lengths), 1), pad)
+        for i, (s, t) in enumerate(zip(src_lengths, tgt_lengths)):
+            src[:s, i, 0] = torch.randint(2, 10, (s,))
+            tgt[:t, i, 0] = torch.randint(2, 10, (t,))
+        batch.src = (src, torch.tensor(src_lengths))
+        batch.tgt = tgt
+        return batch
+
+    def expected(self, models, batches):
+        """The outputs and gradients of each model run alone."""
+        outputs, grads = [], []
+        for model, batch in zip(models, batches):
+            src, lengths = batch.src
+            output, _ = model(src, batch.tgt, lengths)
+            output.pow(2).sum().backward()
+            outputs.append(output.detach())
+            grads.append({name: p.grad for name, p
+                          in model.named_parameters() if p.grad is not None})
+            model.zero_grad(set_to_none=True)
+        return outputs, grads
+
+    def assert_grads(self, models, grads):
+        for model, expected in zip(models, grads):
+            params = dict(model.named_parameters())
+            for name, grad in expected.items():
+                self.assertTrue(params[name].grad.allclose(
+                    grad, atol=1e-5), name)
+
+    def test_shared_batch(self):
+        models = [self.build_model(seed) for seed in range(3)]
+        batch = self.batch([3, 6, 2], [7, 5, 4])
+        outputs, grads = self.expected(models, [batch] * 3)
+        stacked = StackedModel(models)
+        src, lengths = batch.src
+        output = stacked(src, batch.tgt, lengths)
+        output.pow(2).sum().backward()
+        stacked.scatter_grads()
+        for out, expected in zip(output, outputs):
+            self.assertTrue(out.allclose(expected, atol=1e-5))
+        self.assert_grads(models, grads)
+
+    def test_batched(self):
+        models = [self.build_model(seed) for seed in range(2)]
+        batches = [self.batch([3, 6, 2], [7, 5, 4]),
+                   self.batch([4, 2], [3, 9])]
+        outputs, grads = self.expected(models, batches)
+        stacked = StackedModel(models)
+        src, tgt, lengths = _stack_batches(batches)
+        output = stacked(src, tgt, lengths, batched=True)
+        loss = 0
+        for out, batch, expected in zip(output, batches, outputs):
+            out = out[:batch.tgt.size(0) - 1, :batch.tgt.size(1)]
+            self.assertTrue(out.allclose(expected, atol=1e-5))
+            loss = loss + out.pow(2).sum()
+        loss.backward()
+        stacked.scatter_grads()
+        self.assert_grads(models, grads)
+
+    def test_updates_in_place(self):
+        models = [self.build_model(seed) for seed in range(3)]
+        stacked = StackedModel(models)
+        with torch.no_grad():
+            models[1].decoder.layer_norm.bias.fill_(2.)
+        stack = stacked.stack["decoder.layer_norm.bias"]
+        self.assertTrue(stack[1].eq(2.).all())
+        stacked.select([0, 1])
+        self.assertEqual(stacked.stack["decoder.layer_norm.bias"].size(0), 2)
+        self.assertTrue(models[1].decoder.layer_norm.bias.eq(2.).all())
+        stacked.select([])
+        self.assertEqual(stacked.stack, {})
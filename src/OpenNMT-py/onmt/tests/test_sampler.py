@@ -0,0 +1,90 @@
+import unittest
+
+import numpy as np
+
+from onmt.inputters.inputter import ExampleLengths, batch_iter
+from onmt.inputters.sampler import BucketBatchSampler, PaddingStats, \
+    max_tok_len, padded_lengths, shard_batches
+
+
+def _lengths(n, seed=0):
+    rng = np.random.RandomState(seed)
+    return {"src": rng.randint(1, 20, n).astype(np.int16),
+            "tgt": rng.randint(1, 60, n).astype(np.int16)}
+
+
+class TestMaxTokLen(unittest.TestCase):
+    def test_interleaved_batches_are_independent(self):
+        lengths = _lengths(200)
+        records = [ExampleLengths(int(s), int(t), i) for i, (s, t) in
+                   enumerate(zip(lengths["src"], lengths["tgt"]))]
+        expected = list(batch_iter(records, 300, max_tok_len))
+        first = batch_iter(records, 300, max_tok_len)
+        second = batch_iter(records[::-1], 300, max_tok_len)
+        interleaved = []
+        for batch, _ in zip(first, second):
+            interleaved.append(batch)
+        interleaved.extend(first)
+        self.assertEqual(interleaved, expected)
+        for batch in expected:
+            self.assertLessEqual(
+                len(batch) * max(max(r.src + 2 for r in batch),
+                                 max(r.tgt + 1 for r in batch)), 300)
+
+
+class TestBucketBatchSampler(unittest.TestCase):
+    def test_batches_cover_epoch_within_budget(self):
+        lengths = _lengths(500)
+        padded = padded_lengths(lengths)
+        sampler = BucketBatchSampler(lengths, 400, "tokens", seed=1)
+        batches = list(sampler)
+        self.assertEqual(sorted(np.concatenate(batches).tolist()),
+                         list(range(500)))
+        for b in batches:
+            self.assertLessEqual(
+                len(b) * max(padded["src"][b].max(),
+                             padded["tgt"][b].max()), 400)
+        self.assertEqual(sampler.stats.batches, len(batches))
+        self.assertEqual(sampler.stats.tokens["tgt"],
+                         int(padded["tgt"].sum()))
+        self.assertEqual(
+            sampler.stats.padded["tgt"],
+            sum(len(b) * int(padded["tgt"][b].max()) for b in batches))
+
+    def test_epochs_depend_on_seed_and_epoch_only(self):
+        lengths = _lengths(300)
+        a = BucketBatchSampler(lengths, 16, seed=3)
+        b = BucketBatchSampler(lengths, 16, seed=3)
+        first = [x.tolist() for x in a]
+        second = [x.tolist() for x in a]
+        self.assertNotEqual(first, second)
+        b.set_epoch(1)
+        self.assertEqual([x.tolist() for x in b], second)
+        self.assertEqual(sum(len(x) != 16 for x in first), 1)
+
+    def test_batch_size_multiple(self):
+        sampler = BucketBatchSampler(
+            _lengths(300), 500, "tokens", batch_size_multiple=8)
+        batches = list(sampler)
+        self.assertEqual(sum(len(b) for b in batches), 300)
+        self.assertEqual(
+            sum(len(b) % 8 != 0 for b in batches), 1)
+
+    def test_padding_stats(self):
+        stats = PaddingStats()
+        stats.update([np.array([0, 1]), np.array([2])],
+                     {"src": np.array([3, 5, 4]), "tgt": None})
+        self.assertEqual(stats.tokens["src"], 12)
+        self.assertEqual(stats.padded["src"], 14)
+        self.assertAlmostEqual(stats.efficiency(), 12 / 14)
+
+
+class TestShardBatches(unittest.TestCase):
+    def test_ranks_get_disjoint_equal_shares(self):
+        batches = [x.tolist() for x in BucketBatchSampler(
+            _lengths(300), 16, seed=2)]
+        shares = [list(shard_batches(iter(batches), rank, 3))
+                  for rank in range(3)]
+        self.assertEqual(len(batches), 19)
+        self.assertEqual([len(share) for share in shares], [6, 6, 6])
+        self.assertEqual(sorted(sum(shares, [])), sorted(batches[:18]))
@@ -0,0 +1,82 @@
+import os
+import shutil
+import tempfile
+import unittest
+from collections import Counter, defaultdict
+
+import torch
+
+import onmt.inputters as inputters
+from onmt.bin import sweep
+from onmt.bin.train import _get_parser as _get_train_parser
+from onmt.inputters.inputter import _build_fields_vocab
+from onmt.inputters.numeric_dataset import NumericDataset
+
+
+class TestSweep(unittest.TestCase):
+    def test_runs(self):
+        opt = sweep._get_parser().parse_args(
+            ["-sweep_dir", "out", "-seeds", "1", "2", "-grid",
+             "layers=2,4", "data=d/1_example", "position_encoding=true,false"])
+        axes = sweep.parse_grid(opt.grid, _get_train_parser())
+        runs = sweep.build_runs(opt, ["-heads", "4"], axes)
+        self.assertEqual(len(runs), 8)
+        self.assertEqual(runs[0]["name"],
+                         "layers-2_data-1_example_position_encoding-true_s1")
+        self.assertEqual(runs[3]["setting"], ["2", "d/1_example", "false"])
+        parser = _get_train_parser()
+        first = parser.parse_args(runs[0]["argv"])
+        self.assertEqual((first.layers, first.heads, first.seed),
+                         (2, 4, 1))
+        self.assertTrue(first.position_encoding)
+        self.assertEqual(first.save_model, os.path.join(
+            "out", runs[0]["name"], "model"))
+        self.assertFalse(parser.parse_args(runs[3]["argv"]).position_encoding)
+
+    def test_invalid_grid(self):
+        parser = _get_train_parser()
+        for grid in (["layers"], ["no_such_option=1"],
+                     ["position_encoding=1"]):
+            with self.assertRaises(ValueError):
+                sweep.parse_grid(grid, parser)
+
+
+class TestShareCorpus(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def test_numericalized_batches(self):
+        fields = inputters.get_fields("text", 0, 0)
+        reader = inputters.str2reader["text"]()
+        srcs = [b"Emma slept .", b"A cat ate the cake ."]
+        tgts = [b"sleep . agent ( x _ 1 , Emma )",
+                b"cat ( x _ 1 ) AND eat . agent ( x _ 2 , x _ 1 )"]
+        dataset = inputters.Dataset(
+            fields, readers=[reader, reader],
+            data=[("src", srcs), ("tgt", tgts)], dirs=[None, None],
+            sort_key=inputters.str2sortkey["text"])
+        counters = defaultdict(Counter)
+        for ex in dataset.examples:
+            counters["src"].update(ex.src[0])
+            counters["tgt"].update(ex.tgt[0])
+        fields = _build_fields_vocab(fields, counters, "text", False, 1,
+                                     100, 0, 100, 0)
+        data = os.path.join(self.tmp, "corpus")
+        dataset.save(data + ".train.0.pt")
+        torch.save(fields, data + ".vocab.pt")
+
+        staged = sweep.share_corpus(data, os.path.join(self.tmp, "shm"))
+        self.assertEqual(sorted(os.listdir(os.path.dirname(staged))),
+                         ["corpus.train.0.bin", "corpus.vocab.pt"])
+        shard = NumericDataset.load(staged + ".train.0.bin", fields)
+        dataset.fields = fields
+        expected = inputters.inputter._make_batch(
+            list(dataset), dataset, "cpu")
+        batch = inputters.inputter._make_batch(list(shard), shard, "cpu")
+        for side in ("src", "tgt"):
+            self.assertTrue(getattr(expected, side)[0].equal(
+                getattr(batch, side)[0]))
+        self.assertTrue(expected.indices.equal(batch.indices))
@@ -0,0 +1,70 @@
+import unittest
+
+from onmt.inputters.dataset_base import Dataset
+from onmt.inputters.inputter import _make_batch, get_fields, length_index
+from onmt.inputters.tensor_dataset import TensorDataset, TensorIterator
+from onmt.inputters.text_dataset import TextDataReader, text_sort_key
+from onmt.tests.test_prefetch import SRC, TGT
+
+
+class TestTensorDataset(unittest.TestCase):
+    def make_dataset(self, src, tgt):
+        fields = get_fields("text", 0, 0)
+        data = [("src", [s.encode("utf-8") for s in src]),
+                ("tgt", [s.encode("utf-8") for s in tgt])]
+        reader = TextDataReader()
+        dataset = Dataset(fields, readers=[reader, reader], data=data,
+                          dirs=[None, None], sort_key=text_sort_key)
+        for side in ["src", "tgt"]:
+            fields[side].base_field.build_vocab(
+                [ex[0] for ex in getattr(dataset, side)])
+        fields["corpus_id"].build_vocab(["train"])
+        dataset.fields = fields
+        return dataset
+
+    def test_batches_match_collated_examples(self):
+        fields = self.make_dataset(SRC, TGT).fields
+        # two shards of different widths
+        shards = [self.make_dataset(SRC[:2], TGT[:2]),
+                  self.make_dataset(SRC[2:], TGT[2:])]
+        for shard in shards:
+            shard.fields = fields
+        data = TensorDataset(
+            [_make_batch(list(d.examples), d, "cpu") for d in shards],
+            [length_index(d) for d in shards], fields, "cpu")
+        self.assertEqual(len(data), len(SRC))
+        by_src = {tuple(ex.src[0]): ex
+                  for d in shards for ex in d.examples}
+        itos = fields["src"].base_field.vocab.itos
+        for train in [True, False]:
+            seen = 0
+            for batch in TensorIterator(data, 2, train=train, repeat=False):
+                examples = [
+                    by_src[tuple(itos[i] for i in batch.src[0][:n, b, 0])]
+                    for b, n in enumerate(batch.src[1].tolist())]
+                expected = _make_batch(examples, shards[0], "cpu")
+                self.assertTrue(batch.src[0].equal(expected.src[0]))
+                self.assertTrue(batch.src[1].equal(expected.src[1]))
+                self.assertTrue(batch.tgt.equal(expected.tgt))
+                self.assertTrue(batch.indices.equal(expected.indices))
+                self.assertEqual(batch.src[1].tolist(),
+                                 sorted(batch.src[1].tolist(), reverse=True))
+                seen += batch.batch_size
+            self.assertEqual(seen, len(SRC))
+
+    def test_resume_from_state_dict(self):
+        dataset = self.make_dataset(SRC, TGT)
+        data = TensorDataset([_make_batch(list(dataset.examples), dataset,
+                                          "cpu")],
+                             [length_index(dataset)], dataset.fields, "cpu")
+        iterator = TensorIterator(data, 2, seed=4)
+        batches = iter(iterator)
+        for _ in range(4):
+            next(batches)
+        state = iterator.state_dict()
+        expected = [next(batches).indices for _ in range(4)]
+        resumed = TensorIterator(data, 2, seed=0)
+        resumed.load_state_dict(state)
+        batches = iter(resumed)
+        for indices in expected:
+            self.assertTrue(next(batches).indices.equal(indices))
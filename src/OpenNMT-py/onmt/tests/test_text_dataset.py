@@ -1,11 +1,20 @@
 import unittest
-from onmt.inputters.text_dataset import TextMultiField, TextDataReader
+from onmt.inputters.text_dataset import TextMultiField, TextDataReader, \
+    text_sort_key
+from onmt.inputters.dataset_base import CompactExample, Dataset, \
+    DynamicDict, DynamicDictBatch, SymbolTable, build_dynamic_dict
+from onmt.inputters.inputter import get_fields
 
+import io
 import itertools
 import os
+from collections import Counter
 from copy import deepcopy
 
+import numpy as np
+import torch
 from torchtext.data import Field
+from torchtext.vocab import Vocab
 
 from onmt.tests.utils_for_tests import product_dict
 
@@ -175,3 +184,123 @@ class TestTextDataReaderFromFS(unittest.TestCase):
         rdr = TextDataReader()
         for i, ex in enumerate(rdr.read(self.FILE_NAME, "src")):
             self.assertEqual(ex["src"], self.STRINGS[i].decode("utf-8"))
+
+
+class TestCompactExample(unittest.TestCase):
+    SRC = ["A cat ate the cake .", "Emma slept ."]
+    TGT = ["cat ( x _ 1 ) AND eat . agent ( x _ 2 , x _ 1 )",
+           "sleep . agent ( x _ 1 , Emma )"]
+
+    def make_dataset(self, n_src_feats=0, with_tgt=True):
+        src = self.SRC
+        if n_src_feats:
+            src = [" ".join(t + u"\uffe8" + t.lower() for t in s.split())
+                   for s in src]
+        fields = get_fields("text", n_src_feats, 0, dynamic_dict=True)
+        data = [("src", [s.encode("utf-8") for s in src])]
+        if with_tgt:
+            data.append(("tgt", [s.encode("utf-8") for s in self.TGT]))
+        else:
+            del fields["tgt"], fields["alignment"]
+        reader = TextDataReader()
+        dataset = Dataset(fields, readers=[reader] * len(data), data=data,
+                          dirs=[None] * len(data), sort_key=text_sort_key)
+        for side, _ in data:
+            for i, (_, f) in enumerate(fields[side]):
+                f.build_vocab([ex[i] for ex in getattr(dataset, side)])
+        fields["corpus_id"].build_vocab(["train"])
+        return dataset, fields
+
+    def test_attributes_match_input(self):
+        for n_src_feats in [0, 1]:
+            dataset, _ = self.make_dataset(n_src_feats)
+            self.assertIsNotNone(dataset.symbols)
+            for i, ex in enumerate(dataset.examples):
+                self.assertIsInstance(ex, CompactExample)
+                words = self.SRC[i].split()
+                expected = [words, [w.lower() for w in words]]
+                self.assertEqual(ex.src, expected[:n_src_feats + 1])
+                self.assertEqual(ex.tgt, [self.TGT[i].split()])
+                self.assertEqual(ex.indices, i)
+                self.assertEqual(ex.corpus_id, "train")
+                self.assertEqual(
+                    dataset.dynamic_dict.itos(i),
+                    Vocab(Counter(words), specials=["<unk>", "<blank>"]).itos)
+
+    def test_batch_and_pickle(self):
+        dataset, fields = self.make_dataset()
+        batch = DynamicDictBatch(dataset.examples, dataset)
+        stoi = fields["src"].base_field.vocab.stoi
+        self.assertEqual(batch.src[0][:, 1, 0].tolist(),
+                         [stoi[w] for w in dataset.examples[1].src[0]] +
+                         [stoi["<blank>"]] * 3)
+        self.assertEqual(batch.src_map.size(), (6, 2, 8))
+        # BOS, "sleep . agent ( x _ 1 , Emma )", EOS, then padding
+        self.assertEqual(batch.alignment[:, 1].tolist(),
+                         [0, 0, 2, 0, 0, 0, 0, 0, 0, 3, 0, 0] + [0] * 9)
+        self.assertEqual(batch.src_ex_vocab.itos(1),
+                         ["<unk>", "<blank>", ".", "Emma", "slept"])
+
+        buf = io.BytesIO()
+        dataset.save(buf)
+        buf.seek(0)
+        loaded = torch.load(buf)
+        self.assertIs(loaded.examples[0]._symbols,
+                      loaded.examples[1]._symbols)
+        self.assertIs(loaded.symbols.itos, loaded.dynamic_dict.symbols)
+        for ex, orig in zip(loaded.examples, dataset.examples):
+            self.assertEqual(ex.src, orig.src)
+            self.assertEqual(ex.tgt, orig.tgt)
+            self.assertEqual(text_sort_key(ex), text_sort_key(orig))
+
+    def test_missing_side_is_absent(self):
+        dataset, _ = self.make_dataset(with_tgt=False)
+        ex = dataset.examples[0]
+        self.assertFalse(hasattr(ex, "tgt"))
+        self.assertFalse(hasattr(ex, "alignment"))
+        self.assertEqual(text_sort_key(ex), 6)
+
+
+class TestDynamicDict(unittest.TestCase):
+    SPECIALS = ["<unk>", "<blank>"]
+
+    def build(self, srcs, tgts):
+        symbols = SymbolTable()
+        flat = {}
+        for side, seqs in [("src", srcs), ("tgt", tgts)]:
+            ids = [symbols.encode(seq) for seq in seqs]
+            flat[side] = np.array([i for seq in ids for i in seq], np.int32)
+            flat[side + "_offsets"] = np.cumsum(
+                [0] + [len(seq) for seq in seqs])
+        arrays = build_dynamic_dict(
+            flat["src"], flat["src_offsets"], flat["tgt"],
+            flat["tgt_offsets"], symbols.itos, self.SPECIALS)
+        arrays.update(indices=np.arange(len(srcs)),
+                      src_offsets=flat["src_offsets"],
+                      tgt_offsets=flat["tgt_offsets"])
+        return DynamicDict(arrays, symbols.itos, self.SPECIALS), arrays
+
+    def test_matches_per_example_vocabs(self):
+        srcs = [["b", "a", "c", "a", "b", "d"], [], ["<blank>", "x", "x"],
+                ["<unk>", "b"]]
+        tgts = [["a", "z", "d"], ["a"], ["x", "<blank>"], ["b", "<unk>"]]
+        dynamic_dict, arrays = self.build(srcs, tgts)
+        src_map = np.split(arrays["src_map"], arrays["src_offsets"][1:-1])
+        alignment = np.split(arrays["alignment"],
+                             arrays["tgt_offsets"][1:-1])
+        for i, (src, tgt) in enumerate(zip(srcs, tgts)):
+            vocab = Vocab(Counter(src), specials=self.SPECIALS)
+            self.assertEqual(dynamic_dict.itos(i), vocab.itos)
+            self.assertEqual(src_map[i].tolist(),
+                             [vocab.stoi[w] for w in src])
+            self.assertEqual(alignment[i].tolist(),
+                             [vocab.stoi[w] for w in tgt])
+
+    def test_tgt_map(self):
+        dynamic_dict, _ = self.build([["b", "a", "c"], ["c"]], [[], []])
+        tgt_vocab = Vocab(Counter(["a", "c"]), specials=self.SPECIALS)
+        # copy vocabularies are [<unk>, <blank>, a, b, c] and
+        # [<unk>, <blank>, c]; b is unknown to the target vocabulary
+        self.assertEqual(
+            dynamic_dict.tgt_map(np.array([1, 0]), tgt_vocab).tolist(),
+            [[0, 1, 3, 0, 0], [0, 1, 2, 0, 3]])
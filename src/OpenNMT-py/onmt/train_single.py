@@ -1,6 +1,8 @@
 #!/usr/bin/env python
 """Training on a single process."""
+import copy
 import os
+import random
 
 import torch
 
@@ -8,11 +10,13 @@ from onmt.inputters.inputter import build_dataset_iter, patch_fields, \
     load_old_vocab, old_style_vocab, build_dataset_iter_multiple
 from onmt.model_builder import build_model
 from onmt.utils.optimizers import Optimizer
-from onmt.utils.misc import set_random_seed
-from onmt.trainer import build_trainer
-from onmt.models import build_model_saver
+from onmt.utils.misc import set_random_seed, get_rng_state, \
+    set_rng_state
+from onmt.trainer import build_trainer, ReplicaTrainer
+from onmt.models import build_model_saver, load_checkpoint
 from onmt.utils.logging import init_logger, logger
 from onmt.utils.parse import ArgumentParser
+from onmt.utils.distributed import broadcast_seed
 
 
 def _check_save_model_path(opt):
@@ -33,13 +37,91 @@ def _tally_parameters(model):
     return enc + dec, enc, dec
 
 
+def _build_train_iter(opt, fields):
+    rank, world_size = 0, 1
+    if opt.world_size > 1:
+        rank, world_size = torch.distributed.get_rank(), opt.world_size
+        # all processes batch the data alike, and each keeps its share
+        random.seed(broadcast_seed(random.randrange(2 ** 31)))
+    if len(opt.data_ids) > 1:
+        train_shards = []
+        for train_id in opt.data_ids:
+            shard_base = "train_" + train_id
+            train_shards.append(shard_base)
+        return build_dataset_iter_multiple(
+            train_shards, fields, opt, rank=rank, world_size=world_size)
+    if opt.data_ids[0] is not None:
+        shard_base = "train_" + opt.data_ids[0]
+    else:
+        shard_base = "train"
+    return build_dataset_iter(
+        shard_base, fields, opt, rank=rank, world_size=world_size)
+
+
+def _replica_opt(opt, k):
+    """The options of replica ``k``, those of a single run with seed
+    ``-seed + k`` saving its checkpoints and logs apart."""
+    replica_opt = copy.copy(opt)
+    if opt.seed > 0:
+        replica_opt.seed = opt.seed + k
+    replica_opt.save_model = "%s_replica%d" % (opt.save_model, k)
+    if opt.tensorboard:
+        replica_opt.tensorboard_log_dir = os.path.join(
+            opt.tensorboard_log_dir, "replica%d" % k)
+    return replica_opt
+
+
+def _train_replicas(opt, fields, device_id):
+    """Train ``-replicas`` models at once, each set up as a single run
+    with its own seed would be, see :class:`onmt.trainer.ReplicaTrainer`.
+    """
+    trainers, train_iters, rng_states = [], [], []
+    for k in range(opt.replicas):
+        replica_opt = _replica_opt(opt, k)
+        set_random_seed(replica_opt.seed, device_id >= 0)
+        model = build_model(replica_opt, replica_opt, fields, None)
+        if k == 0:
+            n_params, enc, dec = _tally_parameters(model)
+            logger.info('* number of parameters: %d, %d replicas'
+                        % (n_params, opt.replicas))
+        _check_save_model_path(replica_opt)
+        optim = Optimizer.from_opt(model, replica_opt)
+        model_saver = build_model_saver(
+            replica_opt, replica_opt, model, fields, optim)
+        trainers.append(build_trainer(
+            replica_opt, device_id, model, fields, optim,
+            model_saver=model_saver))
+        if k == 0 or opt.replica_data_order == "different":
+            train_iters.append(_build_train_iter(replica_opt, fields))
+        # the same for all replicas, but building it draws a seed
+        valid_iter = build_dataset_iter(
+            "valid", fields, replica_opt, is_train=False)
+        rng_states.append(get_rng_state())
+    logger.info('args: {}'.format(opt))
+
+    train_steps = opt.train_steps
+    if opt.single_pass and train_steps > 0:
+        logger.warning("Option single_pass is enabled, ignoring train_steps.")
+        train_steps = 0
+    ReplicaTrainer(trainers, rng_states).train(
+        train_iters,
+        train_steps,
+        save_checkpoint_steps=opt.save_checkpoint_steps,
+        valid_iter=valid_iter,
+        valid_steps=opt.valid_steps)
+
+    for trainer in trainers:
+        if trainer.report_manager.tensorboard_writer is not None:
+            trainer.report_manager.tensorboard_writer.close()
+
+
 def configure_process(opt, device_id):
     if device_id >= 0:
         torch.cuda.set_device(device_id)
     set_random_seed(opt.seed, device_id >= 0)
 
 
-def main(opt, device_id, batch_queue=None, semaphore=None):
+def main(opt, device_id):
     # NOTE: It's important that ``opt`` has been validated and updated
     # at this point.
     configure_process(opt, device_id)
@@ -49,8 +131,7 @@ def main(opt, device_id, batch_queue=None, semaphore=None):
     # Load checkpoint if we resume from a previous training.
     if opt.train_from:
         logger.info('Loading checkpoint from %s' % opt.train_from)
-        checkpoint = torch.load(opt.train_from,
-                                map_location=lambda storage, loc: storage)
+        checkpoint = load_checkpoint(opt.train_from)
         model_opt = ArgumentParser.ckpt_model_opts(checkpoint["opt"])
         ArgumentParser.update_model_opts(model_opt)
         ArgumentParser.validate_model_opts(model_opt)
@@ -83,6 +164,10 @@ def main(opt, device_id, batch_queue=None, semaphore=None):
             if sf.use_vocab:
                 logger.info(' * %s vocab size = %d' % (sn, len(sf.vocab)))
 
+    if opt.replicas > 1:
+        _train_replicas(opt, fields, device_id)
+        return
+
     # Build model.
     model = build_model(model_opt, opt, fields, checkpoint)
     n_params, enc, dec = _tally_parameters(model)
@@ -101,35 +186,28 @@ def main(opt, device_id, batch_queue=None, semaphore=None):
     trainer = build_trainer(
         opt, device_id, model, fields, optim, model_saver=model_saver)
 
-    if batch_queue is None:
-        if len(opt.data_ids) > 1:
-            train_shards = []
-            for train_id in opt.data_ids:
-                shard_base = "train_" + train_id
-                train_shards.append(shard_base)
-            train_iter = build_dataset_iter_multiple(train_shards, fields, opt)
-        else:
-            if opt.data_ids[0] is not None:
-                shard_base = "train_" + opt.data_ids[0]
-            else:
-                shard_base = "train"
-            train_iter = build_dataset_iter(shard_base, fields, opt)
-
-    else:
-        assert semaphore is not None, \
-            "Using batch_queue requires semaphore as well"
-
-        def _train_iter():
-            while True:
-                batch = batch_queue.get()
-                semaphore.release()
-                yield batch
-
-        train_iter = _train_iter()
-
+    train_iter = _build_train_iter(opt, fields)
     valid_iter = build_dataset_iter(
         "valid", fields, opt, is_train=False)
 
+    if checkpoint is not None and opt.reset_optim != 'all':
+        # carry on exactly where the checkpointed run was
+        if checkpoint.get('data_state') is not None \
+                and hasattr(train_iter, 'load_state_dict'):
+            logger.info('Resuming training data from the checkpoint.')
+            train_iter.load_state_dict(checkpoint['data_state'])
+        if 'rng' in checkpoint:
+            set_rng_state(checkpoint['rng'])
+        if 'train_weights' in checkpoint:
+            # the model was built with the averaged weights
+            if trainer.moving_average is not None:
+                trainer.moving_average.load_state_dict(checkpoint['ema'])
+            logger.info('Resuming the trained (not averaged) weights.')
+            model.load_state_dict(
+                checkpoint['train_weights']['model'], strict=False)
+            model.generator.load_state_dict(
+                checkpoint['train_weights']['generator'], strict=False)
+
     if len(opt.gpu_ranks):
         logger.info('Starting training on GPU: %s' % opt.gpu_ranks)
     else:
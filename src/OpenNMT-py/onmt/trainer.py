@@ -9,13 +9,24 @@
           users of this library) for the strategy things we do.
 """
 
+import logging
+import time
+from contextlib import contextmanager
+from itertools import count
+
 import torch
 import traceback
 
 import onmt.utils
+from onmt.translate.greedy_search import greedy_exact_match
 from onmt.utils.logging import logger
 
 
+@contextmanager
+def _untimed():
+    yield
+
+
 def build_trainer(opt, device_id, model, fields, optim, model_saver=None):
     """
     Simplify `Trainer` creation based on user `opt`s*
@@ -37,24 +48,31 @@ def build_trainer(opt, device_id, model, fields, optim, model_saver=None):
         model, tgt_field, opt, train=False)
 
     trunc_size = opt.truncated_decoder  # Badly named...
-    shard_size = opt.max_generator_batches if opt.model_dtype == 'fp32' else 0
+    shard_size = opt.max_generator_batches \
+        if opt.model_dtype != 'fp16' else 0
     norm_method = opt.normalization
     accum_count = opt.accum_count
     accum_steps = opt.accum_steps
     n_gpu = opt.world_size
     average_decay = opt.average_decay
     average_every = opt.average_every
+    average_device = "cpu" if opt.average_offload else None
     dropout = opt.dropout
     dropout_steps = opt.dropout_steps
     if device_id >= 0:
         gpu_rank = opt.gpu_ranks[device_id]
+    elif opt.world_size > 1:
+        # one of several CPU processes
+        gpu_rank = torch.distributed.get_rank()
     else:
         gpu_rank = 0
         n_gpu = 0
     gpu_verbose_level = opt.gpu_verbose_level
 
+    valid_exact_match = opt.valid_exact_match \
+        or "exact_match" in (opt.early_stopping_criteria or [])
     earlystopper = onmt.utils.EarlyStopping(
-        opt.early_stopping, scorers=onmt.utils.scorers_from_opts(opt), base_path=opt.save_model) \
+        opt.early_stopping, scorers=onmt.utils.scorers_from_opts(opt)) \
         if opt.early_stopping > 0 else None
 
     source_noise = None
@@ -75,7 +93,30 @@ def build_trainer(opt, device_id, model, fields, optim, model_saver=None):
             device_id=device_id
         )
 
+    grad_reducer = None
+    reduce_in_backward = n_gpu > 1 and not opt.reduce_after_backward
+    if reduce_in_backward and not hasattr(
+            torch.Tensor, "register_post_accumulate_grad_hook"):
+        logger.info("Reducing gradients after backward: reducing them "
+                    "during backward requires torch>=2.1.")
+        reduce_in_backward = False
+    if reduce_in_backward:
+        # sharded loss computation backpropagates through the generator
+        # shard by shard, before the rest of the model, which also
+        # reaches the generator weights tied to the embeddings
+        late_params, final_params = [], []
+        if shard_size:
+            body = set(id(p) for name, module in model.named_children()
+                       if name != "generator" for p in module.parameters())
+            for p in model.generator.parameters():
+                (final_params if id(p) in body else late_params).append(p)
+        grad_reducer = onmt.utils.distributed.GradientReducer(
+            model.parameters(), late_params=late_params,
+            final_params=final_params)
+
     report_manager = onmt.utils.build_report_manager(opt, gpu_rank)
+    phase_timer = onmt.utils.PhaseTimer(cuda=device_id >= 0) \
+        if opt.phase_timing else None
     trainer = onmt.Trainer(model, train_loss, valid_loss, optim, trunc_size,
                            shard_size, norm_method,
                            accum_count, accum_steps,
@@ -85,11 +126,15 @@ def build_trainer(opt, device_id, model, fields, optim, model_saver=None):
                            model_saver=model_saver if gpu_rank == 0 else None,
                            average_decay=average_decay,
                            average_every=average_every,
+                           average_device=average_device,
                            model_dtype=opt.model_dtype,
                            earlystopper=earlystopper,
                            dropout=dropout,
                            dropout_steps=dropout_steps,
-                           source_noise=source_noise)
+                           source_noise=source_noise,
+                           grad_reducer=grad_reducer,
+                           valid_exact_match=valid_exact_match,
+                           phase_timer=phase_timer)
     return trainer
 
 
@@ -117,6 +162,15 @@ class Trainer(object):
             model_saver(:obj:`onmt.models.ModelSaverBase`): the saver is
                 used to save a checkpoint.
                 Thus nothing will be saved if this parameter is None
+            average_device(str): where to keep the moving average of the
+                parameters, see :class:`onmt.utils.ExponentialMovingAverage`
+            grad_reducer(:obj:`onmt.utils.distributed.GradientReducer`):
+                reduces gradients during backward in multi-process
+                training, or None to reduce them after backward.
+            valid_exact_match(bool): also compute the exact match of
+                greedy decoding in validation.
+            phase_timer(:obj:`onmt.utils.PhaseTimer`): times the phases
+                of the training steps, or None not to.
     """
 
     def __init__(self, model, train_loss, valid_loss, optim,
@@ -125,9 +179,11 @@ class Trainer(object):
                  accum_steps=[0],
                  n_gpu=1, gpu_rank=1, gpu_verbose_level=0,
                  report_manager=None, with_align=False, model_saver=None,
-                 average_decay=0, average_every=1, model_dtype='fp32',
+                 average_decay=0, average_every=1, average_device=None,
+                 model_dtype='fp32',
                  earlystopper=None, dropout=[0.3], dropout_steps=[0],
-                 source_noise=None):
+                 source_noise=None, grad_reducer=None,
+                 valid_exact_match=False, phase_timer=None):
         # Basic attributes.
         self.model = model
         self.train_loss = train_loss
@@ -146,13 +202,19 @@ class Trainer(object):
         self.with_align = with_align
         self.model_saver = model_saver
         self.average_decay = average_decay
-        self.moving_average = None
+        self.moving_average = onmt.utils.ExponentialMovingAverage(
+            model, average_decay, device=average_device) \
+            if average_decay > 0 else None
         self.average_every = average_every
         self.model_dtype = model_dtype
         self.earlystopper = earlystopper
         self.dropout = dropout
         self.dropout_steps = dropout_steps
         self.source_noise = source_noise
+        self.grad_reducer = grad_reducer
+        self.valid_exact_match = valid_exact_match
+        self.phase_timer = phase_timer
+        self._data_wait = 0.
 
         for i in range(len(self.accum_count_l)):
             assert self.accum_count_l[i] > 0
@@ -181,12 +243,18 @@ class Trainer(object):
         batches = []
         normalization = 0
         self.accum_count = self._accum_count(self.optim.training_step)
+        start = time.perf_counter()
         for batch in iterator:
+            self._data_wait += time.perf_counter() - start
             batches.append(batch)
             if self.norm_method == "tokens":
                 num_tokens = batch.tgt[1:, :, 0].ne(
-                    self.train_loss.padding_idx).sum()
-                normalization += num_tokens.item()
+                    self.train_loss.padding_idx).sum().item()
+                if hasattr(batch, "tgt_segments"):
+                    # packed rows: the BOS of all examples but the first
+                    # of each row are not predicted
+                    num_tokens -= batch.batch_size - batch.tgt.size(1)
+                normalization += num_tokens
             else:
                 normalization += batch.batch_size
             if len(batches) == self.accum_count:
@@ -194,23 +262,10 @@ class Trainer(object):
                 self.accum_count = self._accum_count(self.optim.training_step)
                 batches = []
                 normalization = 0
+            start = time.perf_counter()
         if batches:
             yield batches, normalization
 
-    def _update_average(self, step):
-        if self.moving_average is None:
-            copy_params = [params.detach().float()
-                           for params in self.model.parameters()]
-            self.moving_average = copy_params
-        else:
-            average_decay = max(self.average_decay,
-                                1 - (step + 1)/(step + 10))
-            for (i, avg), cpt in zip(enumerate(self.moving_average),
-                                     self.model.parameters()):
-                self.moving_average[i] = \
-                    (1 - average_decay) * avg + \
-                    cpt.detach().float() * average_decay
-
     def train(self,
               train_iter,
               train_steps,
@@ -241,6 +296,8 @@ class Trainer(object):
         total_stats = onmt.utils.Statistics()
         report_stats = onmt.utils.Statistics()
         self._start_report_manager(start_time=total_stats.start_time)
+        # checkpoints record where the data is, when the iterator can tell
+        data_state = getattr(train_iter, "state_dict", lambda: None)
 
         for i, (batches, normalization) in enumerate(
                 self._accum_batches(train_iter)):
@@ -256,72 +313,118 @@ class Trainer(object):
                             % (self.gpu_rank, i + 1, len(batches)))
 
             if self.n_gpu > 1:
-                normalization = sum(onmt.utils.distributed
-                                    .all_gather_list
-                                    (normalization))
+                normalization = onmt.utils.distributed.all_reduce_values(
+                    [normalization])[0]
 
             self._gradient_accumulation(
                 batches, normalization, total_stats,
                 report_stats)
+            report_stats, stop = self._end_step(
+                i, step, train_steps, report_stats, data_state,
+                save_checkpoint_steps, valid_iter, valid_steps)
+            if stop:
+                break
 
-            if self.average_decay > 0 and i % self.average_every == 0:
-                self._update_average(step)
-
-            report_stats = self._maybe_report_training(
-                step, train_steps,
-                self.optim.learning_rate(),
-                report_stats)
+        self._end_training(step, data_state)
+        return total_stats
 
-            if valid_iter is not None and step % valid_steps == 0:
-                if self.gpu_verbose_level > 0:
-                    logger.info('GpuRank %d: validate step %d'
-                                % (self.gpu_rank, step))
-                valid_stats = self.validate(
-                    valid_iter, moving_average=self.moving_average)
-                if self.gpu_verbose_level > 0:
-                    logger.info('GpuRank %d: gather valid stat \
-                                step %d' % (self.gpu_rank, step))
-                valid_stats = self._maybe_gather_stats(valid_stats)
-                if self.gpu_verbose_level > 0:
-                    logger.info('GpuRank %d: report stat step %d'
-                                % (self.gpu_rank, step))
-                self._report_step(self.optim.learning_rate(),
-                                  step, valid_stats=valid_stats)
-                # Run patience mechanism
-                if self.earlystopper is not None:
-                    self.earlystopper(valid_stats, step)
-                    # If the patience has reached the limit, stop training
-                    if self.earlystopper.has_stopped():
-                        break
-
-            if (self.model_saver is not None
-                and (save_checkpoint_steps != 0
-                     and step % save_checkpoint_steps == 0)):
-                self.model_saver.save(step, moving_average=self.moving_average)
-
-            if train_steps > 0 and step >= train_steps:
-                break
+    def _end_step(self, i, step, train_steps, report_stats, data_state,
+                  save_checkpoint_steps, valid_iter, valid_steps):
+        """Average, report, validate and save after the ``i``-th update,
+        see :meth:`train`.
 
+        Returns:
+            (Statistics, bool): the report statistics to go on with, and
+            whether training is over.
+        """
+        report_stats.n_steps += 1
+        report_stats.data_wait += self._data_wait
+        if self.phase_timer is not None:
+            self.phase_timer.add("data", self._data_wait)
+        self._data_wait = 0.
+
+        if self.moving_average is not None \
+                and i % self.average_every == 0:
+            with self._phase("optim"):
+                self.moving_average.update(step)
+        if self.phase_timer is not None:
+            # the checkpoint below counts in the next step
+            self.phase_timer.end_step()
+
+        report_stats = self._maybe_report_training(
+            step, train_steps,
+            self.optim.learning_rate(),
+            report_stats)
+
+        if valid_iter is not None and step % valid_steps == 0:
+            if self.gpu_verbose_level > 0:
+                logger.info('GpuRank %d: validate step %d'
+                            % (self.gpu_rank, step))
+            valid_stats = self.validate(
+                valid_iter, moving_average=self.moving_average)
+            if self.gpu_verbose_level > 0:
+                logger.info('GpuRank %d: gather valid stat \
+                            step %d' % (self.gpu_rank, step))
+            valid_stats = self._maybe_gather_stats(valid_stats)
+            if self.gpu_verbose_level > 0:
+                logger.info('GpuRank %d: report stat step %d'
+                            % (self.gpu_rank, step))
+            self._report_step(self.optim.learning_rate(),
+                              step, valid_stats=valid_stats)
+            # Run patience mechanism
+            if self.earlystopper is not None:
+                self.earlystopper(valid_stats, step)
+                # If the patience has reached the limit, stop training
+                if self.earlystopper.has_stopped():
+                    return report_stats, True
+
+        if (self.model_saver is not None
+            and (save_checkpoint_steps != 0
+                 and step % save_checkpoint_steps == 0)):
+            with self._phase("checkpoint"):
+                self.model_saver.save(
+                    step, moving_average=self.moving_average,
+                    data_state=data_state(), best=self._is_best(step))
+
+        return report_stats, train_steps > 0 and step >= train_steps
+
+    def _end_training(self, step, data_state):
+        """Save the last checkpoint, and wait for it to be written.
+        Write the time of the phases next to it."""
         if self.model_saver is not None:
-            self.model_saver.save(step, moving_average=self.moving_average)
-        return total_stats
+            with self._phase("checkpoint"):
+                self.model_saver.save(
+                    step, moving_average=self.moving_average,
+                    data_state=data_state(), best=self._is_best(step))
+                self.model_saver.wait()
+            if self.phase_timer is not None:
+                path = self.model_saver.base_path + "_phase_timing.json"
+                logger.info("Writing the time of the phases to %s" % path)
+                self.phase_timer.dump(path)
+
+    def _phase(self, name):
+        """Time the phase ``name``, when timing phases."""
+        if self.phase_timer is None:
+            return _untimed()
+        return self.phase_timer(name)
+
+    def _is_best(self, step):
+        """Whether early stopping found the model best at ``step``."""
+        return self.earlystopper is not None \
+            and self.earlystopper.current_step_best == step
 
     def validate(self, valid_iter, moving_average=None):
         """ Validate model.
             valid_iter: validate data iterator
+            moving_average: the :class:`onmt.utils.ExponentialMovingAverage`
+                to evaluate instead of the model
         Returns:
             :obj:`nmt.Statistics`: validation loss statistics
         """
         valid_model = self.model
-        if moving_average:
-            # swap model params w/ moving average
-            # (and keep the original parameters)
-            model_params_data = []
-            for avg, param in zip(self.moving_average,
-                                  valid_model.parameters()):
-                model_params_data.append(param.data)
-                param.data = avg.data.half() if self.optim._fp16 == "legacy" \
-                    else avg.data
+        if moving_average is not None and moving_average.shadow is not None:
+            valid_model = moving_average.module(
+                next(self.model.parameters()).device)
 
         # Set model in validating mode.
         valid_model.eval()
@@ -334,25 +437,42 @@ class Trainer(object):
                                    else (batch.src, None)
                 tgt = batch.tgt
 
-                # F-prop through the model.
-                outputs, attns = valid_model(src, tgt, src_lengths,
-                                             with_align=self.with_align)
+                with self._autocast():
+                    if self.valid_exact_match:
+                        batch_stats = self._validate_exact_match(
+                            valid_model, batch, src, src_lengths, tgt)
+                    else:
+                        # F-prop through the model.
+                        outputs, attns = valid_model(
+                            src, tgt, src_lengths, with_align=self.with_align)
 
-                # Compute loss.
-                _, batch_stats = self.valid_loss(batch, outputs, attns)
+                        # Compute loss.
+                        _, batch_stats = self.valid_loss(
+                            batch, outputs, attns)
 
                 # Update statistics.
                 stats.update(batch_stats)
-        if moving_average:
-            for param_data, param in zip(model_params_data,
-                                         self.model.parameters()):
-                param.data = param_data
 
         # Set model back to training mode.
         valid_model.train()
 
         return stats
 
+    def _validate_exact_match(self, model, batch, src, src_lengths, tgt):
+        """Validation loss and exact match of greedy decoding, from the
+        same encoder pass."""
+        enc_state, memory_bank, lengths = model.encoder(src, src_lengths)
+        model.decoder.init_state(src, memory_bank, enc_state)
+        outputs, attns = model.decoder(tgt[:-1], memory_bank,
+                                       memory_lengths=lengths,
+                                       with_align=self.with_align)
+        _, batch_stats = self.valid_loss(batch, outputs, attns)
+        match = greedy_exact_match(model, src, enc_state, memory_bank,
+                                   lengths, tgt, self.valid_loss.padding_idx)
+        batch_stats.n_sents += match.numel()
+        batch_stats.n_exact += match.sum().item()
+        return batch_stats
+
     def _gradient_accumulation(self, true_batches, normalization, total_stats,
                                report_stats):
         if self.accum_count > 1:
@@ -372,35 +492,54 @@ class Trainer(object):
                 else (batch.src, None)
             if src_lengths is not None:
                 report_stats.n_src_words += src_lengths.sum().item()
+                report_stats.update_padding(
+                    src, src_lengths, batch.tgt, self.train_loss.padding_idx)
 
             tgt_outer = batch.tgt
+            src_segments = getattr(batch, "src_segments", None)
+            tgt_segments = getattr(batch, "tgt_segments", None)
 
             bptt = False
             for j in range(0, target_size-1, trunc_size):
                 # 1. Create truncated target.
                 tgt = tgt_outer[j: j + trunc_size]
+                segments = {}
+                if tgt_segments is not None:
+                    segments = {
+                        "src_segments": src_segments,
+                        "tgt_segments": tgt_segments[j: j + trunc_size]}
 
                 # 2. F-prop all but generator.
                 if self.accum_count == 1:
                     self.optim.zero_grad()
-
-                outputs, attns = self.model(src, tgt, src_lengths, bptt=bptt,
-                                            with_align=self.with_align)
+                if self.grad_reducer is not None:
+                    # only the last micro-batch of a step syncs gradients
+                    self.grad_reducer.arm(
+                        self.accum_count == 1
+                        or k == len(true_batches) - 1)
+
+                with self._phase("forward"), self._autocast():
+                    outputs, attns = self.model(
+                        src, tgt, src_lengths, bptt=bptt,
+                        with_align=self.with_align, **segments)
                 bptt = True
 
                 # 3. Compute loss.
                 try:
-                    loss, batch_stats = self.train_loss(
-                        batch,
-                        outputs,
-                        attns,
-                        normalization=normalization,
-                        shard_size=self.shard_size,
-                        trunc_start=j,
-                        trunc_size=trunc_size)
+                    with self._phase("loss"), self._autocast():
+                        loss, batch_stats = self.train_loss(
+                            batch,
+                            outputs,
+                            attns,
+                            normalization=normalization,
+                            shard_size=self.shard_size,
+                            trunc_start=j,
+                            trunc_size=trunc_size,
+                            phase_timer=self.phase_timer)
 
                     if loss is not None:
-                        self.optim.backward(loss)
+                        with self._phase("backward"):
+                            self.optim.backward(loss)
 
                     total_stats.update(batch_stats)
                     report_stats.update(batch_stats)
@@ -414,12 +553,8 @@ class Trainer(object):
                 if self.accum_count == 1:
                     # Multi GPU gradient gather
                     if self.n_gpu > 1:
-                        grads = [p.grad.data for p in self.model.parameters()
-                                 if p.requires_grad
-                                 and p.grad is not None]
-                        onmt.utils.distributed.all_reduce_and_rescale_tensors(
-                            grads, float(1))
-                    self.optim.step()
+                        self._reduce_gradients()
+                    self._optim_step()
 
                 # If truncated, don't backprop fully.
                 # TO CHECK
@@ -432,13 +567,33 @@ class Trainer(object):
         # update only after accum batches
         if self.accum_count > 1:
             if self.n_gpu > 1:
-                grads = [p.grad.data for p in self.model.parameters()
-                         if p.requires_grad
-                         and p.grad is not None]
-                onmt.utils.distributed.all_reduce_and_rescale_tensors(
-                    grads, float(1))
+                self._reduce_gradients()
+            self._optim_step()
+
+    def _optim_step(self):
+        if self.moving_average is not None:
+            # the average may still be copying the parameters
+            self.moving_average.wait_for_copies()
+        with self._phase("optim"):
             self.optim.step()
 
+    def _autocast(self):
+        """The mixed precision context of ``-model_dtype bf16``."""
+        return onmt.utils.misc.autocast(
+            self.model_dtype, next(self.model.parameters()).device)
+
+    def _reduce_gradients(self):
+        """Sum the gradients of all processes."""
+        with self._phase("all_reduce"):
+            if self.grad_reducer is not None:
+                self.grad_reducer.finish()
+                return
+            grads = [p.grad.data for p in self.model.parameters()
+                     if p.requires_grad
+                     and p.grad is not None]
+            onmt.utils.distributed.all_reduce_and_rescale_tensors(
+                grads, float(1))
+
     def _start_report_manager(self, start_time=None):
         """
         Simple function to start report manager (if any)
@@ -473,7 +628,7 @@ class Trainer(object):
         if self.report_manager is not None:
             return self.report_manager.report_training(
                 step, num_steps, learning_rate, report_stats,
-                multigpu=self.n_gpu > 1)
+                multigpu=self.n_gpu > 1, phase_timer=self.phase_timer)
 
     def _report_step(self, learning_rate, step, train_stats=None,
                      valid_stats=None):
@@ -490,3 +645,251 @@ class Trainer(object):
         if self.source_noise is not None:
             return self.source_noise(batch)
         return batch
+
+
+class _LogPrefix(logging.Filter):
+    def __init__(self, prefix):
+        super(_LogPrefix, self).__init__()
+        self.prefix = prefix
+
+    def filter(self, record):
+        record.msg = self.prefix + str(record.msg)
+        return True
+
+
+class ReplicaTrainer(object):
+    """Train independently initialized replicas of a model at once.
+
+    Each replica is a :class:`Trainer`, with its own model, optimizer,
+    moving average, early stopping, checkpoints and reports, and its own
+    random state. The replicas share one data iterator, or each have
+    theirs, and make their updates together: transformers run as one
+    :class:`onmt.models.stacked.StackedModel` (with torch>=2.0), other
+    models one after the other.
+    The loss of each replica is then computed on its own decoder output,
+    and a single backward pass goes through the models.
+
+    A replica stops like a single training run, after ``train_steps`` or
+    from early stopping, and the others go on.
+
+    Args:
+        trainers (List[Trainer]): the replicas.
+        rng_states (List[dict]): the random state of each replica, see
+            :func:`onmt.utils.misc.get_rng_state`.
+    """
+
+    def __init__(self, trainers, rng_states):
+        self.trainers = trainers
+        self.rng_states = rng_states
+        self.stacked = None
+        models = [t.model for t in trainers]
+        if hasattr(torch, "func"):
+            # not at module level: torch.func requires torch>=2.0
+            from onmt.models.stacked import StackedModel
+            if all(StackedModel.supports(m) for m in models):
+                self.stacked = StackedModel(models)
+        logger.info("Training %d replicas %s." % (
+            len(trainers), "stacked" if self.stacked is not None
+            else "one after the other"))
+
+    @contextmanager
+    def _replica(self, k):
+        """Run as replica ``k``: with its random state, and its number
+        in the logs."""
+        onmt.utils.misc.set_rng_state(self.rng_states[k])
+        prefix = _LogPrefix("[replica %d] " % k)
+        logger.addFilter(prefix)
+        try:
+            yield
+        finally:
+            logger.removeFilter(prefix)
+            self.rng_states[k] = onmt.utils.misc.get_rng_state()
+
+    def train(self,
+              train_iters,
+              train_steps,
+              save_checkpoint_steps=5000,
+              valid_iter=None,
+              valid_steps=10000):
+        """Train the replicas, see :meth:`Trainer.train`.
+
+        Args:
+            train_iters (list): the training iterator of each replica, or
+                a single one which they all go through.
+
+        Returns:
+            List[Statistics]: the statistics of each replica.
+        """
+        trainers = self.trainers
+        shared = len(train_iters) == 1
+        if shared:
+            streams = [trainers[0]._accum_batches(train_iters[0])]
+        else:
+            streams = [t._accum_batches(it)
+                       for t, it in zip(trainers, train_iters)]
+        data_states = [getattr(it, "state_dict", lambda: None)
+                       for it in train_iters]
+        if shared:
+            data_states = data_states * len(trainers)
+
+        total_stats = [onmt.utils.Statistics() for _ in trainers]
+        report_stats = [onmt.utils.Statistics() for _ in trainers]
+        for t, stats in zip(trainers, total_stats):
+            t._start_report_manager(start_time=stats.start_time)
+        steps = [t.optim.training_step for t in trainers]
+        live = list(range(len(trainers)))
+        for i in count():
+            # loading shards draws from the random state of the reader
+            if shared:
+                with self._replica(0):
+                    accum = next(streams[0], None)
+                wait, trainers[0]._data_wait = trainers[0]._data_wait, 0.
+                accums = [accum] * len(live)
+                for k in live:
+                    trainers[k]._data_wait = wait
+            else:
+                accums = []
+                for k in live:
+                    with self._replica(k):
+                        accums.append(next(streams[k], None))
+            done = [k for k, accum in zip(live, accums) if accum is None]
+            if done:
+                # out of data
+                self._stop(done, live, steps, data_states)
+                accums = [a for a in accums if a is not None]
+                if not live:
+                    break
+
+            for k in live:
+                steps[k] = trainers[k].optim.training_step
+                trainers[k]._maybe_update_dropout(steps[k])
+            self._gradient_accumulation(
+                live, [batches for batches, _ in accums],
+                [normalization for _, normalization in accums],
+                total_stats, report_stats)
+
+            done = []
+            for k in live:
+                with self._replica(k):
+                    report_stats[k], stop = trainers[k]._end_step(
+                        i, steps[k], train_steps, report_stats[k],
+                        data_states[k], save_checkpoint_steps,
+                        valid_iter, valid_steps)
+                if stop:
+                    done.append(k)
+            self._stop(done, live, steps, data_states)
+            if not live:
+                break
+        return total_stats
+
+    def _stop(self, done, live, steps, data_states):
+        """End the training of the replicas ``done``, removing them
+        from ``live``."""
+        if not done:
+            return
+        for k in done:
+            with self._replica(k):
+                logger.info("Replica done at step %d." % steps[k])
+                self.trainers[k]._end_training(steps[k], data_states[k])
+        if self.stacked is not None:
+            self.stacked.select(
+                [j for j, k in enumerate(live) if k not in done])
+        live[:] = [k for k in live if k not in done]
+
+    def _gradient_accumulation(self, live, true_batches, normalizations,
+                               total_stats, report_stats):
+        trainers = [self.trainers[k] for k in live]
+        for t in trainers:
+            t.optim.zero_grad()
+        if self.stacked is not None:
+            self.stacked.zero_grad()
+
+        for j in range(max(len(batches) for batches in true_batches)):
+            group = [(i, batches[j]) for i, batches in enumerate(true_batches)
+                     if j < len(batches)]
+            for i, batch in group:
+                src, src_lengths = batch.src
+                stats = report_stats[live[i]]
+                stats.n_src_words += src_lengths.sum().item()
+                stats.update_padding(
+                    src, src_lengths, batch.tgt,
+                    trainers[i].train_loss.padding_idx)
+
+            with trainers[0]._autocast():
+                outputs = self._forward(live, group)
+            roots, grads = [], []
+            for (i, batch), output in zip(group, outputs):
+                t, k = trainers[i], live[i]
+                # the loss backpropagates to the output only, then one
+                # backward pass goes through all the models
+                leaf = output.detach().requires_grad_()
+                with t._autocast():
+                    loss, batch_stats = t.train_loss(
+                        batch, leaf, {},
+                        normalization=normalizations[i],
+                        shard_size=t.shard_size)
+                if loss is not None:
+                    t.optim.backward(loss)
+                total_stats[k].update(batch_stats)
+                report_stats[k].update(batch_stats)
+                if leaf.grad is not None:
+                    roots.append(output)
+                    grads.append(leaf.grad)
+            torch.autograd.backward(roots, grads)
+
+        if self.stacked is not None:
+            self.stacked.scatter_grads()
+        for t in trainers:
+            t._optim_step()
+
+    def _forward(self, live, group):
+        """The decoder outputs of the replicas of ``group``, a list of
+        ``(i, batch)`` giving the batch of replica ``live[i]``."""
+        batches = [batch for _, batch in group]
+        segments = [{"src_segments": b.src_segments,
+                     "tgt_segments": b.tgt_segments}
+                    if hasattr(b, "tgt_segments") else {} for b in batches]
+        shared = all(b is batches[0] for b in batches)
+        if self.stacked is not None and len(group) == len(live) \
+                and (shared or not segments[0]):
+            if shared:
+                src, lengths = batches[0].src
+                return list(self.stacked(src, batches[0].tgt, lengths,
+                                         **segments[0]))
+            src, tgt, lengths = _stack_batches(batches)
+            outputs = self.stacked(src, tgt, lengths, batched=True)
+            return [out[:b.tgt.size(0) - 1, :b.tgt.size(1)].contiguous()
+                    for out, b in zip(outputs, batches)]
+
+        outputs = []
+        for (i, batch), seg in zip(group, segments):
+            k = live[i]
+            src, lengths = batch.src
+            with self._replica(k):
+                output, _ = self.trainers[k].model(
+                    src, batch.tgt, lengths, **seg)
+            outputs.append(output)
+        return outputs
+
+
+def _stack_batches(batches):
+    """Stack the sources, targets and source lengths of ``batches``,
+    padded to the same shape. Padding positions hold token 0, masked out
+    of the sources and after the end of the targets; padding examples
+    are copies of the first one."""
+    def pad(x, length, batch_size):
+        out = x.new_zeros((length, batch_size) + x.shape[2:])
+        out[:x.size(0), :x.size(1)] = x
+        out[:x.size(0), x.size(1):] = x[:, :1]
+        return out
+
+    srcs = [b.src[0] for b in batches]
+    src_len = max(src.size(0) for src in srcs)
+    tgt_len = max(b.tgt.size(0) for b in batches)
+    batch_size = max(b.tgt.size(1) for b in batches)
+    src = torch.stack([pad(s, src_len, batch_size) for s in srcs])
+    tgt = torch.stack([pad(b.tgt, tgt_len, batch_size) for b in batches])
+    lengths = torch.stack([
+        torch.cat([b.src[1], b.src[1][:1].expand(
+            batch_size - b.src[1].size(0))]) for b in batches])
+    return src, tgt, lengths
@@ -3,6 +3,61 @@ import torch
 from onmt.translate.decode_strategy import DecodeStrategy
 
 
+def greedy_exact_match(model, src, enc_state, memory_bank, memory_lengths,
+                       tgt, tgt_pad):
+    """Whether greedy decoding reproduces each target exactly.
+
+    Decodes the batch at once from an encoder pass already run, e.g. for
+    the validation loss. A sequence leaves the batch as soon as its
+    prediction differs from its target, or ends with it at its EOS, so
+    decoding runs no longer than it takes to know the answer. Copy
+    attention is not supported.
+
+    Args:
+        model (onmt.models.NMTModel): the model, whose decoder state
+            gets reset.
+        src, enc_state, memory_bank, memory_lengths: the encoder input
+            and outputs.
+        tgt (LongTensor): the targets ``(tgt_len, batch, 1)``, from BOS
+            to EOS.
+        tgt_pad (int): padding index of the targets.
+
+    Returns:
+        BoolTensor: ``(batch,)``, ``True`` for exact matches.
+    """
+
+    gold = tgt[1:, :, 0]
+    last = gold.ne(tgt_pad).sum(0) - 1
+    batch_size = gold.size(1)
+    match = torch.zeros(batch_size, dtype=torch.bool, device=gold.device)
+    alive = torch.arange(batch_size, device=gold.device)
+    model.decoder.init_state(src, memory_bank, enc_state)
+    decoder_in = tgt[:1]
+    for step in range(gold.size(0)):
+        dec_out, _ = model.decoder(decoder_in, memory_bank,
+                                   memory_lengths=memory_lengths, step=step)
+        pred = model.generator(dec_out.squeeze(0)).argmax(-1)
+        correct = pred.eq(gold[step, alive])
+        ended = correct & last[alive].eq(step)
+        match[alive[ended]] = True
+        keep = (correct & ~ended).nonzero().view(-1)
+        if keep.numel() == 0:
+            break
+        if keep.numel() < alive.numel():
+            alive = alive[keep]
+            pred = pred[keep]
+            if isinstance(memory_bank, tuple):
+                memory_bank = tuple(x.index_select(1, keep)
+                                    for x in memory_bank)
+            else:
+                memory_bank = memory_bank.index_select(1, keep)
+            memory_lengths = memory_lengths.index_select(0, keep)
+            model.decoder.map_state(
+                lambda state, dim: state.index_select(dim, keep))
+        decoder_in = pred.view(1, -1, 1)
+    return match
+
+
 def sample_with_temperature(logits, sampling_temp, keep_topk):
     """Select next tokens randomly from the top k possible next tokens.
 
@@ -41,7 +41,7 @@ class TranslationBuilder(object):
             if tok < len(vocab):
                 tokens.append(vocab.itos[tok])
             else:
-                tokens.append(src_vocab.itos[tok - len(vocab)])
+                tokens.append(src_vocab[tok - len(vocab)])
             if tokens[-1] == tgt_field.eos_token:
                 tokens = tokens[:-1]
                 break
@@ -87,8 +87,8 @@ class TranslationBuilder(object):
         translations = []
         for b in range(batch_size):
             if self._has_text_src:
-                src_vocab = self.data.src_vocabs[inds[b]] \
-                    if self.data.src_vocabs else None
+                src_vocab = batch.src_ex_vocab.itos(perm[b]) \
+                    if hasattr(batch, "src_ex_vocab") else None
                 src_raw = self.data.examples[inds[b]].src[0]
             else:
                 src_vocab = None
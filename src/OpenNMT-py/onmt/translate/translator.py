@@ -12,9 +12,10 @@ import torch
 import onmt.model_builder
 import onmt.inputters as inputters
 import onmt.decoders.ensemble
+from onmt.inputters.sampler import max_src_tok_len
 from onmt.translate.beam_search import BeamSearch
 from onmt.translate.greedy_search import GreedySearch
-from onmt.utils.misc import tile, set_random_seed, report_matrix
+from onmt.utils.misc import tile, set_random_seed, report_matrix, autocast
 from onmt.utils.alignment import extract_alignment, build_align_pharaoh
 from onmt.modules.copy_generator import collapse_copy_scores
 
@@ -43,25 +44,6 @@ def build_translator(opt, report_score=True, logger=None, out_file=None):
     return translator
 
 
-def max_tok_len(new, count, sofar):
-    """
-    In token batching scheme, the number of sequences is limited
-    such that the total number of src/tgt tokens (including padding)
-    in a batch <= batch_size
-    """
-    # Maintains the longest src and tgt length in the current batch
-    global max_src_in_batch  # this is a hack
-    # Reset current longest length at a new batch (count=1)
-    if count == 1:
-        max_src_in_batch = 0
-        # max_tgt_in_batch = 0
-    # Src: [<bos> w1 ... wN <eos>]
-    max_src_in_batch = max(max_src_in_batch, len(new.src[0]) + 2)
-    # Tgt: [w1 ... wM <eos>]
-    src_elements = count * max_src_in_batch
-    return src_elements
-
-
 class Translator(object):
     """Translate a batch of sentences with a saved model.
 
@@ -99,6 +81,8 @@ class Translator(object):
         out_file (TextIO or codecs.StreamReaderWriter): Output file.
         report_score (bool) : Whether to report scores
         logger (logging.Logger or NoneType): Logger.
+        bf16 (bool): Decode under bfloat16 autocast, see
+            :func:`onmt.utils.misc.autocast`.
     """
 
     def __init__(
@@ -130,7 +114,8 @@ class Translator(object):
             report_align=False,
             report_score=True,
             logger=None,
-            seed=-1):
+            seed=-1,
+            bf16=False):
         self.model = model
         self.fields = fields
         tgt_field = dict(self.fields)["tgt"].base_field
@@ -183,6 +168,7 @@ class Translator(object):
         self.report_align = report_align
         self.report_score = report_score
         self.logger = logger
+        self.bf16 = bf16
 
         self.use_filter_pred = False
         self._filter_pred = None
@@ -259,7 +245,8 @@ class Translator(object):
             report_align=report_align,
             report_score=report_score,
             logger=logger,
-            seed=opt.seed)
+            seed=opt.seed,
+            bf16=opt.bf16)
 
     def _log(self, msg):
         if self.logger:
@@ -267,11 +254,11 @@ class Translator(object):
         else:
             print(msg)
 
-    def _gold_score(self, batch, memory_bank, src_lengths, src_vocabs,
+    def _gold_score(self, batch, memory_bank, src_lengths,
                     use_src_map, enc_states, batch_size, src):
         if "tgt" in batch.__dict__:
             gs = self._score_target(
-                batch, memory_bank, src_lengths, src_vocabs,
+                batch, memory_bank, src_lengths,
                 batch.src_map if use_src_map else None)
             self.model.decoder.init_state(src, memory_bank, enc_states)
         else:
@@ -328,7 +315,7 @@ class Translator(object):
             dataset=data,
             device=self._dev,
             batch_size=batch_size,
-            batch_size_fn=max_tok_len if batch_type == "tokens" else None,
+            batch_size_fn=max_src_tok_len if batch_type == "tokens" else None,
             train=False,
             sort=False,
             sort_within_batch=True,
@@ -352,9 +339,7 @@ class Translator(object):
         start_time = time.time()
 
         for batch in data_iter:
-            batch_data = self.translate_batch(
-                batch, data.src_vocabs, attn_debug
-            )
+            batch_data = self.translate_batch(batch, attn_debug)
             translations = xlation_builder.from_batch(batch_data)
 
             for trans in translations:
@@ -513,9 +498,10 @@ class Translator(object):
             alignment_attn, prediction_mask, src_lengths, n_best)
         return alignement
 
-    def translate_batch(self, batch, src_vocabs, attn_debug):
+    def translate_batch(self, batch, attn_debug):
         """Translate a batch of sentences."""
-        with torch.no_grad():
+        with torch.no_grad(), autocast(
+                "bf16" if self.bf16 else "fp32", self._dev):
             if self.beam_size == 1:
                 decode_strategy = GreedySearch(
                     pad=self._tgt_pad_idx,
@@ -545,7 +531,7 @@ class Translator(object):
                     exclusion_tokens=self._exclusion_idxs,
                     stepwise_penalty=self.stepwise_penalty,
                     ratio=self.ratio)
-            return self._translate_batch_with_strategy(batch, src_vocabs,
+            return self._translate_batch_with_strategy(batch,
                                                        decode_strategy)
 
     def _run_encoder(self, batch):
@@ -568,7 +554,6 @@ class Translator(object):
             decoder_in,
             memory_bank,
             batch,
-            src_vocabs,
             memory_lengths,
             src_map=None,
             step=None,
@@ -611,7 +596,6 @@ class Translator(object):
                 scores,
                 batch,
                 self._tgt_vocab,
-                src_vocabs,
                 batch_dim=0,
                 batch_offset=batch_offset
             )
@@ -624,13 +608,11 @@ class Translator(object):
     def _translate_batch_with_strategy(
             self,
             batch,
-            src_vocabs,
             decode_strategy):
         """Translate a batch of sentences step by step using cache.
 
         Args:
             batch: a batch of sentences, yield by data iterator.
-            src_vocabs (list): list of torchtext.data.Vocab if can_copy.
             decode_strategy (DecodeStrategy): A decode strategy to use for
                 generate translation step by step.
 
@@ -652,7 +634,7 @@ class Translator(object):
             "attention": None,
             "batch": batch,
             "gold_score": self._gold_score(
-                batch, memory_bank, src_lengths, src_vocabs, use_src_map,
+                batch, memory_bank, src_lengths, use_src_map,
                 enc_states, batch_size, src)}
 
         # (2) prep decode_strategy. Possibly repeat src objects.
@@ -670,7 +652,6 @@ class Translator(object):
                 decoder_input,
                 memory_bank,
                 batch,
-                src_vocabs,
                 memory_lengths=memory_lengths,
                 src_map=src_map,
                 step=step,
@@ -712,13 +693,12 @@ class Translator(object):
             results["alignment"] = [[] for _ in range(batch_size)]
         return results
 
-    def _score_target(self, batch, memory_bank, src_lengths,
-                      src_vocabs, src_map):
+    def _score_target(self, batch, memory_bank, src_lengths, src_map):
         tgt = batch.tgt
         tgt_in = tgt[:-1]
 
         log_probs, attn = self._decode_and_generate(
-            tgt_in, memory_bank, batch, src_vocabs,
+            tgt_in, memory_bank, batch,
             memory_lengths=src_lengths, src_map=src_map)
 
         log_probs[:, :, self._tgt_pad_idx] = 0
@@ -6,8 +6,11 @@ from onmt.utils.statistics import Statistics
 from onmt.utils.optimizers import MultipleOptimizer, \
     Optimizer, AdaFactor
 from onmt.utils.earlystopping import EarlyStopping, scorers_from_opts
+from onmt.utils.ema import ExponentialMovingAverage
+from onmt.utils.phase_timer import PhaseTimer
 
 __all__ = ["split_corpus", "aeq", "use_gpu", "set_random_seed", "ReportMgr",
            "build_report_manager", "Statistics",
            "MultipleOptimizer", "Optimizer", "AdaFactor", "EarlyStopping",
-           "scorers_from_opts", "make_batch_align_matrix"]
+           "scorers_from_opts", "make_batch_align_matrix",
+           "ExponentialMovingAverage", "PhaseTimer"]
@@ -17,21 +17,43 @@ def is_master(opt, device_id):
     return opt.gpu_ranks[device_id] == 0
 
 
-def multi_init(opt, device_id):
+def multi_init(opt, device_id, rank=None):
+    """Join the process group of distributed training.
+
+    Args:
+        opt: the training options.
+        device_id (int): the GPU of the process, -1 for CPU processes,
+            which use the gloo backend.
+        rank (int): rank of the process, ``opt.gpu_ranks[device_id]``
+            by default.
+
+    Returns:
+        the rank of the process.
+    """
+    if rank is None:
+        rank = opt.gpu_ranks[device_id]
     dist_init_method = 'tcp://{master_ip}:{master_port}'.format(
         master_ip=opt.master_ip,
         master_port=opt.master_port)
     dist_world_size = opt.world_size
     torch.distributed.init_process_group(
-        backend=opt.gpu_backend, init_method=dist_init_method,
-        world_size=dist_world_size, rank=opt.gpu_ranks[device_id])
+        backend=opt.gpu_backend if device_id >= 0 else 'gloo',
+        init_method=dist_init_method,
+        world_size=dist_world_size, rank=rank)
     gpu_rank = torch.distributed.get_rank()
-    if not is_master(opt, device_id):
+    if gpu_rank != 0:
         logger.disabled = True
 
     return gpu_rank
 
 
+def broadcast_seed(seed, src=0):
+    """Return the ``seed`` of process ``src`` on all processes."""
+    tensor = torch.tensor([seed], dtype=torch.long, device=_device())
+    torch.distributed.broadcast(tensor, src)
+    return tensor.item()
+
+
 def all_reduce_and_rescale_tensors(tensors, rescale_denom,
                                    buffer_size=10485760):
     """All-reduce and rescale tensors in chunks of the specified size.
@@ -86,37 +108,168 @@ def all_reduce_and_rescale_tensors(tensors, rescale_denom,
         all_reduce_buffer()
 
 
-def all_gather_list(data, max_size=4096):
-    """Gathers arbitrary data from all nodes into a list."""
+def _device():
+    """Where tensors of the default process group go: gloo reduces CPU
+    tensors, nccl CUDA ones."""
+    if torch.distributed.get_backend() == 'nccl':
+        return torch.device('cuda', torch.cuda.current_device())
+    return torch.device('cpu')
+
+
+def all_reduce_values(values):
+    """Sum numbers over all processes, in float64.
+
+    Args:
+        values (List[float] or List[List[float]]): the numbers of this
+            process.
+
+    Returns:
+        the sums, as a list of the same shape as ``values``.
+    """
+    tensor = torch.tensor(values, dtype=torch.float64, device=_device())
+    torch.distributed.all_reduce(tensor)
+    return tensor.tolist()
+
+
+def all_gather_list(data):
+    """Gathers arbitrary picklable data from all nodes into a list.
+
+    The sizes of the pickles are exchanged first, so that ``data`` can be
+    of any size.
+    """
     world_size = torch.distributed.get_world_size()
-    if not hasattr(all_gather_list, '_in_buffer') or \
-            max_size != all_gather_list._in_buffer.size():
-        all_gather_list._in_buffer = torch.cuda.ByteTensor(max_size)
-        all_gather_list._out_buffers = [
-            torch.cuda.ByteTensor(max_size)
-            for i in range(world_size)
-        ]
-    in_buffer = all_gather_list._in_buffer
-    out_buffers = all_gather_list._out_buffers
+    device = _device()
 
     enc = pickle.dumps(data)
-    enc_size = len(enc)
-    if enc_size + 2 > max_size:
-        raise ValueError(
-            'encoded data exceeds max_size: {}'.format(enc_size + 2))
-    assert max_size < 255*256
-    in_buffer[0] = enc_size // 255  # this encoding works for max_size < 65k
-    in_buffer[1] = enc_size % 255
-    in_buffer[2:enc_size+2] = torch.ByteTensor(list(enc))
-
-    torch.distributed.all_gather(out_buffers, in_buffer.cuda())
-
-    results = []
-    for i in range(world_size):
-        out_buffer = out_buffers[i]
-        size = (255 * out_buffer[0].item()) + out_buffer[1].item()
-
-        bytes_list = bytes(out_buffer[2:size+2].tolist())
-        result = pickle.loads(bytes_list)
-        results.append(result)
-    return results
+    size = torch.tensor([len(enc)], dtype=torch.long, device=device)
+    sizes = [torch.empty_like(size) for _ in range(world_size)]
+    torch.distributed.all_gather(sizes, size)
+    sizes = [s.item() for s in sizes]
+
+    in_buffer = torch.zeros(max(sizes), dtype=torch.uint8, device=device)
+    in_buffer[:len(enc)] = torch.ByteTensor(bytearray(enc))
+    out_buffers = [torch.empty_like(in_buffer) for _ in range(world_size)]
+    torch.distributed.all_gather(out_buffers, in_buffer)
+
+    return [pickle.loads(out_buffer[:size].cpu().numpy().tobytes())
+            for out_buffer, size in zip(out_buffers, sizes)]
+
+
+class GradientReducer(object):
+    """All-reduce gradients in buckets, while backward computes the others.
+
+    Each parameter's gradient hook marks it ready; a bucket is all-reduced
+    asynchronously once all its parameters are ready and the buckets
+    before it were launched, so that every process issues the same
+    collectives in the same order. Hooks only count while the reducer is
+    armed, for the backward of the last micro-batch of a step.
+
+    Gradients of ``late_params`` are completed over several backward
+    passes before the last one, e.g. the generator's over loss shards.
+    They are reduced first, as soon as the last backward reaches the
+    other parameters.
+
+    Gradients of ``final_params`` accumulate over those passes and the
+    last one too, e.g. a generator weight tied to the embeddings: their
+    hook would run once per pass. They are reduced last, by
+    :meth:`finish`.
+
+    Args:
+        params (Iterable[torch.nn.Parameter]): the parameters to reduce.
+        late_params (Iterable[torch.nn.Parameter]): see above.
+        final_params (Iterable[torch.nn.Parameter]): see above.
+        bucket_size (int): size of the buckets, in bytes.
+    """
+
+    def __init__(self, params, late_params=(), final_params=(),
+                 bucket_size=10485760):
+        params = [p for p in params if p.requires_grad]
+        late = set(id(p) for p in late_params)
+        final = set(id(p) for p in final_params)
+        hooked = [p for p in params if id(p) not in late | final]
+        # backward reaches parameters roughly in reverse order
+        order = [p for p in params if id(p) in late] + \
+            hooked[::-1] + [p for p in params if id(p) in final]
+        self.buckets = []
+        self._bucket_of = {}
+        for p in order:
+            group = "late" if id(p) in late \
+                else "final" if id(p) in final else "hooked"
+            bucket = self.buckets[-1] if self.buckets else None
+            if bucket is None or bucket["group"] != group \
+                    or bucket["dtype"] != p.dtype \
+                    or bucket["device"] != p.device \
+                    or (bucket["numel"] + p.numel()) * p.element_size() \
+                    > bucket_size:
+                bucket = {"params": [], "numel": 0, "group": group,
+                          "late": group == "late",
+                          "dtype": p.dtype, "device": p.device}
+                self.buckets.append(bucket)
+            bucket["params"].append(p)
+            bucket["numel"] += p.numel()
+            self._bucket_of[p] = len(self.buckets) - 1
+        for bucket in self.buckets:
+            bucket["buffer"] = torch.zeros(
+                bucket["numel"], dtype=bucket["dtype"],
+                device=bucket["device"])
+        for p in hooked:
+            p.register_post_accumulate_grad_hook(self._ready)
+        self.armed = False
+        self._reset()
+
+    def _reset(self):
+        self._pending = [len(b["params"]) for b in self.buckets]
+        self._launched = 0
+        self._works = []
+
+    def arm(self, armed=True):
+        """Reduce buckets during the next backward passes if ``armed``."""
+        self.armed = armed
+
+    def _ready(self, param):
+        if not self.armed:
+            return
+        if self.buckets[0]["late"] and self._pending[0]:
+            # the last backward started: late gradients are complete
+            for i, bucket in enumerate(self.buckets):
+                if bucket["late"]:
+                    self._pending[i] = 0
+        self._pending[self._bucket_of[param]] -= 1
+        while self._launched < len(self.buckets) \
+                and self._pending[self._launched] == 0:
+            self._launch(self._launched)
+
+    def _launch(self, i):
+        bucket = self.buckets[i]
+        offset = 0
+        for p in bucket["params"]:
+            numel = p.numel()
+            if p.grad is None:
+                bucket["buffer"][offset:offset + numel].zero_()
+            else:
+                bucket["buffer"][offset:offset + numel].copy_(p.grad.view(-1))
+            offset += numel
+        self._works.append(torch.distributed.all_reduce(
+            bucket["buffer"], async_op=True))
+        self._launched += 1
+
+    def finish(self):
+        """Reduce the buckets left, wait for all of them and write the sums
+        into the gradients."""
+        while self._launched < len(self.buckets):
+            self._launch(self._launched)
+        for work in self._works:
+            work.wait()
+        for bucket in self.buckets:
+            offset = 0
+            for p in bucket["params"]:
+                numel = p.numel()
+                reduced = bucket["buffer"][offset:offset + numel].view_as(p)
+                if p.grad is not None:
+                    p.grad.copy_(reduced)
+                elif reduced.any():
+                    # unused here, but not in other processes
+                    p.grad = reduced.clone()
+                offset += numel
+        self.armed = False
+        self._reset()
@@ -1,7 +1,6 @@
 
 from enum import Enum
 from onmt.utils.logging import logger
-from shutil import copyfile
 
 class PatienceEnum(Enum):
     IMPROVING = 0
@@ -73,13 +72,29 @@ class AccuracyScorer(Scorer):
         return stats.accuracy()
 
 
+class ExactMatchScorer(Scorer):
+
+    def __init__(self):
+        super(ExactMatchScorer, self).__init__(float("-inf"), "exact_match")
+
+    def is_improving(self, stats):
+        return stats.exact_match() > self.best_score
+
+    def is_decreasing(self, stats):
+        return stats.exact_match() < self.best_score
+
+    def _caller(self, stats):
+        return stats.exact_match()
+
+
 DEFAULT_SCORERS = [PPLScorer(), AccuracyScorer()]
 
 
 SCORER_BUILDER = {
     "ppl": PPLScorer,
     "accuracy": AccuracyScorer,
-    "loss": LossScorer
+    "loss": LossScorer,
+    "exact_match": ExactMatchScorer
 }
 
 
@@ -97,7 +112,7 @@ def scorers_from_opts(opt):
 
 class EarlyStopping(object):
 
-    def __init__(self, tolerance, scorers=DEFAULT_SCORERS, base_path=""):
+    def __init__(self, tolerance, scorers=DEFAULT_SCORERS):
         """
             Callable class to keep track of early stopping.
 
@@ -112,7 +127,6 @@ class EarlyStopping(object):
         self.early_stopping_scorers = scorers
         self.status = PatienceEnum.IMPROVING
         self.current_step_best = 0
-        self.base_path = base_path
 
     def __call__(self, valid_stats, step):
         """
@@ -196,9 +210,6 @@ class EarlyStopping(object):
     def _log_best_step(self):
         logger.info("Best model found at step {}".format(
             self.current_step_best))
-        best_path = "{}_step_{}.pt".format(self.base_path, self.current_step_best)
-        new_path = "{}_best.pt".format(self.base_path)
-        copyfile(best_path, new_path)
 
     def _decreasing_or_stopped_status_update(self, tolerance):
         self.status = PatienceEnum.DECREASING \
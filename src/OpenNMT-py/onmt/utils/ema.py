@@ -0,0 +1,136 @@
+"""Exponential moving average of the weights of a model."""
+import copy
+
+import torch
+
+
+class ExponentialMovingAverage(object):
+    """Exponential moving average (EMA) of the parameters of a model.
+
+    The average is held as fp32 tensors updated in place, with
+    ``torch._foreach`` ops when available, so that updates do not
+    allocate. It can be kept on the CPU: the parameters are then copied to
+    preallocated buffers on a side CUDA stream, and the update is applied
+    when the average is next needed, overlapping with training. The
+    parameters must not change before :meth:`wait_for_copies`.
+
+    :meth:`module` gives a copy of the model whose parameters are the
+    average, to evaluate or save it without touching the model.
+
+    Args:
+        model (nn.Module): the model, generator included.
+        decay (float): the weight of the current parameters in an update,
+            see :meth:`update`.
+        device (torch.device or str): where to keep the average, that of
+            each parameter if ``None``.
+    """
+
+    def __init__(self, model, decay, device=None):
+        self.model = model
+        self.decay = decay
+        self.device = None if device is None else torch.device(device)
+        self.updates = 0
+        self.shadow = None
+        self._staging = None
+        self._stream = None
+        self._pending = None
+        self._module = None
+
+    def _params(self):
+        return [p.detach() for p in self.model.parameters()]
+
+    def _init_shadow(self):
+        params = self._params()
+        self.shadow = [
+            p.to(device=self.device or p.device, dtype=torch.float32,
+                 copy=True)
+            for p in params]
+        if any(p.dtype != s.dtype or p.device != s.device
+               for p, s in zip(params, self.shadow)):
+            self._staging = [torch.empty_like(s) for s in self.shadow]
+            if self.device is not None and self.device.type == "cpu" \
+                    and torch.cuda.is_available():
+                self._staging = [s.pin_memory() for s in self._staging]
+                self._stream = torch.cuda.Stream()
+        self._module = None
+
+    def _apply(self, decay, params):
+        if hasattr(torch, "_foreach_mul_"):
+            torch._foreach_mul_(self.shadow, 1 - decay)
+            torch._foreach_add_(self.shadow, params, alpha=decay)
+        else:
+            for avg, param in zip(self.shadow, params):
+                avg.mul_(1 - decay).add_(param, alpha=decay)
+
+    def synchronize(self):
+        """Apply the update still waiting for its copies, if any."""
+        if self._pending is not None:
+            event, decay = self._pending
+            self._pending = None
+            event.synchronize()
+            self._apply(decay, self._staging)
+
+    def wait_for_copies(self):
+        """Make the current CUDA stream wait for the copies of the last
+        update, before the parameters change in place, e.g. in the next
+        optimizer step."""
+        if self._pending is not None:
+            torch.cuda.current_stream().wait_event(self._pending[0])
+
+    def update(self, step):
+        """Move the average towards the current parameters.
+
+        The first update copies them; later ones weigh them by
+        ``max(decay, 1 - (step + 1) / (step + 10))``, as in Marian.
+        """
+        self.updates += 1
+        if self.shadow is None:
+            self._init_shadow()
+            return
+        self.synchronize()
+        decay = max(self.decay, 1 - (step + 1) / (step + 10))
+        params = self._params()
+        if self._staging is None:
+            self._apply(decay, params)
+        elif self._stream is not None:
+            self._stream.wait_stream(torch.cuda.current_stream())
+            with torch.cuda.stream(self._stream):
+                for buf, param in zip(self._staging, params):
+                    buf.copy_(param, non_blocking=True)
+                event = torch.cuda.Event()
+                event.record()
+            self._pending = (event, decay)
+        else:
+            for buf, param in zip(self._staging, params):
+                buf.copy_(param)
+            self._apply(decay, self._staging)
+
+    def module(self, device=None):
+        """The model with the averaged weights as parameters.
+
+        It shares the average and the buffers of the model, so that it
+        follows the updates; on another ``device`` than the average, it
+        is a copy instead.
+        """
+        self.synchronize()
+        if self._module is None:
+            memo = {id(b): b for b in self.model.buffers()}
+            for param, avg in zip(self.model.parameters(), self.shadow):
+                memo[id(param)] = torch.nn.Parameter(
+                    avg, requires_grad=False)
+            self._module = copy.deepcopy(self.model, memo)
+        device = None if device is None else torch.device(device)
+        if device is None or device == self.shadow[0].device:
+            return self._module
+        return copy.deepcopy(self._module).to(device)
+
+    def state_dict(self):
+        """Settings and progress of the average. The average itself is
+        saved as the weights of :meth:`module`."""
+        return {"decay": self.decay, "updates": self.updates}
+
+    def load_state_dict(self, state_dict):
+        """Resume from :meth:`state_dict`, taking the current parameters
+        of the model, loaded from the saved average, as the average."""
+        self.updates = state_dict["updates"]
+        self._init_shadow()
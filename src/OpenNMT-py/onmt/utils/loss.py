@@ -3,6 +3,8 @@ This includes: LossComputeBase and the standard NMTLossCompute, and
                sharded loss compute stuff.
 """
 from __future__ import division
+import math
+
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
@@ -35,6 +37,11 @@ def build_loss_compute(model, tgt_field, opt, train=True):
             len(tgt_field.vocab), opt.copy_attn_force,
             unk_index=unk_idx, ignore_index=padding_idx
         )
+    elif opt.label_smoothing > 0 and train \
+            and isinstance(model.generator[-1], nn.LogSoftmax):
+        criterion = FusedLabelSmoothingLoss(
+            opt.label_smoothing, len(tgt_field.vocab), ignore_index=padding_idx
+        )
     elif opt.label_smoothing > 0 and train:
         criterion = LabelSmoothingLoss(
             opt.label_smoothing, len(tgt_field.vocab), ignore_index=padding_idx
@@ -50,6 +57,9 @@ def build_loss_compute(model, tgt_field, opt, train=True):
     # loss function of this kind is the sparsemax loss.
     use_raw_logits = isinstance(criterion, SparsemaxLoss)
     loss_gen = model.generator[0] if use_raw_logits else model.generator
+    if isinstance(criterion, FusedLabelSmoothingLoss):
+        # the fused loss normalizes the (float32) logits itself
+        loss_gen = model.generator[:-1]
     if opt.copy_attn:
         compute = onmt.modules.CopyGeneratorLossCompute(
             criterion, loss_gen, tgt_field.vocab, opt.copy_loss_by_seqlength,
@@ -126,7 +136,8 @@ class LossComputeBase(nn.Module):
                  normalization=1.0,
                  shard_size=0,
                  trunc_start=0,
-                 trunc_size=None):
+                 trunc_size=None,
+                 phase_timer=None):
         """Compute the forward loss, possibly in shards in which case this
         method also runs the backward pass and returns ``None`` as the loss
         value.
@@ -150,6 +161,8 @@ class LossComputeBase(nn.Module):
           shard_size (int) : maximum number of examples in a shard
           trunc_start (int) : starting position of truncation window
           trunc_size (int) : length of truncation window
+          phase_timer (:obj:`onmt.utils.PhaseTimer`) : times the backward
+              pass through the model after the shards, or None
 
         Returns:
             A tuple with the loss and a :obj:`onmt.utils.Statistics` instance.
@@ -162,7 +175,8 @@ class LossComputeBase(nn.Module):
             loss, stats = self._compute_loss(batch, **shard_state)
             return loss / float(normalization), stats
         batch_stats = onmt.utils.Statistics()
-        for shard in shards(shard_state, shard_size):
+        for shard in shards(shard_state, shard_size,
+                            phase_timer=phase_timer):
             loss, stats = self._compute_loss(batch, **shard)
             loss.div(float(normalization)).backward()
             batch_stats.update(stats)
@@ -221,6 +235,88 @@ class LabelSmoothingLoss(nn.Module):
         return F.kl_div(output, model_prob, reduction='sum')
 
 
+class _FusedLabelSmoothing(torch.autograd.Function):
+    """Sum of the per-token losses of :class:`FusedLabelSmoothingLoss`,
+    computed ``chunk_size`` tokens at a time. The gradient w.r.t. the
+    logits, softmax - q, is written chunk by chunk in place."""
+
+    @staticmethod
+    def forward(ctx, logits, target, crit):
+        keep = target.ne(crit.ignore_index)
+        lse = torch.empty(logits.size(0), dtype=logits.dtype,
+                          device=logits.device)
+        loss = logits.new_zeros(())
+        for start in range(0, logits.size(0), crit.chunk_size):
+            chunk = slice(start, start + crit.chunk_size)
+            z = logits[chunk]
+            lse[chunk] = z.logsumexp(1)
+            # since confidence + (V - 2) * smoothing = 1
+            tok_loss = lse[chunk] + crit.neg_entropy \
+                - (crit.confidence - crit.smoothing_value) \
+                * z.gather(1, target[chunk].unsqueeze(1)).squeeze(1) \
+                + crit.smoothing_value * (z[:, crit.ignore_index] - z.sum(1))
+            loss += tok_loss.masked_fill(~keep[chunk], 0).sum()
+        ctx.save_for_backward(logits, target, lse, keep)
+        ctx.crit = crit
+        return loss
+
+    @staticmethod
+    def backward(ctx, grad_output):
+        logits, target, lse, keep = ctx.saved_tensors
+        crit = ctx.crit
+        grad = torch.empty_like(logits)
+        for start in range(0, logits.size(0), crit.chunk_size):
+            chunk = slice(start, start + crit.chunk_size)
+            g = grad[chunk]
+            torch.sub(logits[chunk], lse[chunk].unsqueeze(1), out=g)
+            g.exp_().sub_(crit.smoothing_value)
+            g.scatter_add_(1, target[chunk].unsqueeze(1), g.new_full(
+                (g.size(0), 1),
+                crit.smoothing_value - crit.confidence))
+            g[:, crit.ignore_index] += crit.smoothing_value
+            g.mul_((grad_output * keep[chunk]).unsqueeze(1).to(g.dtype))
+        return grad, None, None
+
+
+class FusedLabelSmoothingLoss(nn.Module):
+    """
+    The loss of :class:`LabelSmoothingLoss`, computed from the logits.
+
+    The KL-divergence from the smoothed distribution q (``confidence`` on
+    the target, ``label_smoothing / (tgt_vocab_size - 2)`` on the other
+    non-padding words) to p = softmax(logits) is, for each token,
+
+        sum_w q(w) log q(w) - confidence * log p(target)
+            - smoothing * (sum_w log p(w) - log p(target) - log p(pad))
+
+    where log p(w) = logits(w) - logsumexp(logits). It only takes a few
+    reductions of the logits, and its gradient is softmax(logits) - q:
+    neither q nor log p are materialized, and the temporaries are
+    bounded by ``chunk_size`` tokens.
+    """
+    def __init__(self, label_smoothing, tgt_vocab_size, ignore_index=-100,
+                 chunk_size=512):
+        assert 0.0 < label_smoothing <= 1.0
+        super(FusedLabelSmoothingLoss, self).__init__()
+        self.ignore_index = ignore_index
+        self.tgt_vocab_size = tgt_vocab_size
+        self.chunk_size = chunk_size
+        self.confidence = 1.0 - label_smoothing
+        self.smoothing_value = label_smoothing / (tgt_vocab_size - 2)
+
+        def xlogx(x):
+            return x * math.log(x) if x > 0 else 0.0
+        self.neg_entropy = xlogx(self.confidence) \
+            + (tgt_vocab_size - 2) * xlogx(self.smoothing_value)
+
+    def forward(self, output, target):
+        """
+        output (FloatTensor): batch_size x n_classes, unnormalized
+        target (LongTensor): batch_size
+        """
+        return _FusedLabelSmoothing.apply(output, target, self)
+
+
 class NMTLossCompute(LossComputeBase):
     """
     Standard NMT Loss Computation.
@@ -233,9 +329,17 @@ class NMTLossCompute(LossComputeBase):
         self.lambda_align = lambda_align
 
     def _make_shard_state(self, batch, output, range_, attns=None):
+        target = batch.tgt[range_[0] + 1: range_[1], :, 0]
+        tgt_segments = getattr(batch, "tgt_segments", None)
+        if tgt_segments is not None:
+            # packed rows: the BOS of an example is not a prediction
+            # from the end of the one before
+            segments = tgt_segments[range_[0]: range_[1]]
+            target = target.masked_fill(
+                segments[1:] != segments[:-1], self.padding_idx)
         shard_state = {
             "output": output,
-            "target": batch.tgt[range_[0] + 1: range_[1], :, 0],
+            "target": target,
         }
         if self.lambda_coverage != 0.0:
             coverage = attns.get("coverage", None)
@@ -322,16 +426,23 @@ def filter_shard_state(state, shard_size=None):
             yield k, v
 
         if v is not None:
-            v_split = []
+            v_split, v_grad = [], None
             if isinstance(v, torch.Tensor):
-                for v_chunk in torch.split(v, shard_size):
-                    v_chunk = v_chunk.data.clone()
-                    v_chunk.requires_grad = v.requires_grad
-                    v_split.append(v_chunk)
-            yield k, (v, v_split)
-
-
-def shards(state, shard_size, eval_only=False):
+                # Shards are detached views of ``v``, not copies. Their
+                # ``.grad`` is preset to the matching view of a single
+                # buffer, so each shard's backward accumulates in place.
+                v_chunks = torch.split(v.detach(), shard_size)
+                if v.requires_grad:
+                    v_grad = torch.zeros_like(v)
+                    for v_chunk, g_chunk in zip(
+                            v_chunks, torch.split(v_grad, shard_size)):
+                        v_chunk.requires_grad_()
+                        v_chunk.grad = g_chunk
+                v_split = list(v_chunks)
+            yield k, (v, v_split, v_grad)
+
+
+def shards(state, shard_size, eval_only=False, phase_timer=None):
     """
     Args:
         state: A dictionary which corresponds to the output of
@@ -340,6 +451,8 @@ def shards(state, shard_size, eval_only=False):
         shard_size: The maximum size of the shards yielded by the model.
         eval_only: If True, only yield the state, nothing else.
               Otherwise, yield shards.
+        phase_timer: times the back-propagation as "backward", if not
+              None.
 
     Yields:
         Each yielded shard is a dict.
@@ -359,8 +472,8 @@ def shards(state, shard_size, eval_only=False):
         # want a sequence of dictionaries of tensors.
         # First, unzip the dictionary into a sequence of keys and a
         # sequence of tensor-like sequences.
-        keys, values = zip(*((k, [v_chunk for v_chunk in v_split])
-                             for k, (_, v_split) in non_none.items()))
+        keys, values = zip(*((k, v_split)
+                             for k, (_, v_split, _) in non_none.items()))
 
         # Now, yield a dictionary for each shard. The keys are always
         # the same. values is a sequence of length #keys where each
@@ -371,11 +484,14 @@ def shards(state, shard_size, eval_only=False):
         for shard_tensors in zip(*values):
             yield dict(zip(keys, shard_tensors))
 
-        # Assumed backprop'd
-        variables = []
-        for k, (v, v_split) in non_none.items():
-            if isinstance(v, torch.Tensor) and state[k].requires_grad:
-                variables.extend(zip(torch.split(state[k], shard_size),
-                                     [v_chunk.grad for v_chunk in v_split]))
+        # Assumed backprop'd: the shard gradients were accumulated into
+        # one buffer per tensor, so a single backward through the full
+        # tensors finishes the job.
+        variables = [(v, v_grad) for v, _, v_grad in non_none.values()
+                     if v_grad is not None]
         inputs, grads = zip(*variables)
-        torch.autograd.backward(inputs, grads)
+        if phase_timer is None:
+            torch.autograd.backward(inputs, grads)
+        else:
+            with phase_timer("backward"):
+                torch.autograd.backward(inputs, grads)
@@ -3,6 +3,7 @@
 import torch
 import random
 import inspect
+import contextlib
 from itertools import islice, repeat
 import os
 
@@ -53,6 +54,28 @@ def sequence_mask(lengths, max_len=None):
             .lt(lengths.unsqueeze(1)))
 
 
+def segment_mask(query_segments, key_segments):
+    """
+    Creates the attention mask of packed rows, see
+    :mod:`onmt.inputters.packing`: ``True`` where query and key belong to
+    different examples. Segments are ``(len, batch)`` example ids, the
+    mask is ``(batch, query_len, key_len)``.
+    """
+    return query_segments.t().unsqueeze(2) != key_segments.t().unsqueeze(1)
+
+
+def segment_positions(segments):
+    """
+    Position of each token of packed rows within its example, from the
+    ``(len, batch)`` example ids of the tokens.
+    """
+    steps = torch.arange(segments.size(0), device=segments.device) \
+        .unsqueeze(1).expand_as(segments)
+    starts = torch.ones_like(segments, dtype=torch.bool)
+    starts[1:] = segments[1:] != segments[:-1]
+    return steps - torch.where(starts, steps, 0).cummax(0)[0]
+
+
 def tile(x, count, dim=0):
     """
     Tiles x on dimension dim count times.
@@ -99,6 +122,46 @@ def set_random_seed(seed, is_cuda):
         torch.cuda.manual_seed(seed)
 
 
+def get_rng_state():
+    """The state of the random generators, see :func:`set_rng_state`."""
+    state = {"python": random.getstate(), "torch": torch.get_rng_state()}
+    if torch.cuda.is_available() and torch.cuda.is_initialized():
+        state["cuda"] = torch.cuda.get_rng_state()
+    return state
+
+
+def set_rng_state(state):
+    """Restore the random generators as :func:`get_rng_state` saw them."""
+    random.setstate(state["python"])
+    torch.set_rng_state(state["torch"])
+    if "cuda" in state and torch.cuda.is_available():
+        torch.cuda.set_rng_state(state["cuda"])
+
+
+def autocast(model_dtype, device=None):
+    """Mixed precision context for ``-model_dtype bf16``.
+
+    Matmuls run in bfloat16 while the weights stay in fp32; softmax,
+    layer norm and the loss are kept in fp32 by autocast and by the
+    explicit casts in the attention and the generator. Any other
+    ``model_dtype`` gets a no-op context.
+
+    Args:
+        model_dtype (str): ``"fp32"``, ``"fp16"`` or ``"bf16"``.
+        device (torch.device or str): device the model runs on,
+            CPU if ``None``.
+    """
+    if model_dtype != "bf16":
+        return _no_autocast()
+    device_type = torch.device(device or "cpu").type
+    return torch.autocast(device_type, dtype=torch.bfloat16)
+
+
+@contextlib.contextmanager
+def _no_autocast():
+    yield
+
+
 def generate_relative_positions_matrix(length, max_relative_positions,
                                        cache=False):
     """Generate the clipped relative positions matrix
@@ -1,7 +1,9 @@
 import configargparse as cfargparse
+import inspect
 import os
 
 import torch
+from torch.utils.data import DataLoader
 
 import onmt.opts as opts
 from onmt.utils.logging import logger
@@ -113,9 +115,51 @@ class ArgumentParser(cfargparse.ArgumentParser):
                   "unless -world_size is greater than len(gpu_ranks).")
         assert len(opt.data_ids) == len(opt.data_weights), \
             "Please check -data_ids and -data_weights options!"
-
+        assert opt.num_workers >= 0 and opt.prefetch > 0, \
+            "-num_workers must be >= 0 and -prefetch > 0."
+        assert opt.num_workers == 0 or "prefetch_factor" in \
+            inspect.signature(DataLoader).parameters, \
+            "-num_workers requires torch>=1.7."
+        if opt.preload_tensors:
+            assert opt.model_type == "text" and not opt.copy_attn \
+                and opt.lambda_align == 0.0, \
+                "-preload_tensors only supports text data, without " \
+                "-copy_attn or alignments."
+            assert len(opt.data_ids) == 1, \
+                "-preload_tensors requires a single corpus."
+
+        if opt.pack_length > 0:
+            assert opt.model_type == "text" \
+                and opt.encoder_type == "transformer" \
+                and opt.decoder_type == "transformer" \
+                and opt.self_attn_type == "scaled-dot", \
+                "-pack_length requires text data and a transformer " \
+                "encoder and decoder with scaled-dot self-attention."
+            assert not opt.copy_attn and opt.lambda_align == 0.0 \
+                and opt.truncated_decoder == 0 and not opt.src_noise, \
+                "-pack_length does not support -copy_attn, alignments, " \
+                "-truncated_decoder or -src_noise."
+        if opt.valid_exact_match \
+                or "exact_match" in (opt.early_stopping_criteria or []):
+            assert not opt.copy_attn, \
+                "Exact match in validation does not support -copy_attn."
+
+        if opt.replicas > 1:
+            assert opt.world_size == 1 and opt.model_dtype != "fp16" \
+                and not opt.train_from, \
+                "-replicas does not support multiple processes, " \
+                "-model_dtype fp16 or -train_from."
+            assert opt.model_type == "text" and not opt.copy_attn \
+                and opt.lambda_align == 0.0 and opt.lambda_coverage == 0.0 \
+                and opt.truncated_decoder == 0 and not opt.src_noise \
+                and not opt.phase_timing, \
+                "-replicas only supports text data, without -copy_attn, " \
+                "alignments, coverage, -truncated_decoder, -src_noise " \
+                "or -phase_timing."
         assert len(opt.dropout) == len(opt.dropout_steps), \
             "Number of dropout values must match accum_steps values"
+        assert opt.model_dtype != "bf16" or hasattr(torch, "autocast"), \
+            "-model_dtype bf16 requires torch>=1.10."
 
         assert len(opt.attention_dropout) == len(opt.dropout_steps), \
             "Number of attention_dropout values must match accum_steps values"
@@ -124,6 +168,8 @@ class ArgumentParser(cfargparse.ArgumentParser):
     def validate_translate_opts(cls, opt):
         if opt.beam_size != 1 and opt.random_sampling_topk != 1:
             raise ValueError('Can either do beam search OR random sampling.')
+        assert not opt.bf16 or hasattr(torch, "autocast"), \
+            "-bf16 requires torch>=1.10."
 
     @classmethod
     def validate_preprocess_args(cls, opt):
@@ -160,6 +206,12 @@ class ArgumentParser(cfargparse.ArgumentParser):
         assert not opt.valid_tgt or os.path.isfile(opt.valid_tgt), \
             "Please check path of your valid tgt file!"
 
+        if opt.shard_format == "bin":
+            assert opt.data_type == "text" \
+                and opt.train_align[0] is None, \
+                "-shard_format bin only supports text data without " \
+                "alignments."
+
         assert not opt.src_vocab or os.path.isfile(opt.src_vocab), \
             "Please check path of your src vocab!"
         assert not opt.tgt_vocab or os.path.isfile(opt.tgt_vocab), \
@@ -0,0 +1,110 @@
+"""Time spent in each phase of the training steps."""
+import json
+import math
+import time
+from array import array
+from contextlib import contextmanager
+
+import torch
+
+
+class PhaseTimer(object):
+    """Time the phases of the training steps.
+
+    A phase is timed with ``with timer("forward"):``. Phases nest: the
+    time of an inner phase is not counted in the outer one, e.g. the
+    backward pass run while computing a sharded loss. With ``cuda``, the
+    device is synchronized at each phase boundary, so that kernels count
+    in the phase that launched them; this slows training down a little.
+
+    The time of each phase is summed over a step, until
+    :meth:`end_step`, and kept for every step (in ms) to report its
+    distribution, over the last report interval (:meth:`summary`) or the
+    whole training (:meth:`dump`).
+
+    Args:
+        cuda (bool): synchronize CUDA at the phase boundaries.
+    """
+
+    PHASES = ["data", "forward", "loss", "backward", "all_reduce",
+              "optim", "checkpoint"]
+
+    def __init__(self, cuda=False):
+        self.cuda = cuda
+        self.times = {phase: array("d") for phase in self.PHASES}
+        self._step = dict.fromkeys(self.PHASES, 0.)
+        self._running = []
+        self._interval_start = 0
+
+    def _now(self):
+        if self.cuda:
+            torch.cuda.synchronize()
+        return time.perf_counter()
+
+    @contextmanager
+    def __call__(self, phase):
+        now = self._now()
+        if self._running:
+            outer = self._running[-1]
+            self._step[outer[0]] += now - outer[1]
+        self._running.append([phase, now])
+        try:
+            yield
+        finally:
+            now = self._now()
+            self._step[phase] += now - self._running.pop()[1]
+            if self._running:
+                # the outer phase resumes
+                self._running[-1][1] = now
+
+    def add(self, phase, seconds):
+        """Count ``seconds`` in ``phase``, timed by the caller."""
+        self._step[phase] += seconds
+
+    def end_step(self):
+        """Record the time of each phase in the step."""
+        for phase, seconds in self._step.items():
+            self.times[phase].append(1000 * seconds)
+            self._step[phase] = 0.
+
+    @property
+    def n_steps(self):
+        return len(self.times[self.PHASES[0]])
+
+    def summary(self, start=0):
+        """The mean, median and 95th percentile of the time of each
+        phase, in ms per step, over the steps from ``start``."""
+        summary = {}
+        for phase, times in self.times.items():
+            times = sorted(times[start:])
+            summary[phase] = {
+                "mean": sum(times) / len(times) if times else 0.,
+                "p50": _percentile(times, 50),
+                "p95": _percentile(times, 95)}
+        return summary
+
+    def interval_summary(self):
+        """The :meth:`summary` of the steps since the last call."""
+        summary = self.summary(self._interval_start)
+        self._interval_start = self.n_steps
+        return summary
+
+    def dump(self, path):
+        """Write the :meth:`summary` of all the steps, and the total time
+        of each phase, in JSON to ``path``."""
+        summary = self.summary()
+        for phase, stats in summary.items():
+            # the time since the last step, e.g. the last checkpoint
+            stats["total"] = sum(self.times[phase]) \
+                + 1000 * self._step[phase]
+        with open(path, "w") as f:
+            json.dump({"unit": "ms", "steps": self.n_steps,
+                       "phases": summary}, f, indent=2)
+
+
+def _percentile(sorted_values, q):
+    """The nearest-rank ``q``-th percentile of ``sorted_values``."""
+    if not sorted_values:
+        return 0.
+    rank = max(int(math.ceil(q / 100 * len(sorted_values))), 1)
+    return sorted_values[rank - 1]
@@ -50,7 +50,7 @@ class ReportMgrBase(object):
         logger.info(*args, **kwargs)
 
     def report_training(self, step, num_steps, learning_rate,
-                        report_stats, multigpu=False):
+                        report_stats, multigpu=False, phase_timer=None):
         """
         This is the user-defined batch-level traing progress
         report function.
@@ -60,6 +60,8 @@ class ReportMgrBase(object):
             num_steps(int): total number of batches.
             learning_rate(float): current learning rate.
             report_stats(Statistics): old Statistics instance.
+            phase_timer(PhaseTimer): also report the time of the phases
+                of the steps since the last report, if not None.
         Returns:
             report_stats(Statistics): updated Statistics instance.
         """
@@ -73,6 +75,8 @@ class ReportMgrBase(object):
                     onmt.utils.Statistics.all_gather_stats(report_stats)
             self._report_training(
                 step, num_steps, learning_rate, report_stats)
+            if phase_timer is not None:
+                self._report_phases(step, phase_timer.interval_summary())
             return onmt.utils.Statistics()
         else:
             return report_stats
@@ -81,6 +85,10 @@ class ReportMgrBase(object):
         """ To be overridden """
         raise NotImplementedError()
 
+    def _report_phases(self, *args, **kwargs):
+        """ To be overridden """
+        raise NotImplementedError()
+
     def report_step(self, lr, step, train_stats=None, valid_stats=None):
         """
         Report stats of a step
@@ -132,6 +140,19 @@ class ReportMgr(ReportMgrBase):
 
         return report_stats
 
+    def _report_phases(self, step, summary):
+        """
+        Report the time of each phase, see `PhaseTimer.summary`.
+        """
+        self.log("Phases (ms/step, mean/p50/p95): " + "; ".join(
+            "%s %.1f/%.1f/%.1f" % (phase, s["mean"], s["p50"], s["p95"])
+            for phase, s in summary.items()))
+        if self.tensorboard_writer is not None:
+            for phase, stats in summary.items():
+                for name, value in stats.items():
+                    self.tensorboard_writer.add_scalar(
+                        "phases/%s_%s" % (phase, name), value, step)
+
     def _report_step(self, lr, step, train_stats=None, valid_stats=None):
         """
         See base class method `ReportMgrBase.report_step`.
@@ -148,6 +169,9 @@ class ReportMgr(ReportMgrBase):
         if valid_stats is not None:
             self.log('Validation xent: %g' % valid_stats.xent())
             self.log('Validation accuracy: %g' % valid_stats.accuracy())
+            if valid_stats.n_sents > 0:
+                self.log('Validation exact match: %g'
+                         % valid_stats.exact_match())
 
             self.maybe_log_tensorboard(valid_stats,
                                        "valid",
@@ -1,5 +1,6 @@
 """ Statistics calculation utility """
 from __future__ import division
+import copy
 import time
 import math
 import sys
@@ -15,6 +16,9 @@ class Statistics(object):
     * accuracy
     * perplexity
     * elapsed time
+    * time spent waiting for training data, per step
+    * share of padding in the training batches
+    * exact match of greedy decoding, in validation
     """
 
     def __init__(self, loss=0, n_words=0, n_correct=0):
@@ -22,50 +26,63 @@ class Statistics(object):
         self.n_words = n_words
         self.n_correct = n_correct
         self.n_src_words = 0
+        self.n_steps = 0
+        self.data_wait = 0.
+        self.n_tokens = 0
+        self.n_padding = 0
+        self.n_sents = 0
+        self.n_exact = 0
         self.start_time = time.time()
 
+    # the fields summed over processes
+    REDUCED = ["loss", "n_words", "n_correct", "n_src_words",
+               "n_steps", "data_wait", "n_tokens", "n_padding",
+               "n_sents", "n_exact"]
+
     @staticmethod
-    def all_gather_stats(stat, max_size=4096):
+    def all_gather_stats(stat):
         """
         Gather a `Statistics` object accross multiple process/nodes
 
         Args:
             stat(:obj:Statistics): the statistics object to gather
                 accross all processes/nodes
-            max_size(int): max buffer size to use
 
         Returns:
             `Statistics`, the update stats object
         """
-        stats = Statistics.all_gather_stats_list([stat], max_size=max_size)
+        stats = Statistics.all_gather_stats_list([stat])
         return stats[0]
 
     @staticmethod
-    def all_gather_stats_list(stat_list, max_size=4096):
+    def all_gather_stats_list(stat_list):
         """
-        Gather a `Statistics` list accross all processes/nodes
+        Sum a `Statistics` list accross all processes/nodes
+
+        The fields in `REDUCED` of all the statistics are reduced at once,
+        as a single float64 tensor.
 
         Args:
             stat_list(list([`Statistics`])): list of statistics objects to
                 gather accross all processes/nodes
-            max_size(int): max buffer size to use
 
         Returns:
             our_stats(list([`Statistics`])): list of updated stats
         """
-        from torch.distributed import get_rank
-        from onmt.utils.distributed import all_gather_list
-
-        # Get a list of world_size lists with len(stat_list) Statistics objects
-        all_stats = all_gather_list(stat_list, max_size=max_size)
-
-        our_rank = get_rank()
-        our_stats = all_stats[our_rank]
-        for other_rank, stats in enumerate(all_stats):
-            if other_rank == our_rank:
-                continue
-            for i, stat in enumerate(stats):
-                our_stats[i].update(stat, update_n_src_words=True)
+        from onmt.utils.distributed import all_reduce_values
+
+        totals = all_reduce_values(
+            [[getattr(stat, name) for name in Statistics.REDUCED]
+             for stat in stat_list])
+        our_stats = []
+        for stat, values in zip(stat_list, totals):
+            stat = copy.copy(stat)
+            for name, value in zip(Statistics.REDUCED, values):
+                # counts stay integers
+                if isinstance(getattr(stat, name), int):
+                    value = int(value)
+                setattr(stat, name, value)
+            our_stats.append(stat)
         return our_stats
 
     def update(self, stat, update_n_src_words=False):
@@ -81,10 +98,23 @@ class Statistics(object):
         self.loss += stat.loss
         self.n_words += stat.n_words
         self.n_correct += stat.n_correct
+        self.n_steps += stat.n_steps
+        self.data_wait += stat.data_wait
+        self.n_tokens += stat.n_tokens
+        self.n_padding += stat.n_padding
+        self.n_sents += stat.n_sents
+        self.n_exact += stat.n_exact
 
         if update_n_src_words:
             self.n_src_words += stat.n_src_words
 
+    def update_padding(self, src, src_lengths, tgt, tgt_pad):
+        """Count the padding of the ``src`` and ``tgt`` of a text batch."""
+        n_tokens = src.size(0) * src.size(1) + tgt.size(0) * tgt.size(1)
+        n_real = src_lengths.sum() + tgt[:, :, 0].ne(tgt_pad).sum()
+        self.n_tokens += n_tokens
+        self.n_padding += n_tokens - n_real.item()
+
     def accuracy(self):
         """ compute accuracy """
         return 100 * (self.n_correct / self.n_words)
@@ -101,6 +131,18 @@ class Statistics(object):
         """ compute elapsed time """
         return time.time() - self.start_time
 
+    def padding(self):
+        """ compute the share of padding of the batches, in % """
+        return 100 * self.n_padding / self.n_tokens if self.n_tokens else 0.
+
+    def exact_match(self):
+        """ compute the share of exactly matched sentences, in % """
+        return 100 * self.n_exact / self.n_sents if self.n_sents else 0.
+
+    def data_wait_per_step(self):
+        """ compute time spent waiting for batches, in ms per step """
+        return 1000 * self.data_wait / self.n_steps if self.n_steps else 0.
+
     def output(self, step, num_steps, learning_rate, start):
         """Write out statistics to stdout.
 
@@ -113,9 +155,14 @@ class Statistics(object):
         step_fmt = "%2d" % step
         if num_steps > 0:
             step_fmt = "%s/%5d" % (step_fmt, num_steps)
+        data_fmt = ""
+        if self.n_tokens > 0:
+            data_fmt += "; pad: %4.1f%%" % self.padding()
+        if self.n_steps > 0:
+            data_fmt += "; data: %4.1f ms/step" % self.data_wait_per_step()
         logger.info(
             ("Step %s; acc: %6.2f; ppl: %5.2f; xent: %4.2f; " +
-             "lr: %7.5f; %3.0f/%3.0f tok/s; %6.0f sec")
+             "lr: %7.5f; %3.0f/%3.0f tok/s; %6.0f sec%s")
             % (step_fmt,
                self.accuracy(),
                self.ppl(),
@@ -123,7 +170,8 @@ class Statistics(object):
                learning_rate,
                self.n_src_words / (t + 1e-5),
                self.n_words / (t + 1e-5),
-               time.time() - start))
+               time.time() - start,
+               data_fmt))
         sys.stdout.flush()
 
     def log_tensorboard(self, prefix, writer, learning_rate, step):
@@ -134,3 +182,11 @@ class Statistics(object):
         writer.add_scalar(prefix + "/accuracy", self.accuracy(), step)
         writer.add_scalar(prefix + "/tgtper", self.n_words / t, step)
         writer.add_scalar(prefix + "/lr", learning_rate, step)
+        if self.n_steps > 0:
+            writer.add_scalar(
+                prefix + "/data_wait", self.data_wait_per_step(), step)
+        if self.n_tokens > 0:
+            writer.add_scalar(prefix + "/padding", self.padding(), step)
+        if self.n_sents > 0:
+            writer.add_scalar(
+                prefix + "/exact_match", self.exact_match(), step)
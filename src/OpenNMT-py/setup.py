@@ -38,6 +38,8 @@ setup(
             "onmt_train=onmt.bin.train:main",
             "onmt_translate=onmt.bin.translate:main",
             "onmt_preprocess=onmt.bin.preprocess:main",
+            "onmt_compile_corpus=onmt.bin.compile_corpus:main",
+            "onmt_sweep=onmt.bin.sweep:main",
             "onmt_release_model=onmt.bin.release_model:main",
             "onmt_average_models=onmt.bin.average_models:main"
         ],
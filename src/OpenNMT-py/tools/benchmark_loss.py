@@ -0,0 +1,89 @@
+#!/usr/bin/env python
+"""Compare the fused label-smoothing loss with LabelSmoothingLoss.
+
+Times forward and backward of generator + loss, and measures the peak
+memory each takes, in a fresh process (max RSS on CPU, allocator peak on
+GPU).
+
+    python tools/benchmark_loss.py -vocab 1000 8000 32000
+"""
+import argparse
+import resource
+import subprocess
+import sys
+import time
+
+import torch
+import torch.nn as nn
+
+from onmt.modules.util_class import Cast
+from onmt.utils.loss import FusedLabelSmoothingLoss, LabelSmoothingLoss
+
+
+def run(impl, tokens, vocab, hidden, steps, device):
+    torch.manual_seed(0)
+    linear = nn.Linear(hidden, vocab).to(device)
+    if impl == "fused":
+        generator = nn.Sequential(linear, Cast(torch.float32))
+        criterion = FusedLabelSmoothingLoss(0.1, vocab, ignore_index=1)
+    else:
+        generator = nn.Sequential(
+            linear, Cast(torch.float32), nn.LogSoftmax(dim=-1))
+        criterion = LabelSmoothingLoss(0.1, vocab, ignore_index=1)
+    criterion.to(device)
+    hidden_states = torch.randn(tokens, hidden, device=device,
+                                requires_grad=True)
+    target = torch.randint(0, vocab, (tokens,), device=device)
+    if device.type == "cuda":
+        torch.cuda.synchronize()
+        torch.cuda.reset_peak_memory_stats()
+    base = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    times = []
+    for _ in range(steps):
+        start = time.perf_counter()
+        loss = criterion(generator(hidden_states), target)
+        loss.backward()
+        if device.type == "cuda":
+            torch.cuda.synchronize()
+        times.append(time.perf_counter() - start)
+    if device.type == "cuda":
+        peak = torch.cuda.max_memory_allocated() / 2 ** 20
+    else:
+        peak = (resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+                - base) / 2 ** 10
+    times = sorted(times[1:])
+    print("%s %.1f %.1f %.6f" % (
+        impl, 1000 * times[len(times) // 2], peak, loss.item()))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("-tokens", type=int, default=2048)
+    parser.add_argument("-vocab", type=int, nargs="+",
+                        default=[1000, 8000, 32000])
+    parser.add_argument("-hidden", type=int, default=512)
+    parser.add_argument("-steps", type=int, default=6)
+    parser.add_argument("-device", default="cpu")
+    parser.add_argument("-impl", help=argparse.SUPPRESS)
+    opt = parser.parse_args()
+    if opt.impl is not None:
+        run(opt.impl, opt.tokens, opt.vocab[0], opt.hidden, opt.steps,
+            torch.device(opt.device))
+        return
+
+    print("%8s %-10s %10s %12s %14s" % (
+        "vocab", "loss", "ms/step", "peak MiB", "value"))
+    for vocab in opt.vocab:
+        for impl in ["label_smoothing", "fused"]:
+            out = subprocess.check_output([
+                sys.executable, __file__, "-impl", impl,
+                "-tokens", str(opt.tokens), "-vocab", str(vocab),
+                "-hidden", str(opt.hidden), "-steps", str(opt.steps),
+                "-device", opt.device]).decode().split()
+            print("%8d %-10s %10s %12s %14s" % (
+                vocab, "fused" if impl == "fused" else "reference",
+                out[1], out[2], out[3]))
+
+
+if __name__ == "__main__":
+    main()